@@ -0,0 +1,789 @@
+# A local stand-in for a Sonos household, for integration and load testing.
+#
+# Each fake speaker is an HTTP server answering the UPnP/SOAP calls sonobo
+# makes through soco (AVTransport, RenderingControl, ContentDirectory,
+# ZoneGroupTopology and the bits of DeviceProperties soco needs), plus event
+# subscriptions, so a soco.SoCo pointed at it does real HTTP, XML and event
+# traffic. Speakers keep a queue, transport state, volume and grouping, and
+# the household has a few Sonos playlists. Every request can be made slow
+# with --latency-ms/--jitter-ms.
+#
+# Speakers listen on 127.0.0.1, 127.0.0.2, ... so that, as on a real
+# network, each has its own address on the Sonos port; --write-cache writes
+# a speaker cache sonobo (or sonobo_replay.py --speaker) starts from.
+#
+#   python fake_sonos.py --write-cache speakers.json
+#   python fake_sonos.py --latency-ms 40 --jitter-ms 40 --speaker 'Living Room' --speaker Move
+
+import argparse
+import html
+import http.client
+import http.server
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import typing
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ElementTree
+
+import sonobo
+
+log = logging.getLogger("sonobo")
+
+SOAP_ENVELOPE_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+SOAP_RESPONSE_TEMPLATE = (
+    '<?xml version="1.0"?>'
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>%s</s:Body></s:Envelope>')
+SOAP_FAULT_TEMPLATE = (
+    '<s:Fault><faultcode>s:Client</faultcode><faultstring>UPnPError</faultstring>'
+    '<detail><UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+    '<errorCode>%d</errorCode></UPnPError></detail></s:Fault>')
+EVENT_TEMPLATE = '<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">%s</e:propertyset>'
+DIDL_TEMPLATE = (
+    '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
+    'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
+    'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '
+    'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">%s</DIDL-Lite>')
+DEVICE_DESCRIPTION_TEMPLATE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<root xmlns="urn:schemas-upnp-org:device-1-0"><specVersion><major>1</major><minor>0</minor></specVersion>'
+    '<device><deviceType>urn:schemas-upnp-org:device:ZonePlayer:1</deviceType>'
+    '<friendlyName>%(ip)s - Fake Sonos - %(uid)s</friendlyName><manufacturer>Sonos, Inc.</manufacturer>'
+    '<modelNumber>S0</modelNumber><modelName>Fake Sonos</modelName><softwareVersion>0.0-00000</softwareVersion>'
+    '<hardwareVersion>0.0.0.0-0.0</hardwareVersion><serialNum>%(serial)s</serialNum>'
+    '<UDN>uuid:%(uid)s</UDN><displayVersion>0.0</displayVersion><roomName>%(name)s</roomName>'
+    '</device></root>')
+
+# URL path of each service's control and event endpoints.
+SERVICE_PATHS = {
+    'AVTransport': '/MediaRenderer/AVTransport',
+    'RenderingControl': '/MediaRenderer/RenderingControl',
+    'ContentDirectory': '/MediaServer/ContentDirectory',
+    'ZoneGroupTopology': '/ZoneGroupTopology',
+    'DeviceProperties': '/DeviceProperties',
+}
+CONTROL_PATHS = {path + '/Control': service for service, path in SERVICE_PATHS.items()}
+EVENT_PATHS = {path + '/Event': service for service, path in SERVICE_PATHS.items()}
+
+# (in arguments, out arguments) of each action we answer, by service. soco
+# reads them from the service descriptions (see scpd()) to make its calls.
+ACTIONS = {
+    'AVTransport': {
+        'Play': (['InstanceID', 'Speed'], []),
+        'Pause': (['InstanceID'], []),
+        'Stop': (['InstanceID'], []),
+        'Next': (['InstanceID'], []),
+        'Previous': (['InstanceID'], []),
+        'Seek': (['InstanceID', 'Unit', 'Target'], []),
+        'SetAVTransportURI': (['InstanceID', 'CurrentURI', 'CurrentURIMetaData'], []),
+        'BecomeCoordinatorOfStandaloneGroup': (['InstanceID'], ['DelegatedGroupCoordinatorID', 'NewGroupID']),
+        'AddURIToQueue': (
+            ['InstanceID', 'EnqueuedURI', 'EnqueuedURIMetaData', 'DesiredFirstTrackNumberEnqueued',
+             'EnqueueAsNext'],
+            ['FirstTrackNumberEnqueued', 'NumTracksAdded', 'NewQueueLength', 'NewUpdateID']),
+        'RemoveAllTracksFromQueue': (['InstanceID'], []),
+        'GetTransportInfo': (['InstanceID'], ['CurrentTransportState', 'CurrentTransportStatus', 'CurrentSpeed']),
+        'GetPositionInfo': (['InstanceID'], ['Track', 'TrackDuration', 'TrackMetaData', 'TrackURI', 'RelTime',
+                                             'AbsTime', 'RelCount', 'AbsCount']),
+    },
+    'RenderingControl': {
+        'GetVolume': (['InstanceID', 'Channel'], ['CurrentVolume']),
+        'SetVolume': (['InstanceID', 'Channel', 'DesiredVolume'], []),
+        'SetRelativeVolume': (['InstanceID', 'Channel', 'Adjustment'], ['NewVolume']),
+        'GetMute': (['InstanceID', 'Channel'], ['CurrentMute']),
+        'SetMute': (['InstanceID', 'Channel', 'DesiredMute'], []),
+    },
+    'ContentDirectory': {
+        'Browse': (['ObjectID', 'BrowseFlag', 'Filter', 'StartingIndex', 'RequestedCount', 'SortCriteria'],
+                   ['Result', 'NumberReturned', 'TotalMatches', 'UpdateID']),
+    },
+    'ZoneGroupTopology': {
+        'GetZoneGroupState': ([], ['ZoneGroupState']),
+    },
+    'DeviceProperties': {
+        'GetHouseholdID': ([], ['CurrentHouseholdID']),
+        'GetZoneAttributes': ([], ['CurrentZoneName', 'CurrentIcon', 'CurrentConfiguration',
+                                   'CurrentTargetRoomName']),
+    },
+}
+SCPD_PATHS = {'/xml/%s1.xml' % service: service for service in ACTIONS}
+
+# UPnP error codes.
+ERROR_INVALID_ACTION = 401
+ERROR_INVALID_ARGS = 402
+ERROR_NO_SUCH_OBJECT = 701
+ERROR_PRECONDITION_FAILED = 412
+
+PLAYLIST_URI_PREFIX = 'file:///jffs/settings/savedqueues.rsq#'
+TRACKS_PER_PLAYLIST = 3
+EVENT_TIMEOUT_SEC = 3600
+# soco only knows a subscription once it has read the SUBSCRIBE response, so
+# the initial event waits this long rather than racing it.
+INITIAL_EVENT_DELAY_SEC = 0.05
+NOTIFY_TIMEOUT_SEC = 5.0
+DEFAULT_SPEAKERS = [sonobo.LIVING_ROOM, 'Move', 'Kitchen']
+DEFAULT_PLAYLISTS = ['Bedtime', 'Morning']
+
+class UPnPError(Exception):
+    def __init__(self, code: int):
+        super().__init__('UPnP error %d' % code)
+        self.code = code
+
+class FakeSonosSpeaker:
+    """The state of one fake speaker. Guarded by the household's lock."""
+
+    def __init__(self, name: str, ip: str, number: int):
+        self.name = name
+        self.ip = ip
+        self.port = 0
+        self.uid = 'RINCON_000E58FA%04X01400' % number
+        self.coordinator = self
+        self.transport_state = 'STOPPED'
+        self.av_transport_uri = ''
+        self.track = 0
+        self.volume = 10
+        self.mute = False
+        # (uri, title) per track.
+        self.queue: list[typing.Tuple[str, str]] = []
+        self.queue_update_id = 0
+        self.server: typing.Optional[http.server.ThreadingHTTPServer] = None
+
+    @property
+    def location(self) -> str:
+        return 'http://%s:%d/xml/device_description.xml' % (self.ip, self.port)
+
+    def __repr__(self) -> str:
+        return '<FakeSonosSpeaker %s %s:%d>' % (self.name, self.ip, self.port)
+
+class Subscription:
+    def __init__(self, sid: str, speaker: FakeSonosSpeaker, service: str, callback: str, timeout_sec: int):
+        self.sid = sid
+        self.speaker = speaker
+        self.service = service
+        self.callback = callback
+        self.seq = 0
+        self.expires = time.monotonic() + timeout_sec
+
+def scpd(service: str) -> bytes:
+    """The UPnP service description of 'service', with one string state variable per argument."""
+    actions = []
+    variables = set()
+    for action, (in_args, out_args) in ACTIONS[service].items():
+        arguments = []
+        for direction, names in (('in', in_args), ('out', out_args)):
+            for name in names:
+                arguments.append('<argument><name>%s</name><direction>%s</direction>'
+                                 '<relatedStateVariable>A_ARG_TYPE_%s</relatedStateVariable></argument>'
+                                 % (name, direction, name))
+                variables.add(name)
+        actions.append('<action><name>%s</name><argumentList>%s</argumentList></action>'
+                       % (action, ''.join(arguments)))
+    state_table = ''.join('<stateVariable sendEvents="no"><name>A_ARG_TYPE_%s</name><dataType>string</dataType>'
+                          '</stateVariable>' % name for name in sorted(variables))
+    return ('<?xml version="1.0" encoding="utf-8"?><scpd xmlns="urn:schemas-upnp-org:service-1-0">'
+            '<specVersion><major>1</major><minor>0</minor></specVersion><actionList>%s</actionList>'
+            '<serviceStateTable>%s</serviceStateTable></scpd>'
+            % (''.join(actions), state_table)).encode('utf-8')
+
+def didl_title(metadata: str) -> str:
+    """The dc:title in DIDL-Lite 'metadata', or '' if there is none."""
+    if not metadata:
+        return ''
+    try:
+        root = ElementTree.fromstring(metadata)
+    except ElementTree.ParseError:
+        return ''
+    return root.findtext('.//{http://purl.org/dc/elements/1.1/}title') or ''
+
+def parse_timeout(header: typing.Optional[str]) -> int:
+    """Seconds from a 'Second-N' TIMEOUT header."""
+    if header and header.startswith('Second-') and header[len('Second-'):].isdigit():
+        return int(header[len('Second-'):])
+    return EVENT_TIMEOUT_SEC
+
+class FakeHousehold:
+    """A set of fake speakers, with one HTTP server per speaker."""
+
+    def __init__(self, latency_sec: float = 0.0, jitter_sec: float = 0.0, port: int = sonobo.SONOS_PORT,
+                 seed: typing.Optional[int] = None):
+        self.latency_sec = latency_sec
+        self.jitter_sec = jitter_sec
+        self.port = port
+        self.random = random.Random(seed)
+        # A fresh household ID every time, because soco caches the zone group
+        # state by household.
+        self.household_id = 'Sonos_fake%s' % uuid.uuid4().hex[:16]
+        self.lock = threading.RLock()
+        self.speakers: list[FakeSonosSpeaker] = []
+        # title -> track URIs
+        self.playlists: dict[str, list[str]] = {}
+        self.saved_queues_update_id = 0
+        self.topology_id = 0
+        self.subscriptions: dict[str, Subscription] = {}
+        self.notifications: queue.Queue = queue.Queue()
+        self.requests = 0
+        self.threads: list[threading.Thread] = []
+
+    def add_speaker(self, name: str, ip: typing.Optional[str] = None) -> FakeSonosSpeaker:
+        with self.lock:
+            number = len(self.speakers) + 1
+            speaker = FakeSonosSpeaker(name, ip or '127.0.0.%d' % number, number)
+            self.speakers.append(speaker)
+            self.topology_id += 1
+        return speaker
+
+    def add_playlist(self, title: str, tracks: int = TRACKS_PER_PLAYLIST) -> None:
+        with self.lock:
+            self.playlists[title] = ['x-file-cifs://fake/%s/%d.mp3' % (urllib.parse.quote(title), i + 1)
+                                     for i in range(tracks)]
+            self.saved_queues_update_id += 1
+            speakers = list(self.speakers)
+        for speaker in speakers:
+            self.notify(speaker, 'ContentDirectory', {
+                'ContainerUpdateIDs': 'SQ:,%d' % self.saved_queues_update_id,
+                'SavedQueuesUpdateID': 'RINCON_FAKE,%d' % self.saved_queues_update_id,
+            })
+
+    def speaker_named(self, name: str) -> FakeSonosSpeaker:
+        for speaker in self.speakers:
+            if speaker.name == name:
+                return speaker
+        raise ValueError('No fake speaker named "%s"' % name)
+
+    def start(self) -> None:
+        """Starts a server for every speaker. With port 0 each gets a free port."""
+        for speaker in self.speakers:
+            server = http.server.ThreadingHTTPServer(
+                (speaker.ip, self.port), lambda *args, speaker=speaker: FakeSonosHandler(self, speaker, *args))
+            server.daemon_threads = True
+            speaker.server = server
+            speaker.port = server.server_address[1]
+            thread = threading.Thread(target=server.serve_forever, name='fake-sonos-%s' % speaker.ip)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        notifier = threading.Thread(target=self.run_notifier, name='fake-sonos-notifier')
+        notifier.daemon = True
+        notifier.start()
+        self.threads.append(notifier)
+
+    def stop(self) -> None:
+        for speaker in self.speakers:
+            if speaker.server is not None:
+                speaker.server.shutdown()
+                speaker.server.server_close()
+                speaker.server = None
+        self.notifications.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def speaker_cache(self) -> list[sonobo.JsonSpeakerT]:
+        """Entries for sonobo's speaker cache (see sonobo.save_speaker_cache)."""
+        entries: list[sonobo.JsonSpeakerT] = []
+        for speaker in self.speakers:
+            entry: sonobo.JsonSpeakerT = {
+                'name': speaker.name, 'ip': speaker.ip, 'uid': speaker.uid, 'household': self.household_id}
+            if speaker.port != sonobo.SONOS_PORT:
+                entry['port'] = speaker.port
+            entries.append(entry)
+        return entries
+
+    def delay(self) -> None:
+        with self.lock:
+            self.requests += 1
+            delay = self.latency_sec + self.random.uniform(0.0, self.jitter_sec)
+        if delay > 0:
+            time.sleep(delay)
+
+    # Speaker state, as seen by the outside world.
+
+    def set_transport_state(self, speaker: FakeSonosSpeaker, state: str) -> None:
+        """Changes the state as if someone had used the Sonos app."""
+        with self.lock:
+            speaker.coordinator.transport_state = state
+        self.notify_transport(speaker.coordinator)
+
+    def set_volume(self, speaker: FakeSonosSpeaker, volume: int) -> None:
+        with self.lock:
+            speaker.volume = max(0, min(100, volume))
+        self.notify(speaker, 'RenderingControl', self.rendering_control_event(speaker))
+
+    def group_members(self, coordinator: FakeSonosSpeaker) -> list[FakeSonosSpeaker]:
+        return [s for s in self.speakers if s.coordinator is coordinator]
+
+    def zone_group_state(self) -> str:
+        groups = []
+        with self.lock:
+            for coordinator in self.speakers:
+                if coordinator.coordinator is not coordinator:
+                    continue
+                members = ''.join(
+                    '<ZoneGroupMember UUID="%s" Location="%s" ZoneName="%s" Configuration="1" '
+                    'SoftwareVersion="0.0-00000" Invisible="0" IsZoneBridge="0"/>'
+                    % (member.uid, member.location, html.escape(member.name))
+                    for member in self.group_members(coordinator))
+                groups.append('<ZoneGroup Coordinator="%s" ID="%s:%d">%s</ZoneGroup>'
+                              % (coordinator.uid, coordinator.uid, self.topology_id, members))
+        return '<ZoneGroupState><ZoneGroups>%s</ZoneGroups><VanishedDevices/></ZoneGroupState>' % ''.join(groups)
+
+    def av_transport_event(self, speaker: FakeSonosSpeaker) -> dict[str, str]:
+        with self.lock:
+            track_uri = speaker.queue[speaker.track][0] if speaker.track < len(speaker.queue) else ''
+            values = [
+                ('TransportState', speaker.transport_state),
+                ('CurrentPlayMode', 'NORMAL'),
+                ('NumberOfTracks', str(len(speaker.queue))),
+                ('CurrentTrack', str(speaker.track + 1 if speaker.queue else 0)),
+                ('CurrentTrackURI', track_uri),
+                ('AVTransportURI', speaker.av_transport_uri),
+            ]
+        return {'LastChange': '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/AVT/"><InstanceID val="0">%s'
+                              '</InstanceID></Event>' % ''.join('<%s val="%s"/>' % (name, html.escape(value))
+                                                                for name, value in values)}
+
+    def rendering_control_event(self, speaker: FakeSonosSpeaker) -> dict[str, str]:
+        with self.lock:
+            volume, mute = speaker.volume, int(speaker.mute)
+        return {'LastChange': '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/RCS/"><InstanceID val="0">'
+                              '<Volume channel="Master" val="%d"/><Mute channel="Master" val="%d"/>'
+                              '</InstanceID></Event>' % (volume, mute)}
+
+    def content_directory_event(self, speaker: FakeSonosSpeaker) -> dict[str, str]:
+        with self.lock:
+            return {'ContainerUpdateIDs': 'Q:0,%d' % speaker.queue_update_id,
+                    'SavedQueuesUpdateID': 'RINCON_FAKE,%d' % self.saved_queues_update_id}
+
+    def initial_event(self, subscription: Subscription) -> dict[str, str]:
+        if subscription.service == 'AVTransport':
+            return self.av_transport_event(subscription.speaker)
+        elif subscription.service == 'RenderingControl':
+            return self.rendering_control_event(subscription.speaker)
+        elif subscription.service == 'ContentDirectory':
+            return self.content_directory_event(subscription.speaker)
+        elif subscription.service == 'ZoneGroupTopology':
+            return {'ZoneGroupState': self.zone_group_state()}
+        return {}
+
+    # Events.
+
+    def subscribe(self, speaker: FakeSonosSpeaker, service: str, callback: str, timeout_sec: int) -> Subscription:
+        sid = 'uuid:%s_sub%s' % (speaker.uid, uuid.uuid4().hex[:10])
+        subscription = Subscription(sid, speaker, service, callback, timeout_sec)
+        with self.lock:
+            self.subscriptions[sid] = subscription
+        return subscription
+
+    def renew(self, sid: str, timeout_sec: int) -> Subscription:
+        with self.lock:
+            subscription = self.subscriptions.get(sid)
+            if subscription is None or subscription.expires < time.monotonic():
+                raise UPnPError(ERROR_PRECONDITION_FAILED)
+            subscription.expires = time.monotonic() + timeout_sec
+        return subscription
+
+    def unsubscribe(self, sid: str) -> None:
+        with self.lock:
+            if self.subscriptions.pop(sid, None) is None:
+                raise UPnPError(ERROR_PRECONDITION_FAILED)
+
+    def send_event(self, subscription: Subscription, variables: dict[str, str], delay_sec: float = 0.0) -> None:
+        properties = []
+        for name, value in variables.items():
+            element = ElementTree.Element(name)
+            element.text = value
+            properties.append('<e:property>%s</e:property>' % ElementTree.tostring(element, encoding='unicode'))
+        with self.lock:
+            seq = subscription.seq
+            subscription.seq += 1
+        body = (EVENT_TEMPLATE % ''.join(properties)).encode('utf-8')
+        self.notifications.put((time.monotonic() + delay_sec, subscription, seq, body))
+
+    def notify(self, speaker: FakeSonosSpeaker, service: str, variables: dict[str, str]) -> None:
+        now = time.monotonic()
+        with self.lock:
+            subscriptions = [sub for sub in self.subscriptions.values()
+                             if sub.speaker is speaker and sub.service == service and sub.expires >= now]
+        for subscription in subscriptions:
+            self.send_event(subscription, variables)
+
+    def notify_transport(self, speaker: FakeSonosSpeaker) -> None:
+        self.notify(speaker, 'AVTransport', self.av_transport_event(speaker))
+
+    def notify_topology(self) -> None:
+        with self.lock:
+            self.topology_id += 1
+            speakers = list(self.speakers)
+        state = self.zone_group_state()
+        for speaker in speakers:
+            self.notify(speaker, 'ZoneGroupTopology', {'ZoneGroupState': state})
+
+    def run_notifier(self) -> None:
+        while True:
+            item = self.notifications.get()
+            if item is None:
+                return
+            not_before, subscription, seq, body = item
+            delay = not_before - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            callback = urllib.parse.urlsplit(subscription.callback.strip('<>'))
+            try:
+                connection = http.client.HTTPConnection(callback.hostname, callback.port or 80,
+                                                        timeout=NOTIFY_TIMEOUT_SEC)
+                connection.request('NOTIFY', callback.path or '/', body, {
+                    'Content-Type': 'text/xml; charset="utf-8"',
+                    'NT': 'upnp:event',
+                    'NTS': 'upnp:propchange',
+                    'SID': subscription.sid,
+                    'SEQ': str(seq),
+                })
+                connection.getresponse().read()
+                connection.close()
+            except OSError as e:
+                log.info("Could not deliver event to %s: %s", subscription.callback, e)
+
+    # SOAP actions (see ACTIONS), named <service>_<action>. Each takes the
+    # speaker and the request's arguments, and returns the response's.
+
+    def call(self, speaker: FakeSonosSpeaker, service: str, action: str,
+             args: dict[str, str]) -> list[typing.Tuple[str, str]]:
+        if action not in ACTIONS[service]:
+            raise UPnPError(ERROR_INVALID_ACTION)
+        method = getattr(self, '%s_%s' % (service, action))
+        try:
+            return method(speaker, args)
+        except (KeyError, ValueError):
+            raise UPnPError(ERROR_INVALID_ARGS)
+
+    def AVTransport_Play(self, speaker, args):
+        self.set_transport_state(speaker, 'PLAYING')
+        return []
+
+    def AVTransport_Pause(self, speaker, args):
+        self.set_transport_state(speaker, 'PAUSED_PLAYBACK')
+        return []
+
+    def AVTransport_Stop(self, speaker, args):
+        self.set_transport_state(speaker, 'STOPPED')
+        return []
+
+    def AVTransport_Next(self, speaker, args):
+        with self.lock:
+            speaker.track = min(speaker.track + 1, max(0, len(speaker.queue) - 1))
+        self.notify_transport(speaker)
+        return []
+
+    def AVTransport_Previous(self, speaker, args):
+        with self.lock:
+            speaker.track = max(0, speaker.track - 1)
+        self.notify_transport(speaker)
+        return []
+
+    def AVTransport_Seek(self, speaker, args):
+        if args['Unit'] == 'TRACK_NR':
+            with self.lock:
+                track = int(args['Target']) - 1
+                if not 0 <= track < len(speaker.queue):
+                    raise UPnPError(ERROR_INVALID_ARGS)
+                speaker.track = track
+            self.notify_transport(speaker)
+        return []
+
+    def AVTransport_SetAVTransportURI(self, speaker, args):
+        uri = args['CurrentURI']
+        regrouped = False
+        with self.lock:
+            if uri.startswith('x-rincon:'):
+                # Joining the group of the speaker with that UID.
+                uid = uri[len('x-rincon:'):]
+                coordinator = next((s for s in self.speakers if s.uid == uid), None)
+                if coordinator is None:
+                    raise UPnPError(ERROR_INVALID_ARGS)
+                self.leave_group(speaker)
+                speaker.coordinator = coordinator.coordinator
+                regrouped = True
+            elif speaker.coordinator is not speaker:
+                # Playing something of its own takes a speaker out of its group.
+                self.leave_group(speaker)
+                regrouped = True
+            speaker.av_transport_uri = uri
+        if regrouped:
+            self.notify_topology()
+        self.notify_transport(speaker)
+        return []
+
+    def AVTransport_BecomeCoordinatorOfStandaloneGroup(self, speaker, args):
+        with self.lock:
+            self.leave_group(speaker)
+        self.notify_topology()
+        return [('DelegatedGroupCoordinatorID', ''), ('NewGroupID', '%s:%d' % (speaker.uid, self.topology_id))]
+
+    def leave_group(self, speaker: FakeSonosSpeaker) -> None:
+        """Makes 'speaker' a group of its own. The rest of its group stays together."""
+        if speaker.coordinator is speaker:
+            others = [s for s in self.group_members(speaker) if s is not speaker]
+            for other in others:
+                other.coordinator = others[0]
+        speaker.coordinator = speaker
+
+    def AVTransport_AddURIToQueue(self, speaker, args):
+        uri = args['EnqueuedURI']
+        with self.lock:
+            if uri.startswith(PLAYLIST_URI_PREFIX):
+                titles = list(self.playlists)
+                index = int(uri[len(PLAYLIST_URI_PREFIX):])
+                if not 0 <= index < len(titles):
+                    raise UPnPError(ERROR_NO_SUCH_OBJECT)
+                tracks = [(track, '%s %d' % (titles[index], i + 1))
+                          for i, track in enumerate(self.playlists[titles[index]])]
+            else:
+                tracks = [(uri, didl_title(args.get('EnqueuedURIMetaData', '')))]
+            position = int(args.get('DesiredFirstTrackNumberEnqueued') or 0)
+            if not 0 < position <= len(speaker.queue):
+                position = len(speaker.queue) + 1
+            speaker.queue[position - 1:position - 1] = tracks
+            speaker.queue_update_id += 1
+            response = [
+                ('FirstTrackNumberEnqueued', str(position)),
+                ('NumTracksAdded', str(len(tracks))),
+                ('NewQueueLength', str(len(speaker.queue))),
+                ('NewUpdateID', str(speaker.queue_update_id)),
+            ]
+        self.notify_queue(speaker)
+        return response
+
+    def AVTransport_RemoveAllTracksFromQueue(self, speaker, args):
+        with self.lock:
+            speaker.queue = []
+            speaker.track = 0
+            speaker.queue_update_id += 1
+        self.notify_queue(speaker)
+        return []
+
+    def notify_queue(self, speaker: FakeSonosSpeaker) -> None:
+        self.notify(speaker, 'ContentDirectory', {'ContainerUpdateIDs': 'Q:0,%d' % speaker.queue_update_id})
+        self.notify_transport(speaker)
+
+    def AVTransport_GetTransportInfo(self, speaker, args):
+        with self.lock:
+            state = speaker.coordinator.transport_state
+        return [('CurrentTransportState', state), ('CurrentTransportStatus', 'OK'), ('CurrentSpeed', '1')]
+
+    def AVTransport_GetPositionInfo(self, speaker, args):
+        with self.lock:
+            track_uri = speaker.queue[speaker.track][0] if speaker.track < len(speaker.queue) else ''
+            track = speaker.track + 1 if speaker.queue else 0
+        return [('Track', str(track)), ('TrackDuration', '0:03:00'), ('TrackMetaData', ''),
+                ('TrackURI', track_uri), ('RelTime', '0:00:00'), ('AbsTime', 'NOT_IMPLEMENTED'),
+                ('RelCount', '2147483647'), ('AbsCount', '2147483647')]
+
+    def RenderingControl_GetVolume(self, speaker, args):
+        with self.lock:
+            return [('CurrentVolume', str(speaker.volume))]
+
+    def RenderingControl_SetVolume(self, speaker, args):
+        self.set_volume(speaker, int(args['DesiredVolume']))
+        return []
+
+    def RenderingControl_SetRelativeVolume(self, speaker, args):
+        with self.lock:
+            volume = speaker.volume + int(args['Adjustment'])
+        self.set_volume(speaker, volume)
+        with self.lock:
+            return [('NewVolume', str(speaker.volume))]
+
+    def RenderingControl_GetMute(self, speaker, args):
+        with self.lock:
+            return [('CurrentMute', str(int(speaker.mute)))]
+
+    def RenderingControl_SetMute(self, speaker, args):
+        with self.lock:
+            speaker.mute = args['DesiredMute'] in ('1', 'true')
+        self.notify(speaker, 'RenderingControl', self.rendering_control_event(speaker))
+        return []
+
+    def ContentDirectory_Browse(self, speaker, args):
+        object_id = args['ObjectID']
+        with self.lock:
+            if object_id == 'SQ:':
+                items = [
+                    '<container id="SQ:%d" parentID="SQ:" restricted="true"><dc:title>%s</dc:title>'
+                    '<upnp:class>object.container.playlistContainer</upnp:class>'
+                    '<res protocolInfo="file:*:audio/mpegurl:*">%s%d</res></container>'
+                    % (i, html.escape(title), PLAYLIST_URI_PREFIX, i)
+                    for i, title in enumerate(self.playlists)]
+                update_id = self.saved_queues_update_id
+            elif object_id == 'Q:0':
+                items = [
+                    '<item id="Q:0/%d" parentID="Q:0" restricted="true"><dc:title>%s</dc:title>'
+                    '<upnp:class>object.item.audioItem.musicTrack</upnp:class>'
+                    '<res protocolInfo="x-file-cifs:*:audio/mpeg:*">%s</res></item>'
+                    % (i + 1, html.escape(title), html.escape(uri))
+                    for i, (uri, title) in enumerate(speaker.queue)]
+                update_id = speaker.queue_update_id
+            else:
+                raise UPnPError(ERROR_NO_SUCH_OBJECT)
+        start = int(args.get('StartingIndex') or 0)
+        count = int(args.get('RequestedCount') or 0) or len(items)
+        returned = items[start:start + count]
+        return [('Result', DIDL_TEMPLATE % ''.join(returned)), ('NumberReturned', str(len(returned))),
+                ('TotalMatches', str(len(items))), ('UpdateID', str(update_id))]
+
+    def ZoneGroupTopology_GetZoneGroupState(self, speaker, args):
+        return [('ZoneGroupState', self.zone_group_state())]
+
+    def DeviceProperties_GetHouseholdID(self, speaker, args):
+        return [('CurrentHouseholdID', self.household_id)]
+
+    def DeviceProperties_GetZoneAttributes(self, speaker, args):
+        return [('CurrentZoneName', speaker.name), ('CurrentIcon', 'x-rincon-roomicon:living'),
+                ('CurrentConfiguration', '1'), ('CurrentTargetRoomName', speaker.name)]
+
+class FakeSonosHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Linux UPnP/1.0 Sonos/0.0-00000 (ZPS0)'
+
+    def __init__(self, household: FakeHousehold, speaker: FakeSonosSpeaker, *args):
+        self.household = household
+        self.speaker = speaker
+        super().__init__(*args)
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.speaker.name, format % args)
+
+    def send_body(self, status: int, body: bytes, content_type: str = 'text/xml; charset="utf-8"',
+                  headers: typing.Sequence[typing.Tuple[str, str]] = ()) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.household.delay()
+        if self.path in SCPD_PATHS:
+            self.send_body(200, scpd(SCPD_PATHS[self.path]))
+            return
+        if self.path != '/xml/device_description.xml':
+            self.send_body(404, b'')
+            return
+        serial = '00-0E-58-FA-%02X-%02X:0' % divmod(self.household.speakers.index(self.speaker) + 1, 256)
+        body = DEVICE_DESCRIPTION_TEMPLATE % {
+            'ip': self.speaker.ip, 'uid': self.speaker.uid, 'name': html.escape(self.speaker.name),
+            'serial': serial}
+        self.send_body(200, body.encode('utf-8'))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.household.delay()
+        service = CONTROL_PATHS.get(self.path)
+        if service is None:
+            self.send_body(404, b'')
+            return
+        try:
+            request = ElementTree.fromstring(body).find('{%s}Body' % SOAP_ENVELOPE_NS)
+            element = request[0] if request is not None and len(request) else None
+        except ElementTree.ParseError:
+            element = None
+        if element is None:
+            self.send_soap_fault(ERROR_INVALID_ARGS)
+            return
+        action = element.tag.split('}')[-1]
+        args = {child.tag.split('}')[-1]: child.text or '' for child in element}
+        try:
+            response = self.household.call(self.speaker, service, action, args)
+        except UPnPError as e:
+            log.debug("%s %s.%s failed: %d", self.speaker.name, service, action, e.code)
+            self.send_soap_fault(e.code)
+            return
+        arguments = []
+        for name, value in response:
+            element = ElementTree.Element(name)
+            element.text = value
+            arguments.append(ElementTree.tostring(element, encoding='unicode'))
+        self.send_body(200, (SOAP_RESPONSE_TEMPLATE % '<u:%sResponse xmlns:u="urn:schemas-upnp-org:service:%s:1">%s'
+                             '</u:%sResponse>' % (action, service, ''.join(arguments), action)).encode('utf-8'))
+
+    def send_soap_fault(self, code: int) -> None:
+        self.send_body(500, (SOAP_RESPONSE_TEMPLATE % (SOAP_FAULT_TEMPLATE % code)).encode('utf-8'))
+
+    def do_SUBSCRIBE(self):
+        self.household.delay()
+        service = EVENT_PATHS.get(self.path)
+        if service is None:
+            self.send_body(404, b'')
+            return
+        timeout_sec = parse_timeout(self.headers.get('TIMEOUT'))
+        sid = self.headers.get('SID')
+        try:
+            if sid:
+                subscription = self.household.renew(sid, timeout_sec)
+            elif self.headers.get('NT') == 'upnp:event' and self.headers.get('CALLBACK'):
+                subscription = self.household.subscribe(
+                    self.speaker, service, self.headers['CALLBACK'], timeout_sec)
+            else:
+                raise UPnPError(ERROR_PRECONDITION_FAILED)
+        except UPnPError as e:
+            self.send_body(e.code, b'')
+            return
+        self.send_body(200, b'', headers=[('SID', subscription.sid), ('TIMEOUT', 'Second-%d' % timeout_sec)])
+        if not sid:
+            self.household.send_event(subscription, self.household.initial_event(subscription),
+                                      INITIAL_EVENT_DELAY_SEC)
+
+    def do_UNSUBSCRIBE(self):
+        self.household.delay()
+        try:
+            self.household.unsubscribe(self.headers.get('SID', ''))
+        except UPnPError as e:
+            self.send_body(e.code, b'')
+            return
+        self.send_body(200, b'')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run a fake Sonos household on 127.0.0.x.')
+    parser.add_argument('--speaker', action='append', help='speaker name (repeatable, default: %s)'
+                        % ', '.join(DEFAULT_SPEAKERS))
+    parser.add_argument('--playlist', action='append', help='Sonos playlist title (repeatable, default: %s)'
+                        % ', '.join(DEFAULT_PLAYLISTS))
+    parser.add_argument('--port', type=int, default=sonobo.SONOS_PORT, help='port every speaker listens on')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency of every request')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='extra random latency, up to this much')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--write-cache', metavar='FILENAME', help='write a sonobo speaker cache for the household')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="[%(levelname).1s%(asctime)s.%(msecs)03d] %(message)s",
+                        datefmt="%Y%m%d %H:%M:%S", level=logging.INFO)
+
+    household = FakeHousehold(args.latency_ms / 1000, args.jitter_ms / 1000, args.port, args.seed)
+    for name in args.speaker or DEFAULT_SPEAKERS:
+        household.add_speaker(name)
+    for title in args.playlist or DEFAULT_PLAYLISTS:
+        household.add_playlist(title)
+    household.start()
+    for speaker in household.speakers:
+        log.info("%s at http://%s:%d", speaker.name, speaker.ip, speaker.port)
+    if args.write_cache:
+        with open(args.write_cache, 'w') as outfile:
+            json.dump(household.speaker_cache(), outfile, indent=2)
+        log.info("Wrote speaker cache to %s", args.write_cache)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        household.stop()
+        log.info("Served %d requests", household.requests)
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,27 @@
 # - try-catch / error recovery
 # - Support multi-room joining
 
+import atexit
+import bisect
 import cgi
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
 import datetime
+import functools
+import glob
+import gzip
+import hashlib
 import http.server
+import queue
 import logging
 import logging.handlers
 import json
+import math
 import os
-import shutil
+import select
+import signal
 import socket
 import struct
 import sys
@@ -23,14 +36,69 @@ import typing
 import typing_extensions
 
 import soco # type: ignore
+import soco.data_structures # type: ignore
+import soco.exceptions # type: ignore
 import soco.plugins.sharelink # type: ignore
 
 log = logging.getLogger("sonobo")
 
 MAX_VOLUME = 19
+VOLUME_STEP = 2
+# Volume presses arriving within this window of the first one are merged into
+# a single write to the speaker.
+VOLUME_DEBOUNCE_SEC = 0.15
+# How long we trust our cached copy of the speaker's volume before reading it
+# again.
+VOLUME_REFRESH_SEC = 60.0
+
+# Transport state polled from the speaker is trusted for this long when we are
+# not receiving UPnP events for it.
+TRANSPORT_STATE_TTL_SEC = 5.0
+EVENT_SUBSCRIPTION_TIMEOUT_SEC = 600
+# How often we try to get events flowing again after a subscription lapsed.
+EVENT_RESUBSCRIBE_SEC = 60.0
+# Without ZoneGroupTopology events, the grouping we resolved is trusted for
+# this long before we look again.
+TOPOLOGY_TTL_SEC = 10.0
+
+# Grouping commands talk to all speakers at once, on at most this many threads,
+# giving each speaker this long to answer.
+GROUPING_POOL_SIZE = 8
+GROUPING_TIMEOUT_SEC = 10.0
+
+# The Sonos playlist catalog is refreshed in the background this often, or
+# sooner when the speaker tells us the saved playlists changed.
+PLAYLIST_CATALOG_TTL_SEC = 600.0
+# Playing a playlist the catalog doesn't know refreshes it on the spot, but
+# no more often than this.
+PLAYLIST_MISS_REFRESH_SEC = 5.0
 FAST_REPEAT_THRESHOLD_SEC = 4.0
 
+# Keypresses are turned into Actions on the input thread and executed against
+# the speaker on a worker thread, so a slow speaker never stalls the keyboard.
+ACTION_QUEUE_SIZE = 16
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+# Upper bounds of the action latency histogram buckets.
+LATENCY_BUCKETS_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
 EVENT_DEVICE_PATH = '/dev/input/by-id/usb-Telink_Wireless_Receiver-if01-event-kbd'
+# Which keyboards to read, see JsonInputDeviceT. Without it, just EVENT_DEVICE_PATH.
+INPUT_DEVICES_FILENAME = 'input-devices.json'
+# Watched for keyboards coming and going.
+INPUT_DEVICE_DIR = '/dev/input'
+# How often to look for keyboards if inotify is unavailable.
+INPUT_RESCAN_SEC = 5.0
+
+# Speakers found by the last discovery, so we can start without waiting for a
+# new one.
+SPEAKER_CACHE_FILENAME = 'speakers.json'
+LIVING_ROOM = 'Living Room'
+SONOS_PORT = 1400
+
+# 'port' is only there for speakers that aren't on SONOS_PORT, e.g. fake_sonos.py.
+JsonSpeakerT = typing_extensions.TypedDict('JsonSpeakerT', {
+    'name': str, 'ip': str, 'uid': str, 'household': str, 'port': typing_extensions.NotRequired[int]})
 
 EV_KEY = 0x01
 KEY_UP = 103
@@ -91,49 +159,1249 @@ KEY_STRING_TO_CODE_MAP = {
     'M': 50,
 }
 
+# https://www.kernel.org/doc/Documentation/input/input.txt
+#
+# Section5: Event interfaces
+#
+# You can use blocking and nonblocking reads, also select() on the
+# /dev/input/eventX devices, and you'll always get a whole number of input
+# events on a read. Their layout is:
+#
+# struct input_event {
+#	struct timeval time;
+#	unsigned short type;
+#	unsigned short code;
+#	unsigned int value;
+# };
+#
+# 'struct timeval' is from <sys/time.h> and is:
+# struct timeval {
+#	long	tv_sec;		/* seconds */
+#	long	tv_usec;	/* and microseconds */
+# };
+INPUT_EVENT_STRUCT = struct.Struct('llHHi')  # long, long, short, short, int
+
+# How many input_events we pull out of the kernel with a single read. One
+# physical keypress is usually three events (EV_MSC, EV_KEY, EV_SYN).
+INPUT_EVENT_BATCH_SIZE = 64
+# Input capture files are rotated at this size (about 350k events), keeping this many old ones.
+INPUT_CAPTURE_MAX_BYTES = 8 * 1024 * 1024
+INPUT_CAPTURE_BACKUPS = 3
+
+# (type, code, value, timestamp)
+InputEventT = typing.Tuple[int, int, int, float]
+
+# Keys pressed while we are still starting up are kept (up to this many
+# events) and replayed once the speakers are ready, unless they are older
+# than STARTUP_EVENT_MAX_AGE_SEC by then.
+STARTUP_BUFFER_SIZE = 64
+STARTUP_EVENT_MAX_AGE_SEC = 15.0
+
+# The services soco.plugins.sharelink.ShareLinkPlugin knows about, in the
+# order it tries them.
+SHARE_LINK_SERVICES = [
+    soco.plugins.sharelink.SpotifyShare(),
+    soco.plugins.sharelink.SpotifyUSShare(),
+    soco.plugins.sharelink.TIDALShare(),
+    soco.plugins.sharelink.DeezerShare(),
+    soco.plugins.sharelink.AppleMusicShare(),
+]
+
+# Same as ShareLinkPlugin.add_share_link_to_queue()
+SHARE_LINK_METADATA_TEMPLATE = (
+    '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements'
+    '/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata'
+    '-1-0/upnp/" xmlns:r="urn:schemas-rinconnetworks-'
+    'com:metadata-1-0/" xmlns="urn:schemas-upnp-org:m'
+    'etadata-1-0/DIDL-Lite/"><item id="{item_id}" par'
+    'entID="-1" restricted="true"><dc:title>{title}</'
+    "dc:title><upnp:class>{item_class}</upnp:class><d"
+    'esc id="cdudn" nameSpace="urn:schemas-rinconnetw'
+    'orks-com:metadata-1-0/">SA_RINCON{sn}_X_#Svc{sn}'
+    "-0-Token</desc></item></DIDL-Lite>"
+)
+
 JsonSongT = typing_extensions.TypedDict('JsonSongT', {'debugName': str, 'key': str, 'payload': str, 'kind': str})
+# 'match' is a device path or a glob, e.g. '/dev/input/by-id/*-event-kbd'. The
+# keymap makes the device's keys act as others, e.g. {"1": "A"}.
+JsonInputDeviceT = typing_extensions.TypedDict('JsonInputDeviceT', {
+    'match': str, 'name': typing_extensions.NotRequired[str],
+    'keymap': typing_extensions.NotRequired[dict[str, str]]})
 
 class Clock:
     def now_ts(self):
         return time.time_ns() / 1000000
 
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def wall_time(self) -> float:
+        # Same clock as the input_event timestamps.
+        return time.time()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+def decode_input_events(data: memoryview) -> list[InputEventT]:
+    # 'time' is the timestamp, it returns the time at which the event happened.
+    # Type is for example EV_REL for relative moment, EV_KEY for a keypress or
+    # release. More types are defined in include/uapi/linux/input-event-codes.h.
+    #
+    # 'code' is event code, for example REL_X or KEY_BACKSPACE, again a complete
+    # list is in include/uapi/linux/input-event-codes.h.
+    #
+    # 'value' is the value the event carries. Either a relative change for
+    # EV_REL, absolute new value for EV_ABS (joysticks ...), or 0 for EV_KEY for
+    # release, 1 for keypress and 2 for autorepeat.
+    #
+    # https://github.com/torvalds/linux/blob/master/include/uapi/linux/input-event-codes
+    events = []
+    for tv_sec, tv_usec, typet, code, value in INPUT_EVENT_STRUCT.iter_unpack(data):
+        events.append((typet, code, value, (tv_sec * 1000000 + tv_usec)/1000000))
+    return events
+
+class EventRecorder:
+    """Appends raw input_events, exactly as read from the device, to a capture file.
+
+    A capture is just the kernel's input_event structs back to back (so it's
+    only readable on the same architecture), which decode_input_events reads
+    as-is. Once the file would pass max_bytes it is rotated the way
+    RotatingFileHandler does it: 'path' becomes 'path.1', 'path.1' becomes
+    'path.2' and so on, up to 'path.<backups>'.
+    """
+
+    def __init__(self, path: str, max_bytes: int = INPUT_CAPTURE_MAX_BYTES,
+                 backups: int = INPUT_CAPTURE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file: typing.Optional[typing.BinaryIO] = open(path, 'ab')
+        self.size = self.file.tell()
+
+    def write(self, data: memoryview) -> None:
+        """Records 'data'. After a failed write, logs it and records nothing more."""
+        if self.file is None:
+            return
+        try:
+            if self.size > 0 and self.size + len(data) > self.max_bytes:
+                self.rotate()
+            self.file.write(data)
+            # One write per batch, so a crash loses nothing that was read.
+            self.file.flush()
+            self.size += len(data)
+        except OSError as e:
+            # Recording is only for debugging; never let it get in the way of
+            # input. This also stops it for every other device sharing us.
+            log.warning("Stopped recording input to %s: %s", self.path, e)
+            try:
+                self.close()
+            except OSError:
+                pass
+
+    def rotate(self) -> None:
+        self.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.replace('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def close(self) -> None:
+        if self.file is not None:
+            file, self.file = self.file, None
+            file.close()
+
+def capture_files(path: str, backups: int = INPUT_CAPTURE_BACKUPS) -> list[str]:
+    """An EventRecorder's capture files that exist, oldest first."""
+    candidates = ['%s.%d' % (path, i) for i in range(backups, 0, -1)] + [path]
+    return [candidate for candidate in candidates if os.path.exists(candidate)]
+
+def read_capture(paths: list[str]) -> list[InputEventT]:
+    events = []
+    for path in paths:
+        with open(path, 'rb') as infile:
+            data = infile.read()
+        # Ignore a torn event at the end, e.g. if we crashed mid-write.
+        events.extend(decode_input_events(memoryview(data)[:len(data) - len(data) % INPUT_EVENT_STRUCT.size]))
+    return events
+
+class EventReader:
+    """Reads input_events from an evdev device in batches.
+
+    The device is opened non-blocking and waited on with epoll (its own, or an
+    InputMultiplexer's), so that every event the kernel has queued up is
+    pulled out with a single read into a reusable buffer, rather than paying
+    a syscall per event. If given a recorder, each batch is also appended to
+    it as raw bytes.
+    """
+
+    def __init__(self, path: str, batch_size: int = INPUT_EVENT_BATCH_SIZE,
+                 recorder: typing.Optional[EventRecorder] = None):
+        self.path = path
+        self.recorder = recorder
+        self.buffer = bytearray(INPUT_EVENT_STRUCT.size * batch_size)
+        self.view = memoryview(self.buffer)
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.poller: typing.Optional[select.epoll] = None
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read_events(self, timeout: float = -1) -> list[InputEventT]:
+        """Waits up to 'timeout' seconds (forever if negative) for events.
+
+        Returns all of the events that were pending, or an empty list if
+        nothing arrived in time.
+        """
+        if self.poller is None:
+            self.poller = select.epoll()
+            self.poller.register(self.fd, select.EPOLLIN)
+        if not self.poller.poll(timeout):
+            return []
+        return self.read_available()
+
+    def read_available(self) -> list[InputEventT]:
+        """Returns the events that are pending, without waiting for any."""
+        try:
+            length = os.readv(self.fd, [self.buffer])
+        except BlockingIOError:
+            return []
+        if length == 0:
+            raise EOFError('"%s" was closed' % self.path)
+        # The kernel only hands out whole events, but be defensive anyway.
+        length -= length % INPUT_EVENT_STRUCT.size
+        if self.recorder is not None:
+            self.recorder.write(self.view[:length])
+        return decode_input_events(self.view[:length])
+
+    def close(self) -> None:
+        if self.poller is not None:
+            self.poller.close()
+        os.close(self.fd)
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def __enter__(self) -> 'EventReader':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+class InputDevice:
+    """One keyboard as far as dispatch is concerned: its keymap, modifier state
+    and last keypress (for fast-repeat detection)."""
+
+    def __init__(self, name: str, keymap: typing.Optional[dict[int, int]] = None):
+        self.name = name
+        self.keymap = keymap or {}
+        self.shift_pressed = False
+        self.last_key: typing.Optional[int] = None
+        self.last_key_timestamp: typing.Optional[float] = None # seconds
+
+    def update_modifiers(self, typet: int, code: int, value: int) -> bool:
+        """Tracks shift key state from an event. Returns whether it was a modifier event."""
+        if typet == EV_KEY and self.keymap.get(code, code) in (KEY_LEFTSHIFT, KEY_RIGHTSHIFT):
+            self.shift_pressed = (value != 0)  # 1=press, 2=repeat, 0=release
+            return True
+        return False
+
+    def __repr__(self) -> str:
+        return '<InputDevice %s>' % self.name
+
+DeviceInputEventT = typing.Tuple[InputDevice, InputEventT]
+
+def keymap_json_to_map(keymap: dict[str, str]) -> dict[int, int]:
+    """Key codes for a device's keymap. Keys are named as in the songmap, or by number.
+
+    Raises ValueError for keys we don't know.
+    """
+    def key_code(key: str) -> int:
+        if key in KEY_STRING_TO_CODE_MAP:
+            return KEY_STRING_TO_CODE_MAP[key]
+        if key.isdigit():
+            return int(key)
+        raise ValueError('Unknown key "%s" in keymap' % key)
+    return {key_code(key): key_code(target) for key, target in keymap.items()}
+
+def load_input_devices(filename: str) -> list[JsonInputDeviceT]:
+    """The keyboards configured in 'filename', or just EVENT_DEVICE_PATH if there's no such file."""
+    try:
+        with open(filename) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return [{'match': EVENT_DEVICE_PATH, 'name': 'keyboard'}]
+
+class InputMultiplexer:
+    """Reads input_events from every configured keyboard through one epoll set.
+
+    Devices are matched by path or glob, opened as they appear and dropped
+    as they go: INPUT_DEVICE_DIR and the directories of the patterns are
+    watched with inotify and rescanned whenever something in them changes
+    (or every INPUT_RESCAN_SEC without inotify). Each open device has an
+    InputDevice of its own, which goes with its events to Sonobo.dispatch.
+    """
+
+    def __init__(self, configs: list[JsonInputDeviceT], watch_dir: str = INPUT_DEVICE_DIR,
+                 recorder: typing.Optional[EventRecorder] = None, batch_size: int = INPUT_EVENT_BATCH_SIZE):
+        self.configs = configs
+        # Checked up front, so a bad keymap fails at startup rather than at hotplug.
+        self.keymaps = [keymap_json_to_map(config.get('keymap', {})) for config in configs]
+        self.recorder = recorder
+        self.batch_size = batch_size
+        self.poller = select.epoll()
+        self.readers: dict[int, EventReader] = {}
+        self.devices: dict[int, InputDevice] = {}
+        # Real path (the by-id links point at /dev/input/eventN) -> fd
+        self.fds: dict[str, int] = {}
+        self.inotify_fd = open_inotify(watch_dir, INPUT_INOTIFY_MASK)
+        if self.inotify_fd is not None:
+            self.poller.register(self.inotify_fd, select.EPOLLIN)
+        self.last_scan = 0.0
+        self.scan()
+
+    def scan(self) -> None:
+        """Opens devices that newly match, and drops those that no longer exist."""
+        self.last_scan = time.monotonic()
+        if self.inotify_fd is not None:
+            # Again every time, since e.g. /dev/input/by-id goes away with the last USB device.
+            for dirname in {os.path.dirname(config['match']) for config in self.configs}:
+                if os.path.isdir(dirname):
+                    add_inotify_watch(self.inotify_fd, dirname, INPUT_INOTIFY_MASK)
+        wanted: dict[str, typing.Tuple[str, int]] = {}
+        for i, config in enumerate(self.configs):
+            for path in sorted(glob.glob(config['match'])):
+                wanted.setdefault(os.path.realpath(path), (path, i))
+        for realpath, fd in list(self.fds.items()):
+            if realpath not in wanted:
+                self.drop(fd, 'removed')
+        for realpath, (path, i) in wanted.items():
+            if realpath not in self.fds:
+                self.open(realpath, path, i)
+
+    def open(self, realpath: str, path: str, i: int) -> None:
+        try:
+            reader = EventReader(path, self.batch_size, self.recorder)
+        except OSError as e:
+            # e.g. udev hasn't given us permission yet; we'll hear when it does.
+            log.info('Cannot open "%s" yet: %s', path, e)
+            return
+        device = InputDevice(self.configs[i].get('name', os.path.basename(path)), self.keymaps[i])
+        self.readers[reader.fd] = reader
+        self.devices[reader.fd] = device
+        self.fds[realpath] = reader.fd
+        self.poller.register(reader.fd, select.EPOLLIN)
+        log.info('Reading input from "%s" (%s)', path, device.name)
+
+    def drop(self, fd: int, reason: typing.Any) -> None:
+        reader = self.readers.pop(fd)
+        device = self.devices.pop(fd)
+        self.fds = {realpath: other for realpath, other in self.fds.items() if other != fd}
+        self.poller.unregister(fd)
+        # The recorder is shared by all devices, and outlives this one.
+        reader.recorder = None
+        reader.close()
+        log.info('Stopped reading "%s" (%s): %s', reader.path, device.name, reason)
+
+    def read_events(self, timeout: float = -1) -> list[DeviceInputEventT]:
+        """Like EventReader.read_events, for all devices at once."""
+        if self.inotify_fd is None:
+            if time.monotonic() - self.last_scan >= INPUT_RESCAN_SEC:
+                self.scan()
+            timeout = INPUT_RESCAN_SEC if timeout < 0 else min(timeout, INPUT_RESCAN_SEC)
+        events: list[DeviceInputEventT] = []
+        rescan = False
+        for fd, _ in self.poller.poll(timeout):
+            if fd == self.inotify_fd:
+                self.drain_inotify()
+                rescan = True
+                continue
+            reader = self.readers.get(fd)
+            if reader is None:
+                continue
+            try:
+                batch = reader.read_available()
+            except (OSError, EOFError) as e:
+                # Unplugged: ENODEV, or EOF for a pipe.
+                self.drop(fd, e)
+                continue
+            device = self.devices[fd]
+            events.extend((device, event) for event in batch)
+        if rescan:
+            self.scan()
+        return events
+
+    def drain_inotify(self) -> None:
+        # Which names changed doesn't matter, scan() looks at everything.
+        while True:
+            try:
+                if not os.read(typing.cast(int, self.inotify_fd), 4096):
+                    return
+            except BlockingIOError:
+                return
+
+    def close(self) -> None:
+        for fd in list(self.readers):
+            self.drop(fd, 'closing')
+        self.poller.close()
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def __enter__(self) -> 'InputMultiplexer':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+class EnqueueDescriptor:
+    """Everything needed for an AddURIToQueue request, worked out ahead of time."""
+    uri: str
+    metadata: str
+    item_type: str
+
+    def __init__(self, uri: str, metadata: str, item_type: str):
+        self.uri = uri
+        self.metadata = metadata
+        self.item_type = item_type
+
+    def __repr__(self) -> str:
+        return '<EnqueueDescriptor %s uri=%s>' % (self.item_type, self.uri)
+
+def resolve_share_link(share_link: str) -> list[EnqueueDescriptor]:
+    """Turns a share link into AddURIToQueue requests, one per matching service.
+
+    A Spotify link matches both the Spotify and Spotify US services, so like
+    ShareLinkPlugin we keep both and try them in order when enqueuing.
+    """
+    descriptors = []
+    for service in SHARE_LINK_SERVICES:
+        if service.canonical_uri(share_link):
+            share_type, encoded_uri = service.extract(share_link)
+            magic = service.magic()[share_type]
+            descriptors.append(EnqueueDescriptor(
+                magic['prefix'] + encoded_uri,
+                SHARE_LINK_METADATA_TEMPLATE.format(
+                    item_id=magic['key'] + encoded_uri,
+                    title='',
+                    item_class=magic['class'],
+                    sn=service.service_number()),
+                share_type))
+    if not descriptors:
+        raise ValueError('Unsupported share link "%s"' % share_link)
+    return descriptors
+
+class StartupInputBuffer:
+    """Collects input events on a thread of its own while Sonobo starts up.
+
+    When it fills up the oldest events are dropped, but any shift presses and
+    releases among them still take effect on their device, so the keys kept
+    after them are read the way they were typed.
+    """
+
+    def __init__(self, reader: InputMultiplexer, maxlen: int = STARTUP_BUFFER_SIZE):
+        self.reader = reader
+        self.maxlen = maxlen
+        self.events: collections.deque[DeviceInputEventT] = collections.deque()
+        self.received = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sonobo-startup-input')
+        self.thread.daemon = True
+
+    def start(self) -> 'StartupInputBuffer':
+        self.thread.start()
+        return self
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                for event in self.reader.read_events(0.1):
+                    if len(self.events) >= self.maxlen:
+                        # Nothing is dispatched until we finish, so this can't race.
+                        device, (typet, code, value, _) = self.events.popleft()
+                        device.update_modifiers(typet, code, value)
+                    self.events.append(event)
+                    self.received += 1
+            except Exception as e:
+                log.exception(e)
+                return
+
+    def finish(self) -> list[DeviceInputEventT]:
+        """Stops collecting and hands back what was collected, oldest first."""
+        self.stopping.set()
+        self.thread.join()
+        if self.received > len(self.events):
+            log.info("Startup input buffer overflowed, lost %d events", self.received - len(self.events))
+        return list(self.events)
+
 class SongInfo:
     url: str
     kind: str
+    # For SPOTIFY songs, filled in when the songmap is loaded.
+    enqueue: list[EnqueueDescriptor]
 
     def __init__(self, payload: str, kind: str):
         self.payload = payload
         self.kind = kind
+        self.enqueue = []
 
     def __repr__(self) -> str:
         return '<SongInfo kind=%s payload=%s>' % (self.kind, self.payload)
 
+    def same_item(self, other: typing.Optional['SongInfo']) -> bool:
+        return other is not None and self.kind == other.kind and self.payload == other.payload
+
+ACTION_PLAY_PAUSE = 'PLAY_PAUSE'
+ACTION_PAUSE = 'PAUSE'
+ACTION_VOLUME = 'VOLUME'
+ACTION_NEXT = 'NEXT'
+ACTION_PREVIOUS = 'PREVIOUS'
+ACTION_DUMP_PLAYLISTS = 'DUMP_PLAYLISTS'
+ACTION_TOGGLE_MOVE = 'TOGGLE_MOVE'
+ACTION_PARTY_MODE = 'PARTY_MODE'
+ACTION_UNGROUP_ALL = 'UNGROUP_ALL'
+ACTION_SONG = 'SONG'
+
+class VolumeModel:
+    """Our local idea of the coordinator's volume.
+
+    Volume key presses are recorded here on the input thread without touching
+    the network. The worker then flushes a whole burst of presses with a
+    single set_relative_volume call, applying MAX_VOLUME and the shift
+    override to the cached volume rather than reading it from the speaker on
+    every press. The cache is only trusted while events_flowing() says
+    RenderingControl events keep it current; otherwise each burst reads the
+    volume first, so changes made from the Sonos app can't slip past the cap.
+    """
+    volume: typing.Optional[int]
+
+    def __init__(self, clock: Clock, refresh_sec: float = VOLUME_REFRESH_SEC):
+        self.clock = clock
+        self.refresh_sec = refresh_sec
+        self.lock = threading.Lock()
+        self.volume = None
+        self.refreshed_at = 0.0
+        # (direction, override) for each press not yet written to the speaker
+        self.presses: list[typing.Tuple[int, bool]] = []
+        self.first_press_at: typing.Optional[float] = None
+        self.events_flowing: typing.Callable[[], bool] = lambda: False
+
+    def press(self, direction: int, override: bool) -> bool:
+        """Records a press. Returns True if the caller needs to schedule a flush."""
+        with self.lock:
+            self.presses.append((direction, override))
+            if self.first_press_at is not None:
+                return False
+            self.first_press_at = self.clock.monotonic()
+            return True
+
+    def observe(self, volume: int) -> None:
+        """Updates the cached volume with a value reported by the speaker."""
+        with self.lock:
+            self.volume = volume
+            self.refreshed_at = self.clock.monotonic()
+
+    def is_stale(self) -> bool:
+        if not self.events_flowing():
+            return True
+        with self.lock:
+            return (self.volume is None or
+                    self.clock.monotonic() - self.refreshed_at > self.refresh_sec)
+
+    def wait_for_burst(self, debounce_sec: float = VOLUME_DEBOUNCE_SEC) -> None:
+        with self.lock:
+            if self.first_press_at is None:
+                return
+            remaining = self.first_press_at + debounce_sec - self.clock.monotonic()
+        if remaining > 0:
+            self.clock.sleep(remaining)
+
+    def discard(self) -> None:
+        """Forgets the presses of a burst that won't be flushed, e.g. its action was dropped."""
+        with self.lock:
+            self.presses = []
+            self.first_press_at = None
+
+    def flush(self, coordinator) -> None:
+        # Take the burst before touching the network, so that whatever goes
+        # wrong below, the next press starts a new one.
+        with self.lock:
+            presses = self.presses
+            self.presses = []
+            self.first_press_at = None
+
+        if self.is_stale():
+            self.observe(coordinator.volume)
+        with self.lock:
+            current_vol = typing.cast(int, self.volume)
+
+        target = current_vol
+        for direction, override in presses:
+            if direction > 0:
+                if override:
+                    # Shift+Up: volume up with no limit
+                    log.info("Volume up (no limit) (%d + %d)", target, VOLUME_STEP)
+                    target += VOLUME_STEP
+                elif target >= MAX_VOLUME:
+                    log.info("Volume-up capped at %d", target)
+                else:
+                    delta = min(VOLUME_STEP, MAX_VOLUME - target)
+                    log.info("Volume up (%d + %d)", target, delta)
+                    target += delta
+            else:
+                if target <= 0:
+                    log.info("Volume-down capped at 0")
+                else:
+                    delta = min(VOLUME_STEP, target)
+                    log.info("Volume down (%d - %d)", target, delta)
+                    target -= delta
+
+        if target != current_vol:
+            try:
+                new_vol = coordinator.set_relative_volume(target - current_vol)
+            except Exception:
+                # We no longer know where the speaker ended up.
+                with self.lock:
+                    self.volume = None
+                raise
+            self.observe(new_vol if new_vol is not None else target)
+
+class Topology:
+    """Which speaker coordinates the group each of our speakers is in.
+
+    Resolved for all speakers at once on first use and then kept until it is
+    invalidated, either by a ZoneGroupTopology event or by one of our own
+    grouping actions. While events_flowing() says we might be missing those
+    events, it is only kept for ttl_sec.
+    """
+
+    def __init__(self, speaker, all_speakers, clock: Clock, ttl_sec: float = TOPOLOGY_TTL_SEC):
+        self.speaker = speaker
+        self.all_speakers = all_speakers
+        self.clock = clock
+        self.ttl_sec = ttl_sec
+        self.lock = threading.Lock()
+        self.coordinators: typing.Optional[dict[typing.Any, typing.Any]] = None
+        self.resolved_at = 0.0
+        self.names: dict[str, typing.Any] = {}
+        # Bumped by invalidate(), so a resolve racing with it is not kept.
+        self.generation = 0
+        self.events_flowing: typing.Callable[[], bool] = lambda: False
+
+    def resolve(self) -> dict[typing.Any, typing.Any]:
+        events_flowing = self.events_flowing()
+        with self.lock:
+            if self.coordinators is not None and (
+                    events_flowing or self.clock.monotonic() - self.resolved_at <= self.ttl_sec):
+                return self.coordinators
+            generation = self.generation
+            others = [s for s in self.all_speakers if s is not self.speaker]
+
+        # Nothing works without our own coordinator, so any error here is the
+        # caller's to handle.
+        coordinator = self.group_coordinator(self.speaker)
+        if coordinator is None:
+            # e.g. mid-regroup; don't keep this around.
+            raise soco.exceptions.SoCoException('%s is not in any group' % self.speaker)
+        coordinators = {self.speaker: coordinator}
+        names = {self.speaker.player_name: self.speaker}
+        for speaker in others:
+            try:
+                coordinators[speaker] = self.group_coordinator(speaker)
+                names[speaker.player_name] = speaker
+            except Exception as e:
+                # Only grouping actions involving this speaker suffer; it is
+                # tried again once the topology is next invalidated.
+                log.info("Could not resolve the group of %s: %s", speaker, e)
+                coordinators[speaker] = None
+        log.debug("Resolved topology: %s", coordinators)
+
+        with self.lock:
+            if generation == self.generation:
+                self.coordinators = coordinators
+                self.resolved_at = self.clock.monotonic()
+                self.names = names
+        return coordinators
+
+    @staticmethod
+    def group_coordinator(speaker):
+        # soco answers player_name from the same zone group state as 'group'.
+        group = speaker.group
+        return group.coordinator if group is not None else None
+
+    def speaker_named(self, name: str):
+        self.resolve()
+        with self.lock:
+            return self.names.get(name)
+
+    def name_of(self, speaker) -> str:
+        self.resolve()
+        with self.lock:
+            for name, named in self.names.items():
+                if named is speaker:
+                    return name
+        return repr(speaker)
+
+    def coordinator(self):
+        return self.resolve()[self.speaker]
+
+    def coordinator_of(self, speaker):
+        coordinators = self.resolve()
+        if speaker not in coordinators:
+            return speaker.group.coordinator
+        return coordinators[speaker]
+
+    def is_grouped(self, speaker) -> bool:
+        """True if 'speaker' shares its group with any of our other speakers."""
+        coordinators = self.resolve()
+        coordinator = coordinators.get(speaker)
+        if coordinator is not speaker:
+            return True
+        return any(c is speaker for other, c in coordinators.items() if other is not speaker)
+
+    def set_speakers(self, all_speakers) -> None:
+        with self.lock:
+            self.all_speakers = all_speakers
+        self.invalidate()
+
+    def invalidate(self, *args) -> None:
+        with self.lock:
+            self.generation += 1
+            self.coordinators = None
+
+def playlist_enqueue_descriptor(playlist) -> EnqueueDescriptor:
+    # Same request soco's add_to_queue() would send for it.
+    return EnqueueDescriptor(
+        playlist.resources[0].uri, soco.data_structures.to_didl_string(playlist), 'playlist')
+
+class PlaylistCatalog:
+    """Index of the household's Sonos playlists by title.
+
+    Built in the background at startup and refreshed every ttl_sec, or as soon
+    as a ContentDirectory event says the saved playlists changed, so playing
+    a SONOS_PLAYLIST_NAME entry doesn't have to fetch and scan the whole list.
+    """
+    playlists: typing.Optional[dict[str, EnqueueDescriptor]]
+
+    def __init__(self, clock: Clock, ttl_sec: float = PLAYLIST_CATALOG_TTL_SEC):
+        self.clock = clock
+        self.ttl_sec = ttl_sec
+        self.lock = threading.Lock()
+        self.playlists = None
+        self.last_refresh_at: typing.Optional[float] = None
+        self.refresh_wanted = threading.Event()
+        # Called once the catalog is first loaded.
+        self.on_first_load: typing.Optional[typing.Callable[[], None]] = None
+
+    def refresh(self, coordinator) -> None:
+        with self.lock:
+            self.last_refresh_at = self.clock.monotonic()
+        playlists = {}
+        for playlist in coordinator.get_sonos_playlists(complete_result=True):
+            playlists[playlist.title] = playlist_enqueue_descriptor(playlist)
+        with self.lock:
+            first_load = self.playlists is None
+            self.playlists = playlists
+        log.info("Playlist catalog has %d Sonos playlists", len(playlists))
+        if first_load and self.on_first_load is not None:
+            self.on_first_load()
+
+    def refresh_unless_recent(self, coordinator, min_interval_sec: float = PLAYLIST_MISS_REFRESH_SEC) -> bool:
+        """Refreshes, unless we already tried within min_interval_sec. Returns whether it did."""
+        with self.lock:
+            if (self.last_refresh_at is not None
+                    and self.clock.monotonic() - self.last_refresh_at < min_interval_sec):
+                return False
+        self.refresh(coordinator)
+        return True
+
+    def get(self, title: str) -> typing.Optional[EnqueueDescriptor]:
+        with self.lock:
+            if self.playlists is None:
+                return None
+            return self.playlists.get(title)
+
+    def missing(self, titles: typing.Iterable[str]) -> list[str]:
+        """Which of 'titles' are not Sonos playlists (as far as we know yet)."""
+        with self.lock:
+            if self.playlists is None:
+                return []
+            return [title for title in titles if title not in self.playlists]
+
+    def request_refresh(self, *args) -> None:
+        self.refresh_wanted.set()
+
+    def start(self, get_coordinator: typing.Callable[[], typing.Any]) -> threading.Thread:
+        self.refresh_wanted.set()
+        thread = threading.Thread(target=self.run, args=(get_coordinator,), name='sonobo-playlists')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self, get_coordinator: typing.Callable[[], typing.Any]) -> None:
+        while True:
+            self.refresh_wanted.wait(self.ttl_sec)
+            self.refresh_wanted.clear()
+            try:
+                self.refresh(get_coordinator())
+            except Exception as e:
+                log.info("Could not refresh playlist catalog: %s", e)
+
+class SpeakerFanOut:
+    """Runs one operation against many speakers concurrently.
+
+    Used for grouping commands, so that e.g. ungrouping the whole house takes
+    about one round trip instead of one per speaker.
+    """
+
+    def __init__(self, max_workers: int = GROUPING_POOL_SIZE, timeout_sec: float = GROUPING_TIMEOUT_SEC):
+        self.max_workers = max_workers
+        self.timeout_sec = timeout_sec
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='sonobo-fanout')
+
+    def run(self, description: str, speakers: list[typing.Any],
+            operation: typing.Callable[[typing.Any], typing.Any],
+            name_of: typing.Callable[[typing.Any], str] = repr) -> dict[str, typing.Optional[BaseException]]:
+        """Returns the error (or None) for each speaker, by name."""
+        if not speakers:
+            return {}
+        start = time.monotonic()
+        futures = [(speaker, self.executor.submit(operation, speaker)) for speaker in speakers]
+        # Speakers beyond the pool size only start once an earlier one is done.
+        rounds = (len(speakers) + self.max_workers - 1) // self.max_workers
+        deadline = start + self.timeout_sec * rounds
+
+        results: dict[str, typing.Optional[BaseException]] = {}
+        for speaker, future in futures:
+            try:
+                future.result(timeout=max(0.0, deadline - time.monotonic()))
+                results[name_of(speaker)] = None
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                results[name_of(speaker)] = TimeoutError('no answer after %.1fs' % self.timeout_sec)
+            except Exception as e:
+                results[name_of(speaker)] = e
+
+        failures = {name: e for name, e in results.items() if e is not None}
+        log.info("%s: %d/%d speakers OK in %.3fs", description,
+                 len(results) - len(failures), len(results), time.monotonic() - start)
+        for name, e in failures.items():
+            log.info("%s failed for %s: %s", description, name, e)
+        return results
+
+class SpeakerState:
+    """In-memory copy of the coordinator's transport state, volume and track.
+
+    Kept current by subscribing to the coordinator's AVTransport and
+    RenderingControl UPnP events. If the subscriptions lapse (or were never
+    set up) the transport state is polled instead and trusted for ttl_sec.
+    ZoneGroupTopology events are passed on to the Topology, and changes to
+    the saved playlists (from ContentDirectory events) to the PlaylistCatalog.
+    """
+    transport_state: typing.Optional[str]
+    current_track_uri: typing.Optional[str]
+    current_track_title: typing.Optional[str]
+    # UpdateID of the queue (Q:0) from the latest ContentDirectory event.
+    queue_update_id: typing.Optional[str]
+
+    def __init__(self, clock: Clock, volume: VolumeModel, topology: Topology, playlists: PlaylistCatalog,
+                 ttl_sec: float = TRANSPORT_STATE_TTL_SEC):
+        self.clock = clock
+        self.volume = volume
+        self.topology = topology
+        self.playlists = playlists
+        self.ttl_sec = ttl_sec
+        self.lock = threading.Lock()
+        self.transport_state = None
+        self.transport_state_at = 0.0
+        self.current_track_uri = None
+        self.current_track_title = None
+        self.queue_update_id = None
+        self.subscriptions: list[typing.Any] = []
+        self.subscribed_to = None
+        self.last_subscribe_attempt: typing.Optional[float] = None
+
+    def subscribe(self, coordinator) -> None:
+        """(Re)subscribes to events from 'coordinator', dropping older subscriptions."""
+        self.unsubscribe()
+        self.last_subscribe_attempt = self.clock.monotonic()
+        self.subscribed_to = coordinator
+        with self.lock:
+            # Re-learnt from the initial event of the new subscription.
+            self.queue_update_id = None
+        subscriptions = []
+        for service, callback in ((coordinator.avTransport, self.on_event),
+                                  (coordinator.renderingControl, self.on_event),
+                                  (coordinator.zoneGroupTopology, self.topology.invalidate),
+                                  (coordinator.contentDirectory, self.on_content_directory_event)):
+            subscription = service.subscribe(
+                requested_timeout=EVENT_SUBSCRIPTION_TIMEOUT_SEC, auto_renew=True)
+            subscription.callback = callback
+            subscription.auto_renew_fail = self.on_subscription_lapsed
+            subscriptions.append(subscription)
+        with self.lock:
+            self.subscriptions = subscriptions
+        log.info("Subscribed to events from %s", getattr(coordinator, 'player_name', coordinator))
+
+    def unsubscribe(self) -> None:
+        with self.lock:
+            subscriptions = self.subscriptions
+            self.subscriptions = []
+        for subscription in subscriptions:
+            try:
+                subscription.unsubscribe()
+            except Exception as e:
+                log.info("Error unsubscribing: %s", e)
+
+    def subscribed(self) -> bool:
+        with self.lock:
+            subscriptions = self.subscriptions
+        return bool(subscriptions) and all(
+            sub.is_subscribed and sub.time_left > 0 for sub in subscriptions)
+
+    def maybe_resubscribe(self, coordinator) -> None:
+        """Tries to get events flowing again, at most every EVENT_RESUBSCRIBE_SEC."""
+        if self.subscribed() and coordinator is self.subscribed_to:
+            return
+        if (self.last_subscribe_attempt is not None and coordinator is self.subscribed_to and
+                self.clock.monotonic() - self.last_subscribe_attempt < EVENT_RESUBSCRIBE_SEC):
+            return
+        try:
+            self.subscribe(coordinator)
+        except Exception as e:
+            log.info("Could not subscribe to speaker events, polling instead: %s", e)
+
+    def on_subscription_lapsed(self, exception: Exception) -> None:
+        log.info("Speaker event subscription lapsed, falling back to polling: %s", exception)
+        self.invalidate()
+        # We may also have missed a grouping change.
+        self.topology.invalidate()
+
+    def on_event(self, event) -> None:
+        variables = event.variables
+        with self.lock:
+            if 'transport_state' in variables:
+                self.transport_state = variables['transport_state']
+                self.transport_state_at = self.clock.monotonic()
+            if 'current_track_uri' in variables:
+                self.current_track_uri = variables['current_track_uri']
+            if 'current_track_meta_data' in variables:
+                self.current_track_title = getattr(variables['current_track_meta_data'], 'title', None)
+        if 'volume' in variables:
+            try:
+                self.volume.observe(int(variables['volume']['Master']))
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    def on_content_directory_event(self, event) -> None:
+        variables = event.variables
+        # Pairs of container and UpdateID, e.g. 'Q:0,47' or 'SQ:,12,Q:0,48'
+        update_ids = variables.get('container_update_i_ds', '').split(',')
+        for container, update_id in zip(update_ids[0::2], update_ids[1::2]):
+            if container == 'Q:0':
+                with self.lock:
+                    self.queue_update_id = update_id
+            elif container.startswith('SQ:'):
+                self.playlists.request_refresh()
+        if 'saved_queues_update_id' in variables:
+            self.playlists.request_refresh()
+
+    def get_queue_update_id(self) -> typing.Optional[str]:
+        """The queue's UpdateID, if events are keeping it current."""
+        if not self.subscribed():
+            return None
+        with self.lock:
+            return self.queue_update_id
+
+    def get_transport_state(self, coordinator) -> str:
+        with self.lock:
+            state = self.transport_state
+            fresh = self.clock.monotonic() - self.transport_state_at <= self.ttl_sec
+        if state is not None and (fresh or self.subscribed()):
+            return state
+        state = coordinator.get_current_transport_info()['current_transport_state']
+        self.set_transport_state(state)
+        return state
+
+    def set_transport_state(self, state: str) -> None:
+        """Records a state we know the speaker is in, e.g. after telling it to play."""
+        with self.lock:
+            self.transport_state = state
+            self.transport_state_at = self.clock.monotonic()
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.transport_state = None
+
+class Action:
+    kind: str
+    timestamp: float
+    song: typing.Optional[SongInfo]
+    override: bool
+    # Song selections are numbered as they are submitted; only the newest one
+    # is allowed to run to completion.
+    generation: int
+    # (stage, wall time) as the action makes its way from keypress to speaker.
+    stages: list[typing.Tuple[str, float]]
+
+    def __init__(self, kind: str, timestamp: float, song: typing.Optional[SongInfo] = None, override: bool = False):
+        self.kind = kind
+        self.timestamp = timestamp
+        self.song = song
+        self.override = override
+        self.generation = 0
+        self.stages = [('event', timestamp)]
+
+    def mark(self, stage: str, when: float) -> None:
+        self.stages.append((stage, when))
+
+    def __repr__(self) -> str:
+        if self.song is not None:
+            return '<Action %s #%d song=%s>' % (self.kind, self.generation, self.song)
+        return '<Action %s%s>' % (self.kind, ' override' if self.override else '')
+
+class ActionQueue:
+    """Bounded hand-off between the input thread and the action worker.
+
+    When the queue is full the overflow policy decides what gets lost: with
+    OVERFLOW_DROP_OLDEST (the default) the stalest pending action makes room
+    for the new one, with OVERFLOW_DROP_NEWEST the new action is refused.
+
+    A new song selection replaces any song selections still waiting in the
+    queue, since only the most recent one would be heard anyway.
+    """
+
+    def __init__(self, maxsize: int = ACTION_QUEUE_SIZE, overflow: str = OVERFLOW_DROP_OLDEST):
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError('unknown overflow policy "%s"' % overflow)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.pending: collections.deque[Action] = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        # Called with each action lost to overflow, outside the queue's lock.
+        self.on_drop: typing.Optional[typing.Callable[[Action], None]] = None
+
+    def put(self, action: Action) -> bool:
+        """Returns False if 'action' itself was dropped."""
+        with self.cond:
+            if action.kind == ACTION_SONG:
+                for superseded in [a for a in self.pending if a.kind == ACTION_SONG]:
+                    log.info("Dropping %s, superseded by %s", superseded, action)
+                    self.pending.remove(superseded)
+            dropped = None
+            if len(self.pending) >= self.maxsize:
+                self.dropped += 1
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    dropped = action
+                else:
+                    dropped = self.pending.popleft()
+                    log.info("Action queue full, dropped %s", dropped)
+            if dropped is not action:
+                self.pending.append(action)
+                self.cond.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+        return dropped is not action
+
+    def get(self, timeout: typing.Optional[float] = None) -> typing.Optional[Action]:
+        """Blocks until an action is available.
+
+        Returns None on timeout, or once the queue is closed and drained.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.pending or self.closed, timeout):
+                return None
+            if not self.pending:
+                return None
+            return self.pending.popleft()
+
+    def __len__(self) -> int:
+        with self.cond:
+            return len(self.pending)
+
+    def close(self) -> None:
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class Histogram:
+    """Counts of observations (in seconds) per LATENCY_BUCKETS_SEC bucket."""
+
+    def __init__(self, buckets: typing.Sequence[float] = LATENCY_BUCKETS_SEC):
+        self.buckets = buckets
+        # The last count is for observations beyond the largest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q'th quantile (inf if past the last one).
+
+        NaN if nothing was observed.
+        """
+        if self.count == 0:
+            return math.nan
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return math.inf
+
+class ActionMetrics:
+    """Latency and error counts for performed actions, by action kind.
+
+    Latency runs from the kernel's timestamp on the keypress to the action
+    completing; each stage's histogram covers the time since the stage before.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency: dict[str, Histogram] = {}
+        self.stages: dict[typing.Tuple[str, str], Histogram] = {}
+        self.completed: collections.Counter[str] = collections.Counter()
+        self.superseded: collections.Counter[str] = collections.Counter()
+        self.errors: collections.Counter[str] = collections.Counter()
+
+    def record(self, action: Action, failed: bool = False) -> None:
+        with self.lock:
+            if failed:
+                self.errors[action.kind] += 1
+                return
+            if any(stage == 'superseded' for stage, _ in action.stages):
+                # Never meant to finish, so its timing says nothing about latency.
+                self.superseded[action.kind] += 1
+                return
+            self.completed[action.kind] += 1
+            self.latency.setdefault(action.kind, Histogram()).observe(
+                action.stages[-1][1] - action.stages[0][1])
+            for (_, previous), (stage, when) in zip(action.stages, action.stages[1:]):
+                self.stages.setdefault((action.kind, stage), Histogram()).observe(when - previous)
+
+    def summary(self) -> list[dict[str, typing.Any]]:
+        """Per action kind: counts, latency quantiles and mean time per stage."""
+        rows = []
+        with self.lock:
+            kinds = sorted(set(self.completed) | set(self.superseded) | set(self.errors))
+            for kind in kinds:
+                latency = self.latency.get(kind, Histogram())
+                rows.append({
+                    'kind': kind,
+                    'completed': self.completed[kind],
+                    'superseded': self.superseded[kind],
+                    'errors': self.errors[kind],
+                    'p50': latency.quantile(0.5),
+                    'p95': latency.quantile(0.95),
+                    'p99': latency.quantile(0.99),
+                    'mean': latency.sum / latency.count if latency.count else math.nan,
+                    'stages': [(stage, h.sum / h.count) for (k, stage), h in self.stages.items() if k == kind],
+                })
+        return rows
+
+    def prometheus_text(self, action_queue: typing.Optional[ActionQueue] = None) -> str:
+        lines = []
+        with self.lock:
+            def histogram(name: str, help_text: str, histograms: dict[typing.Any, Histogram],
+                          labels: typing.Callable[[typing.Any], str]) -> None:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s histogram' % name)
+                for key, h in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(h.buckets, h.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{%s,le="%g"} %d' % (name, labels(key), bound, cumulative))
+                    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels(key), h.count))
+                    lines.append('%s_sum{%s} %f' % (name, labels(key), h.sum))
+                    lines.append('%s_count{%s} %d' % (name, labels(key), h.count))
+
+            def counter(name: str, help_text: str, counts: collections.Counter[str]) -> None:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s counter' % name)
+                for kind, count in sorted(counts.items()):
+                    lines.append('%s{kind="%s"} %d' % (name, kind, count))
+
+            histogram('sonobo_action_latency_seconds', 'Time from keypress to completed action.',
+                      self.latency, lambda kind: 'kind="%s"' % kind)
+            histogram('sonobo_action_stage_seconds', 'Time spent reaching each stage of an action.',
+                      self.stages, lambda key: 'kind="%s",stage="%s"' % key)
+            counter('sonobo_actions_completed_total', 'Actions performed.', self.completed)
+            counter('sonobo_actions_superseded_total', 'Song selections abandoned for a newer one.',
+                    self.superseded)
+            counter('sonobo_action_errors_total', 'Actions that failed with an exception.', self.errors)
+        if action_queue is not None:
+            lines.append('# HELP sonobo_actions_dropped_total Actions dropped because the queue was full.')
+            lines.append('# TYPE sonobo_actions_dropped_total counter')
+            lines.append('sonobo_actions_dropped_total %d' % action_queue.dropped)
+            lines.append('# HELP sonobo_action_queue_depth Actions waiting to be performed.')
+            lines.append('# TYPE sonobo_action_queue_depth gauge')
+            lines.append('sonobo_action_queue_depth %d' % len(action_queue))
+        return '\n'.join(lines) + '\n'
+
+class SongmapVersionMismatch(ValueError):
+    """An edit was based on an older version of the songmap."""
+
+class SongmapHistoryBroken(ValueError):
+    """The songmap journal can't be trusted to rebuild a revision, e.g. it has a gap."""
+
 class Sonobo:
     songmap_json: list[JsonSongT] = []
     key_code_to_song_map: dict[int, SongInfo] = {}
+    songmap_version = 0
     mutex = threading.Lock()
     speaker = None
     all_speakers = None
 
-    last_key = None
-    last_key_timestamp = None
-    shift_pressed = False
+    action_queue = None
+    song_generation = 0
 
     def __init__(self, songmap_json: list[JsonSongT], speaker, all_speakers, clock: Clock):
         self.songmap_json = songmap_json
-        self.key_code_to_song_map = songmap_json_to_map(songmap_json)
+        # Whatever is on disk at startup; edits are checked strictly.
+        self.key_code_to_song_map = songmap_json_to_map(songmap_json, skip_invalid=True)
+        self.songmap_version = 1
         self.speaker = speaker
         self.all_speakers = all_speakers
         self.clock = clock
-        self.last_key = -1
-        self.last_key_timestamp = 0.0 # seconds
-        self.shift_pressed = False
+        # For events that don't say which keyboard they came from, e.g. replays.
+        self.default_device = InputDevice('default')
+        self.action_queue: typing.Optional[ActionQueue] = None
+        self.song_generation = 0
+        self.volume = VolumeModel(clock)
+        self.topology = Topology(speaker, all_speakers, clock)
+        self.playlists = PlaylistCatalog(clock)
+        self.playlists.on_first_load = self.playlists_loaded
+        self.state = SpeakerState(clock, self.volume, self.topology, self.playlists)
+        self.topology.events_flowing = self.state.subscribed
+        self.volume.events_flowing = self.state.subscribed
+        self.fan_out = SpeakerFanOut()
+        self.metrics = ActionMetrics()
+        # What we last put in the queue, and the queue's UpdateID right after.
+        self.loaded_song: typing.Optional[SongInfo] = None
+        self.loaded_queue_update_id: typing.Optional[str] = None
 
     def speaker_with_name(self, name: str):
-        for speaker in self.all_speakers:
-            if speaker.player_name == name:
-                return speaker
-        return None
+        return self.topology.speaker_named(name)
+
+    def set_speakers(self, speaker, all_speakers) -> None:
+        """Installs the result of a fresh discovery."""
+        self.mutex.acquire()
+        try:
+            self.speaker = speaker
+            self.all_speakers = all_speakers
+        finally:
+            self.mutex.release()
+        self.topology.speaker = speaker
+        self.topology.set_speakers(all_speakers)
 
     def get_songmap_json(self) -> list[JsonSongT]:
         self.mutex.acquire()
@@ -142,6 +1410,14 @@ class Sonobo:
         finally:
             self.mutex.release()
 
+    def get_versioned_songmap_json(self) -> typing.Tuple[int, list[JsonSongT]]:
+        """The songmap, and a version number that changes whenever it does."""
+        self.mutex.acquire()
+        try:
+            return self.songmap_version, self.songmap_json
+        finally:
+            self.mutex.release()
+
     def song_for_code(self, code: int) -> typing.Optional[SongInfo]:
         self.mutex.acquire()
         try:
@@ -151,171 +1427,396 @@ class Sonobo:
         finally:
             self.mutex.release()
 
-    def update_code_to_song_map(self, songmap_json: list[JsonSongT]) -> None:
+    def update_code_to_song_map(self, songmap_json: list[JsonSongT],
+                                expected_version: typing.Optional[int] = None) -> list[str]:
+        """Installs a new songmap. Returns a list of problems worth reporting.
+
+        Raises SongmapVersionMismatch if expected_version is given and the
+        songmap has changed since.
+        """
         code_to_song_map = songmap_json_to_map(songmap_json)
         log.info("Received new code-to-song map with %d songs", (len(code_to_song_map)))
         for item in code_to_song_map.items():
             log.debug(item)
         self.mutex.acquire()
         try:
+            self._check_version(expected_version)
             self.songmap_json = songmap_json
             self.key_code_to_song_map = code_to_song_map
+            self.songmap_version += 1
+        finally:
+            self.mutex.release()
+        return self.songmap_problems(code_to_song_map.values())
+
+    def put_song(self, song: JsonSongT,
+                 expected_version: typing.Optional[int] = None) -> typing.Tuple[int, list[str]]:
+        """Adds or replaces the songmap entry for song['key'], leaving the rest alone.
+
+        Raises SongmapVersionMismatch if expected_version is given and the
+        songmap has changed since. Returns the new version and any problems.
+        """
+        # Validates the entry, so a bad one raises before anything changes.
+        song_info = song_json_to_info(song)
+        self.mutex.acquire()
+        try:
+            self._check_version(expected_version)
+            songmap_json = [s for s in self.songmap_json if s['key'] != song['key']]
+            songmap_json.append(song)
+            self.songmap_json = songmap_json
+            self.key_code_to_song_map[KEY_STRING_TO_CODE_MAP[song['key']]] = song_info
+            self.songmap_version += 1
+            version = self.songmap_version
+        finally:
+            self.mutex.release()
+        log.info("Songmap entry for '%s' is now %s", song['key'], song_info)
+        return version, self.songmap_problems([song_info])
+
+    def delete_song(self, key: str, expected_version: typing.Optional[int] = None) -> int:
+        """Removes the songmap entry for 'key'. Raises KeyError if there isn't one."""
+        self.mutex.acquire()
+        try:
+            self._check_version(expected_version)
+            songmap_json = [s for s in self.songmap_json if s['key'] != key]
+            if len(songmap_json) == len(self.songmap_json):
+                raise KeyError(key)
+            self.songmap_json = songmap_json
+            self.key_code_to_song_map.pop(KEY_STRING_TO_CODE_MAP.get(key), None)
+            self.songmap_version += 1
+            version = self.songmap_version
+        finally:
+            self.mutex.release()
+        log.info("Removed songmap entry for '%s'", key)
+        return version
+
+    def _check_version(self, expected_version: typing.Optional[int]) -> None:
+        if expected_version is not None and expected_version != self.songmap_version:
+            raise SongmapVersionMismatch(
+                'Songmap is at version %d, not %d' % (self.songmap_version, expected_version))
+
+    def songmap_problems(self, songs: typing.Iterable[SongInfo]) -> list[str]:
+        problems = self.missing_playlists(songs)
+        # Pick up any playlists created since we last looked.
+        self.playlists.request_refresh()
+        return problems
+
+    def missing_playlists(self, songs: typing.Iterable[SongInfo]) -> list[str]:
+        problems = []
+        for title in self.playlists.missing(
+                song.payload for song in songs if song.kind == 'SONOS_PLAYLIST_NAME'):
+            problems.append('No Sonos playlist named "%s"' % title)
+        for problem in problems:
+            log.info(problem)
+        return problems
+
+    def playlists_loaded(self) -> None:
+        # Until now missing() couldn't tell, so check the songmap we started with.
+        self.mutex.acquire()
+        try:
+            songs = list(self.key_code_to_song_map.values())
         finally:
             self.mutex.release()
+        self.missing_playlists(songs)
 
     def coordinator(self):
-        return self.speaker.group.coordinator
-
-    def get_keypress(self, keyboard_dev_file: typing.BinaryIO) -> typing.Tuple[int, int, int, float]:
-        # https://www.kernel.org/doc/Documentation/input/input.txt
-        #
-        # Section5: Event interfaces
-        #
-        # You can use blocking and nonblocking reads, also select() on the
-        # /dev/input/eventX devices, and you'll always get a whole number of input
-        # events on a read. Their layout is:
-        #
-        # struct input_event {
-        #	struct timeval time;
-        #	unsigned short type;
-        #	unsigned short code;
-        #	unsigned int value;
-        # };
-        #
-        # 'struct timeval' is from <sys/time.h> and is:
-        # struct timeval {
-        #	long	tv_sec;		/* seconds */
-        #	long	tv_usec;	/* and microseconds */
-        # };
-
-        struct_format = 'llHHi'  # long, long, short, short, int
-        size = struct.calcsize(struct_format)
-        data = keyboard_dev_file.read(size)
-
-        _tv_sec, _tv_usec, typet, code, value = struct.unpack(struct_format, data)
-        timestamp = (_tv_sec * 1000000 + _tv_usec)/1000000
-
-        # 'time' is the timestamp, it returns the time at which the event happened.
-        # Type is for example EV_REL for relative moment, EV_KEY for a keypress or
-        # release. More types are defined in include/uapi/linux/input-event-codes.h.
-        #
-        # 'code' is event code, for example REL_X or KEY_BACKSPACE, again a complete
-        # list is in include/uapi/linux/input-event-codes.h.
-        #
-        # 'value' is the value the event carries. Either a relative change for
-        # EV_REL, absolute new value for EV_ABS (joysticks ...), or 0 for EV_KEY for
-        # release, 1 for keypress and 2 for autorepeat.
-        #
-        # https://github.com/torvalds/linux/blob/master/include/uapi/linux/input-event-codes
-
-        return (typet, code, value, timestamp)
-
-    def dispatch(self, typet: int, code: int, value: int, timestamp: float) -> None:
-        if typet == EV_KEY:
-            # Track shift key state
-            if code in (KEY_LEFTSHIFT, KEY_RIGHTSHIFT):
-                self.shift_pressed = (value != 0)  # 1=press, 2=repeat, 0=release
-                return
+        return self.topology.coordinator()
+
+    def dispatch(self, typet: int, code: int, value: int, timestamp: float,
+                 device: typing.Optional[InputDevice] = None) -> None:
+        if device is None:
+            device = self.default_device
+        # Track shift key state, separately for each keyboard
+        if device.update_modifiers(typet, code, value):
+            return
 
         if typet == EV_KEY and value == 1:
+            code = device.keymap.get(code, code)
             # Keypress
             log.info("%d pressed", code)
             fast_repeat = False
-            if self.last_key == code and self.last_key_timestamp is not None:
-                delay = timestamp - self.last_key_timestamp
+            if device.last_key == code and device.last_key_timestamp is not None:
+                delay = timestamp - device.last_key_timestamp
                 log.info("Delay between repeat keypresses: %s", "{:10.4f}".format(delay))
                 if delay < FAST_REPEAT_THRESHOLD_SEC:
                     fast_repeat = True
 
-            if code == KEY_SPACE:
-                if self.coordinator().get_current_transport_info()['current_transport_state'] != 'PLAYING':
-                    log.info("Play")
-                    self.coordinator().play()
-                else:
-                    log.info("Pause")
-                    self.coordinator().pause()
-            elif code == KEY_BACKSPACE:
+            action = self.action_for_key(code, fast_repeat, timestamp, device.shift_pressed)
+            if action is not None:
+                self.submit(action)
+
+            device.last_key = code
+            device.last_key_timestamp = timestamp
+
+    def action_for_key(self, code: int, fast_repeat: bool, timestamp: float,
+                       shift_pressed: bool = False) -> typing.Optional[Action]:
+        if code == KEY_SPACE:
+            return Action(ACTION_PLAY_PAUSE, timestamp)
+        elif code == KEY_BACKSPACE:
+            return Action(ACTION_PAUSE, timestamp)
+        elif code == KEY_UP:
+            if self.volume.press(1, shift_pressed):
+                return Action(ACTION_VOLUME, timestamp)
+            return None
+        elif code == KEY_DOWN:
+            if self.volume.press(-1, False):
+                return Action(ACTION_VOLUME, timestamp)
+            return None
+        elif code == KEY_RIGHT:
+            return Action(ACTION_NEXT, timestamp)
+        elif code == KEY_LEFT:
+            return Action(ACTION_PREVIOUS, timestamp)
+        elif code == KEY_F12:
+            return Action(ACTION_DUMP_PLAYLISTS, timestamp)
+        elif code == KEY_M and shift_pressed:
+            return Action(ACTION_TOGGLE_MOVE, timestamp)
+        elif code == KEY_A and shift_pressed:
+            return Action(ACTION_PARTY_MODE, timestamp)
+        elif code == KEY_U and shift_pressed:
+            return Action(ACTION_UNGROUP_ALL, timestamp)
+        elif song := self.song_for_code(code):
+            if fast_repeat:
+                log.info("Ignoring fast-repeat of %d", code)
+                return None
+            return Action(ACTION_SONG, timestamp, song=song)
+        return None
+
+    def submit(self, action: Action) -> None:
+        if action.kind == ACTION_SONG:
+            self.mutex.acquire()
+            try:
+                self.song_generation += 1
+                action.generation = self.song_generation
+            finally:
+                self.mutex.release()
+
+        self.trace(action, 'submitted')
+        # Without a worker (e.g. in tests) actions run inline on the caller.
+        if self.action_queue is None:
+            self.execute(action)
+        elif not self.action_queue.put(action):
+            log.info("Action queue full, dropped %s", action)
+
+    def start_worker(self, action_queue: typing.Optional[ActionQueue] = None) -> threading.Thread:
+        self.action_queue = action_queue if action_queue is not None else ActionQueue()
+        self.action_queue.on_drop = self.abandoned
+        worker = threading.Thread(target=self.run_actions, args=(self.action_queue,), name='sonobo-actions')
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def run_actions(self, action_queue: ActionQueue) -> None:
+        while True:
+            try:
+                self.state.maybe_resubscribe(self.coordinator())
+            except Exception as e:
+                # e.g. the topology lookup failed; the worker must live on regardless.
+                log.info("Could not check speaker event subscriptions: %s", e)
+            action = action_queue.get(EVENT_RESUBSCRIBE_SEC)
+            if action is None:
+                if action_queue.closed:
+                    return
+                continue
+            try:
+                self.execute(action)
+            except Exception as e:
+                log.exception(e)
+                # Whatever the speaker is doing now, it may not be what we
+                # think, and it may not even be our coordinator any more.
+                self.state.invalidate()
+                self.topology.invalidate()
+
+    def trace(self, action: Action, stage: str) -> None:
+        action.mark(stage, self.clock.wall_time())
+
+    def execute(self, action: Action) -> None:
+        """perform()s 'action', recording how long it and each of its stages took."""
+        self.trace(action, 'dequeued')
+        try:
+            self.perform(action)
+        except Exception:
+            self.metrics.record(action, failed=True)
+            self.abandoned(action)
+            raise
+        self.trace(action, 'done')
+        self.metrics.record(action)
+
+    def abandoned(self, action: Action) -> None:
+        """Cleans up after an action that was dropped or failed."""
+        if action.kind == ACTION_VOLUME:
+            # Otherwise press() would keep waiting for this burst's flush.
+            self.volume.discard()
+
+    def song_superseded(self, action: Action) -> bool:
+        """True if a newer song selection has been submitted since 'action'.
+
+        Checked between the steps of a song sequence, so that a superseded
+        selection is abandoned before it reaches play.
+        """
+        self.mutex.acquire()
+        try:
+            superseded = action.generation != self.song_generation
+        finally:
+            self.mutex.release()
+        if superseded:
+            log.info("Abandoning %s, a newer song was selected", action)
+            self.trace(action, 'superseded')
+        return superseded
+
+    def queue_holds(self, song: SongInfo) -> bool:
+        """True if the speaker's queue is still exactly what we loaded for 'song'.
+
+        Only trusted while events keep the queue's UpdateID current, since
+        anything else (e.g. the Sonos app) may have changed the queue.
+        """
+        if not song.same_item(self.loaded_song) or self.loaded_queue_update_id is None:
+            return False
+        return self.state.get_queue_update_id() == self.loaded_queue_update_id
+
+    def loaded(self, song: typing.Optional[SongInfo], response: typing.Optional[dict[str, str]] = None) -> None:
+        self.loaded_song = song
+        self.loaded_queue_update_id = response.get('NewUpdateID') if isinstance(response, dict) else None
+
+    def perform(self, action: Action) -> None:
+        coordinator = self.coordinator()
+        self.trace(action, 'coordinator')
+        if action.kind == ACTION_PLAY_PAUSE:
+            if self.state.get_transport_state(coordinator) != 'PLAYING':
+                log.info("Play")
+                coordinator.play()
+                self.trace(action, 'play')
+                self.state.set_transport_state('PLAYING')
+            else:
                 log.info("Pause")
-                self.coordinator().pause()
-            elif code == KEY_UP:
-                current_vol = self.coordinator().volume
-                if self.shift_pressed:
-                    # Shift+Up: volume up with no limit
-                    log.info("Volume up (no limit) (%d + 2)", current_vol)
-                    self.coordinator().set_relative_volume(2)
-                elif current_vol >= MAX_VOLUME:
-                    log.info("Volume-up capped at %d", current_vol)
-                else:
-                    delta = min(2, MAX_VOLUME - current_vol)
-                    log.info("Volume up (%d + %d)", current_vol, delta)
-                    self.coordinator().set_relative_volume(delta)
-            elif code == KEY_DOWN:
-                current_vol = self.coordinator().volume
-                if current_vol <= 0:
-                    log.info("Volume-down capped at 0")
-                else:
-                    delta = min(2, current_vol)
-                    log.info("Volume down (%d - %d)", current_vol, delta)
-                    self.coordinator().set_relative_volume(-1 * delta)
-            elif code == KEY_RIGHT:
-                log.info("Next")
-                self.coordinator().next()
-            elif code == KEY_LEFT:
-                log.info("Previous")
-                self.coordinator().previous()
-            elif code == KEY_F12:
-                log.info("=== Dumping Sonos Playlist IDs ===")
-                for playlist in self.coordinator().get_sonos_playlists():
-                    log.info("title=%s item_id=%s", playlist.title, playlist.item_id)
-            elif code == KEY_M and self.shift_pressed:
-                move_speaker = self.speaker_with_name('Move')
-                if move_speaker is None:
-                    log.info("Could not find 'Move' speaker")
-                elif move_speaker.group.coordinator == self.coordinator():
-                    log.info("Ungrouping 'Move' from Living Room")
-                    move_speaker.unjoin()
-                else:
-                    log.info("Grouping 'Move' with Living Room")
-                    move_speaker.join(self.coordinator())
-            elif code == KEY_A and self.shift_pressed:
-                log.info("Party mode: grouping all speakers")
-                self.coordinator().partymode()
-            elif code == KEY_U and self.shift_pressed:
-                log.info("Ungrouping all speakers")
-                for speaker in self.all_speakers:
-                    if speaker != self.coordinator():
-                        speaker.unjoin()
-            elif song := self.song_for_code(code):
-                if fast_repeat:
-                    log.info("Ignoring fast-repeat of %d", code)
-                else:
-                    log.info('Song %s', song)
-                    if song.kind == 'SPOTIFY':
-                        self.coordinator().clear_queue()
-                        living_room_sharelink = soco.plugins.sharelink.ShareLinkPlugin(self.coordinator())
-                        living_room_sharelink.add_share_link_to_queue(song.payload)
-                        self.coordinator().play_from_queue(0)
-                    elif song.kind == 'SONOS_PLAYLIST_NAME':
-                        playlist = self.coordinator().get_sonos_playlist_by_attr(
-                            'title', song.payload)
-                        self.coordinator().clear_queue()
-                        self.coordinator().add_to_queue(playlist)
-                        self.coordinator().play()
-                    elif song.kind == 'TV_AUDIO':
-                        self.coordinator().switch_to_tv()
-                    else:
-                        log.info('unknown song kind: %s', song.kind)
-
-            self.last_key = code
-            self.last_key_timestamp = timestamp
-
-    def loop(self) -> None:
-        log.info('opening "%s"', EVENT_DEVICE_PATH)
-        with open(EVENT_DEVICE_PATH, 'rb') as f:
-            log.info('READY')
-            while True:
+                coordinator.pause()
+                self.trace(action, 'pause')
+                self.state.set_transport_state('PAUSED_PLAYBACK')
+        elif action.kind == ACTION_PAUSE:
+            log.info("Pause")
+            coordinator.pause()
+            self.trace(action, 'pause')
+            self.state.set_transport_state('PAUSED_PLAYBACK')
+        elif action.kind == ACTION_VOLUME:
+            if self.action_queue is not None:
+                # Give the rest of the burst a chance to arrive.
+                self.volume.wait_for_burst()
+                self.trace(action, 'debounce')
+            self.volume.flush(coordinator)
+            self.trace(action, 'set_relative_volume')
+        elif action.kind == ACTION_NEXT:
+            log.info("Next")
+            coordinator.next()
+            self.trace(action, 'next')
+        elif action.kind == ACTION_PREVIOUS:
+            log.info("Previous")
+            coordinator.previous()
+            self.trace(action, 'previous')
+        elif action.kind == ACTION_DUMP_PLAYLISTS:
+            log.info("=== Dumping Sonos Playlist IDs ===")
+            for playlist in coordinator.get_sonos_playlists():
+                log.info("title=%s item_id=%s", playlist.title, playlist.item_id)
+        elif action.kind == ACTION_TOGGLE_MOVE:
+            move_speaker = self.speaker_with_name('Move')
+            if move_speaker is None:
+                log.info("Could not find 'Move' speaker")
+            elif self.topology.coordinator_of(move_speaker) == coordinator:
+                log.info("Ungrouping 'Move' from Living Room")
+                move_speaker.unjoin()
+                self.topology.invalidate()
+            else:
+                log.info("Grouping 'Move' with Living Room")
+                move_speaker.join(coordinator)
+                self.topology.invalidate()
+        elif action.kind == ACTION_PARTY_MODE:
+            log.info("Party mode: grouping all speakers")
+            coordinator.partymode()
+            self.topology.invalidate()
+        elif action.kind == ACTION_UNGROUP_ALL:
+            log.info("Ungrouping all speakers")
+            grouped = [speaker for speaker in self.all_speakers
+                       if speaker != coordinator and self.topology.is_grouped(speaker)]
+            self.fan_out.run('Ungroup', grouped, lambda speaker: speaker.unjoin(), self.topology.name_of)
+            self.topology.invalidate()
+        elif action.kind == ACTION_SONG:
+            song = action.song
+            log.info('Song %s', song)
+            if self.song_superseded(action):
+                return
+            if song.kind in ('SPOTIFY', 'SONOS_PLAYLIST_NAME') and self.queue_holds(song):
+                log.info('Queue already holds %s, starting it over', song)
+                coordinator.play_from_queue(0)
+                self.trace(action, 'play_from_queue')
+                self.state.set_transport_state('PLAYING')
+            elif song.kind == 'SPOTIFY':
+                self.loaded(None)
+                coordinator.clear_queue()
+                self.trace(action, 'clear_queue')
+                if self.song_superseded(action):
+                    return
+                self.loaded(song, enqueue_song(coordinator, song))
+                self.trace(action, 'enqueue')
+                if self.song_superseded(action):
+                    return
+                coordinator.play_from_queue(0)
+                self.trace(action, 'play_from_queue')
+                self.state.set_transport_state('PLAYING')
+            elif song.kind == 'SONOS_PLAYLIST_NAME':
+                playlist = self.playlists.get(song.payload)
+                # Not loaded yet, or created since the last refresh.
+                if playlist is None and self.playlists.refresh_unless_recent(coordinator):
+                    self.trace(action, 'playlist_refresh')
+                    playlist = self.playlists.get(song.payload)
+                if playlist is None:
+                    log.info('No Sonos playlist named "%s"', song.payload)
+                    return
+                if self.song_superseded(action):
+                    return
+                self.loaded(None)
+                coordinator.clear_queue()
+                self.trace(action, 'clear_queue')
+                if self.song_superseded(action):
+                    return
+                self.loaded(song, enqueue(coordinator, playlist))
+                self.trace(action, 'enqueue')
+                if self.song_superseded(action):
+                    return
+                coordinator.play()
+                self.trace(action, 'play')
+                self.state.set_transport_state('PLAYING')
+            elif song.kind == 'TV_AUDIO':
+                coordinator.switch_to_tv()
+                self.state.invalidate()
+            else:
+                log.info('unknown song kind: %s', song.kind)
+        else:
+            log.info('unknown action: %s', action)
+
+    def replay(self, events: list[DeviceInputEventT], max_age_sec: float = STARTUP_EVENT_MAX_AGE_SEC) -> None:
+        """Dispatches events that arrived before we were ready, unless they are stale."""
+        now = self.clock.wall_time()
+        fresh = []
+        for device, event in events:
+            if now - event[3] <= max_age_sec:
+                fresh.append((device, event))
+            else:
+                # Too old to act on, but a shift held since still applies.
+                device.update_modifiers(*event[:3])
+        if events:
+            log.info("Replaying %d events from startup (%d too old)", len(fresh), len(events) - len(fresh))
+        for device, event in fresh:
+            try:
+                self.dispatch(*event, device=device)
+            except Exception as e:
+                log.exception(e)
+
+    def loop(self, reader: InputMultiplexer,
+             startup_events: typing.Optional[list[DeviceInputEventT]] = None) -> None:
+        self.start_worker()
+        self.playlists.start(self.coordinator)
+        log.info('READY')
+        self.replay(startup_events or [])
+        while True:
+            for device, event in reader.read_events():
                 try:
-                    self.dispatch(*self.get_keypress(f))
+                    self.dispatch(*event, device=device)
                 except Exception as e:
                     log.exception(e)
 
@@ -325,42 +1826,525 @@ def speaker_with_name(speakers, name):
             return speaker
     raise ValueError('Could not find speaker with name "%s"' % name)
 
-def songmap_json_to_map(json_songmap_contents: list[JsonSongT]) -> dict[int, SongInfo]:
+def save_speaker_cache(filename: str, speakers) -> None:
+    entries: list[JsonSpeakerT] = []
+    for speaker in speakers:
+        entry: JsonSpeakerT = {
+            'name': speaker.player_name,
+            'ip': speaker.ip_address,
+            'uid': speaker.uid,
+            'household': speaker.household_id,
+        }
+        port = getattr(speaker, 'port', SONOS_PORT)
+        if port != SONOS_PORT:
+            entry['port'] = port
+        entries.append(entry)
+    with open(filename + '.tmp', 'w') as outfile:
+        json.dump(entries, outfile, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+def load_speaker_cache(filename: str) -> list[JsonSpeakerT]:
+    try:
+        with open(filename) as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError) as e:
+        log.info("No usable speaker cache (%s): %s", filename, e)
+        return []
+
+def speakers_from_cache(entries: list[JsonSpeakerT]) -> list[typing.Any]:
+    speakers = []
+    for entry in entries:
+        port = entry.get('port', SONOS_PORT)
+        # soco keeps one instance per constructor arguments, and discovery
+        # creates them from the IP address alone.
+        speaker = soco.SoCo(entry['ip']) if port == SONOS_PORT else soco.SoCo(entry['ip'], port)
+        prefill_speaker(speaker, entry)
+        speakers.append(speaker)
+    return speakers
+
+def prefill_speaker(speaker, entry: JsonSpeakerT) -> None:
+    """Tells soco what the cache already knows about a speaker.
+
+    soco has no public way to do this, so it sets private attributes, as
+    checked against soco 0.31.5. There, uid and household_id are answered
+    from them without asking the speaker again. player_name still polls the
+    (cached) zone group state, which refreshes it.
+    """
+    speaker._uid = entry['uid']
+    speaker._household_id = entry['household']
+    speaker._player_name = entry['name']
+
+def verify_cached_speaker(speakers, entries: list[JsonSpeakerT], name: str):
+    """Returns the cached speaker called 'name' if it still answers to that name.
+
+    Costs one unicast call, instead of a multicast discovery.
+    """
+    for speaker, entry in zip(speakers, entries):
+        if entry['name'] != name:
+            continue
+        try:
+            zone_name = speaker.deviceProperties.GetZoneAttributes()['CurrentZoneName']
+        except Exception as e:
+            log.info("Cached '%s' (%s) did not answer: %s", name, entry['ip'], e)
+            return None
+        if zone_name != name:
+            log.info("Cached '%s' (%s) is now called '%s'", name, entry['ip'], zone_name)
+            return None
+        return speaker
+    return None
+
+def discover_speakers(name: str) -> typing.Tuple[typing.Any, list[typing.Any]]:
+    """Multicast discovery. Returns the speaker called 'name' and all speakers."""
+    speakers = list(soco.discover() or [])
+    for speaker in speakers:
+        log.info(" - %s", speaker.player_name)
+    return speaker_with_name(speakers, name), speakers
+
+def rediscover(sonobo: Sonobo, cache_filename: str) -> None:
+    """Refreshes the speakers we started with from the cache, then updates the cache."""
+    try:
+        speaker, speakers = discover_speakers(LIVING_ROOM)
+        sonobo.set_speakers(speaker, speakers)
+        log.info("Rediscovered %d speakers", len(speakers))
+        save_speaker_cache(cache_filename, speakers)
+    except Exception as e:
+        log.info("Background discovery failed, keeping cached speakers: %s", e)
+
+def song_json_to_info(song: JsonSongT) -> SongInfo:
+    """Raises ValueError if the song can't be played."""
+    if song['key'] not in KEY_STRING_TO_CODE_MAP:
+        raise ValueError('Unsupported key "%s" for "%s"' % (song['key'], song['debugName']))
+    song_info = SongInfo(song['payload'], song['kind'])
+    if song['kind'] == 'SPOTIFY':
+        song_info.enqueue = resolve_share_link(song['payload'])
+    return song_info
+
+def songmap_json_to_map(json_songmap_contents: list[JsonSongT],
+                        skip_invalid: bool = False) -> dict[int, SongInfo]:
+    """Raises ValueError if any of the songs can't be played.
+
+    With skip_invalid, such songs are logged and left out instead, e.g. so
+    that one bad entry in songmap.json only costs its own key at startup.
+    """
     key_code_to_song_map = {}
     for song in json_songmap_contents:
-        key_code_to_song_map[KEY_STRING_TO_CODE_MAP[song['key']]] = SongInfo(song['payload'], song['kind'])
+        try:
+            song_info = song_json_to_info(song)
+        except ValueError as e:
+            if not skip_invalid:
+                raise
+            log.warning("Skipping songmap entry: %s", e)
+            continue
+        key_code_to_song_map[KEY_STRING_TO_CODE_MAP[song['key']]] = song_info
     return key_code_to_song_map
 
+def enqueue(coordinator, descriptor: EnqueueDescriptor) -> dict[str, str]:
+    return coordinator.avTransport.AddURIToQueue([
+        ('InstanceID', 0),
+        ('EnqueuedURI', descriptor.uri),
+        ('EnqueuedURIMetaData', descriptor.metadata),
+        ('DesiredFirstTrackNumberEnqueued', 0),
+        ('EnqueueAsNext', 0),
+    ])
+
+def enqueue_song(coordinator, song: SongInfo) -> dict[str, str]:
+    """Sends the pre-resolved AddURIToQueue request(s) for 'song'.
+
+    Returns the response of the first one the speaker accepts.
+    """
+    descriptors = song.enqueue or resolve_share_link(song.payload)
+    fault = None
+    for i, descriptor in enumerate(descriptors):
+        try:
+            response = enqueue(coordinator, descriptor)
+        except soco.exceptions.SoCoException as e:
+            fault = e
+            continue
+        if i > 0:
+            # Try the service that worked first next time.
+            song.enqueue = [descriptor] + [d for d in descriptors if d is not descriptor]
+        return response
+    raise typing.cast(Exception, fault)
+
+
+LOG_LINES_PER_PAGE = 100
+LOG_INDEX_CHUNK_SIZE = 64 * 1024
+
+class LogIndex:
+    """Sparse line number -> byte offset index of the log file.
+
+    Remembers where every 'every'-th line starts, so any page of the log can
+    be served with one seek and a bounded read. The index is extended with
+    just the newly written bytes on each update(), and starts over when the
+    file is rotated or replaced.
+    """
+
+    def __init__(self, filename: str, every: int = LOG_LINES_PER_PAGE):
+        self.filename = filename
+        self.every = every
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, identity: typing.Optional[typing.Tuple[int, int]]) -> None:
+        self.identity = identity
+        # offsets[i] is where line i * every starts
+        self.offsets = [0]
+        # Complete (newline-terminated) lines seen so far, and where they end.
+        self.lines = 0
+        self.indexed_to = 0
+        self.size = 0
+
+    def update(self) -> int:
+        """Catches up with the file. Returns its number of lines."""
+        with self.lock:
+            with open(self.filename, 'rb') as log_file:
+                stat = os.fstat(log_file.fileno())
+                identity = (stat.st_dev, stat.st_ino)
+                if identity != self.identity or stat.st_size < self.indexed_to:
+                    self.reset(identity)
+                log_file.seek(self.indexed_to)
+                position = self.indexed_to
+                while chunk := log_file.read(LOG_INDEX_CHUNK_SIZE):
+                    start = 0
+                    while (newline := chunk.find(b'\n', start)) != -1:
+                        start = newline + 1
+                        self.lines += 1
+                        if self.lines % self.every == 0:
+                            self.offsets.append(position + start)
+                    self.indexed_to = position + start if start else self.indexed_to
+                    position += len(chunk)
+                self.size = position
+            # A trailing line without its newline yet still counts.
+            return self.lines + (1 if self.size > self.indexed_to else 0)
+
+    def read_lines(self, start_line: int, end_line: int) -> list[str]:
+        """Lines [start_line, end_line), as of the last update()."""
+        with self.lock:
+            block = min(start_line // self.every, len(self.offsets) - 1)
+            offset = self.offsets[block]
+            skip = start_line - block * self.every
+        lines = []
+        with open(self.filename, 'rb') as log_file:
+            log_file.seek(offset)
+            for i in range(end_line - block * self.every):
+                line = log_file.readline()
+                if not line:
+                    break
+                if i >= skip:
+                    lines.append(line.decode('utf-8', errors='replace').rstrip('\n'))
+        return lines
+
+HTTP_PORT = 8080
+HTTP_POOL_SIZE = 8
+HTTP_REQUEST_TIMEOUT_SEC = 20.0
+# An idle keep-alive connection holds a pool thread, so it gets less patience.
+HTTP_KEEPALIVE_IDLE_SEC = 5.0
+# Connections waiting for a free thread; beyond this they are refused with a 503.
+HTTP_MAX_PENDING = 32
+
+# Records a /log/stream viewer may fall behind by before we give up on it.
+LOG_STREAM_CLIENT_BUFFER = 256
+LOG_STREAM_KEEPALIVE_SEC = 15.0
+# Log records waiting to be written out; beyond this they are dropped.
+LOG_QUEUE_SIZE = 1024
+# Recent log lines kept in memory for /log/recent.
+LOG_RECENT_LINES = 500
+SONGMAP_FILENAME = 'songmap.json'
+SONGMAP_JOURNAL_FILENAME = 'songmap-journal.jsonl'
+# Saves to keep in the songmap journal (it's trimmed once it has twice this many).
+SONGMAP_HISTORY_ENTRIES = 500
+# How often to look at songmap.json when inotify isn't available.
+SONGMAP_POLL_SEC = 1
+# From <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+# Keyboards (and their by-id links) coming and going. IN_ATTRIB too, since
+# udev only makes a new event device readable after creating it.
+INPUT_INOTIFY_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT_STRUCT = struct.Struct('iIII')
+# How long to wait for more songmap edits before saving.
+SONGMAP_WRITE_DELAY_SEC = 2
+SONGMAP_API_PREFIX = '/api/songmap'
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to a QueueListener thread without ever blocking.
+
+    Formatting and I/O happen on the listener thread, off the keypress path.
+    When the queue is full the record is dropped and counted, and a warning
+    with the count is queued once there is room again.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.reported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener is in this process, so there is no need to pre-format
+        # the record for pickling the way QueueHandler does.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.dropped > self.reported:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'Log queue full, dropped %d records', 'args': (self.dropped - self.reported,)}))
+                self.reported = self.dropped
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogStreamSubscriber:
+    def __init__(self, maxsize: int):
+        self.lines: queue.Queue[str] = queue.Queue(maxsize)
+        # Set when the viewer fell too far behind and was cut off.
+        self.dropped = False
+
+class LogStreamHub(logging.Handler):
+    """Fans formatted log records out to every /log/stream viewer.
+
+    Each viewer has its own bounded buffer. A viewer that lets it fill up is
+    dropped, rather than holding up whoever is logging. The most recent lines
+    are also kept in memory, so they can be served without reading the file.
+    """
+
+    def __init__(self, client_buffer: int = LOG_STREAM_CLIENT_BUFFER, recent_lines: int = LOG_RECENT_LINES):
+        super().__init__()
+        self.client_buffer = client_buffer
+        self.subscribers: set[LogStreamSubscriber] = set()
+        self.subscribers_lock = threading.Lock()
+        self.recent: collections.deque[str] = collections.deque(maxlen=recent_lines)
+
+    def recent_lines(self) -> list[str]:
+        with self.subscribers_lock:
+            return list(self.recent)
+
+    def disconnect_all(self) -> None:
+        """Ends every stream, e.g. so that the web server can shut down."""
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+            self.subscribers.clear()
+        for subscriber in subscribers:
+            subscriber.dropped = True
+            try:
+                # Wake it up, if it's waiting for a line.
+                subscriber.lines.put_nowait('')
+            except queue.Full:
+                pass
+
+    def subscribe(self, max_viewers: typing.Optional[int] = None) -> typing.Optional[LogStreamSubscriber]:
+        """Returns None if there are already max_viewers viewers."""
+        subscriber = LogStreamSubscriber(self.client_buffer)
+        with self.subscribers_lock:
+            if max_viewers is not None and len(self.subscribers) >= max_viewers:
+                return None
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: LogStreamSubscriber) -> None:
+        with self.subscribers_lock:
+            self.subscribers.discard(subscriber)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.subscribers_lock:
+            self.recent.extend(line.split('\n'))
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.lines.put_nowait(line)
+            except queue.Full:
+                # Don't log from in here: that would come straight back to us.
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """HTTPServer that handles connections on a bounded pool of threads.
+
+    Unlike ThreadingHTTPServer, a burst of clients can't spawn an unbounded
+    number of threads; up to max_pending extra connections wait for a free
+    thread, and any more are turned away with a 503.
+    """
+
+    def __init__(self, server_address, handler, pool_size: int = HTTP_POOL_SIZE,
+                 max_pending: int = HTTP_MAX_PENDING):
+        super().__init__(server_address, handler)
+        self.executor = concurrent.futures.ThreadPoolExecutor(pool_size, thread_name_prefix='sonobo-http')
+        self.max_connections = pool_size + max_pending
+        # Threads long-lived responses like /log/stream may hold; the rest are
+        # kept for everything else.
+        self.max_streams = pool_size // 2
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address) -> None:
+        with self.connections_lock:
+            accepted = self.connections < self.max_connections
+            if accepted:
+                self.connections += 1
+        if not accepted:
+            self.refuse_request(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
 
-class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, sonobo: Sonobo, log_filename: str, *args):
-        self.sonobo = sonobo
-        self.log_filename = log_filename
-        self.json_songmap: typing.Optional[list[JsonSongT]] = None
-        super().__init__(*args)
+    def refuse_request(self, request) -> None:
+        # Written from the accept loop, so keep it to one small send.
+        try:
+            request.settimeout(1.0)
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n'
+                            b'Retry-After: 5\r\nConnection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.connections_lock:
+                self.connections -= 1
+
+    def server_close(self) -> None:
+        """Stops accepting, then lets in-flight requests finish."""
+        super().server_close()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+EDITOR_CSS = """body { font-family: Arial, sans-serif; margin: 20px; }
+table { border-collapse: collapse; width: 100%; margin-top: 20px; }
+th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
+th { background-color: #f2f2f2; }
+input, select { margin: 2px; }
+.nav { margin-bottom: 20px; }
+.controls { margin: 20px 0; }
+.controls button { margin: 5px; padding: 10px 15px; }
+"""
+
+EDITOR_JS = """let nextRowId = 0;
+
+document.addEventListener('DOMContentLoaded', () => {
+    nextRowId = parseInt(document.getElementById('songTableBody').dataset.nextRowId, 10);
+});
+
+function addRow() {
+    const tbody = document.getElementById('songTableBody');
+    const newRow = document.createElement('tr');
+    newRow.id = `row-${nextRowId}`;
+    newRow.innerHTML = `
+        <td><input type="text" name="debugName_${nextRowId}" value="" style="width: 200px;"></td>
+        <td><input type="text" name="key_${nextRowId}" value="" style="width: 50px;" maxlength="1"></td>
+        <td>
+            <select name="kind_${nextRowId}" style="width: 150px;">
+                <option value="SPOTIFY" selected>SPOTIFY</option>
+                <option value="SONOS_PLAYLIST_NAME">SONOS_PLAYLIST_NAME</option>
+            </select>
+        </td>
+        <td><input type="text" name="payload_${nextRowId}" value="" style="width: 400px;"></td>
+        <td><button type="button" onclick="removeRow(${nextRowId})">Remove</button></td>
+    `;
+    tbody.appendChild(newRow);
+    nextRowId++;
+    updateRowCount();
+}
 
-    def do_GET(self) -> None:
-        log.info('do_GET %s', self.path)
-        if self.path == '/':
-            self._handle_songmap_editor()
-        elif self.path.startswith('/log'):
-            self._handle_log_request()
-        else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b'')
-        log.info('do_GET done')
+function removeRow(rowId) {
+    const row = document.getElementById(`row-${rowId}`);
+    if (row) {
+        row.remove();
+        updateRowCount();
+    }
+}
 
-    def _handle_songmap_editor(self) -> None:
-        songmap_data = self.sonobo.get_songmap_json()
+function updateRowCount() {
+    const rows = document.getElementById('songTableBody').children.length;
+    document.getElementById('rowCount').value = rows;
+}
+"""
+
+# Only responses at least this big are worth gzipping.
+GZIP_MIN_SIZE = 1024
+
+class CachedResponse:
+    """A rendered response body, with its ETag and gzipped form worked out once."""
+
+    def __init__(self, body: bytes, content_type: str, cache_control: str = 'no-cache'):
+        self.body = body
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+        self.gzipped = gzip.compress(body) if len(body) >= GZIP_MIN_SIZE else None
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header matches 'etag'.
+
+    The header is a comma-separated list of entity tags, or '*'. As RFC 9110
+    asks for If-None-Match, W/ (weak) tags match their strong counterpart.
+    """
+    def opaque(tag: str) -> str:
+        return tag[2:] if tag.startswith('W/') else tag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or (tag and opaque(tag) == opaque(etag)):
+            return True
+    return False
+
+def accepts_encoding(accept_encoding: str, coding: str) -> bool:
+    """Whether an Accept-Encoding header allows 'coding', honouring q-values (e.g. gzip;q=0)."""
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    return qualities.get(coding, qualities.get('*', 0.0)) > 0
+
+def static_asset(name: str, body: bytes, content_type: str) -> tuple[str, CachedResponse]:
+    """Serves 'body' under a URL naming its content hash, e.g. /static/editor.<hash>.js.
+
+    A new build gets new URLs, so browsers may keep each one indefinitely.
+    """
+    response = CachedResponse(body, content_type, 'max-age=31536000, immutable')
+    stem, ext = os.path.splitext(name)
+    return '/static/%s.%s%s' % (stem, response.etag.strip('"'), ext), response
+
+EDITOR_CSS_PATH, EDITOR_CSS_RESPONSE = static_asset(
+    'editor.css', EDITOR_CSS.encode('utf-8'), 'text/css; charset=utf-8')
+EDITOR_JS_PATH, EDITOR_JS_RESPONSE = static_asset(
+    'editor.js', EDITOR_JS.encode('utf-8'), 'text/javascript; charset=utf-8')
+
+STATIC_RESPONSES = {
+    EDITOR_CSS_PATH: EDITOR_CSS_RESPONSE,
+    EDITOR_JS_PATH: EDITOR_JS_RESPONSE,
+}
 
-        # Sort by key for easier viewing
-        sorted_songmap = sorted(songmap_data, key=lambda s: s['key'])
+def render_songmap_editor(songmap_data: list[JsonSongT]) -> str:
+    # Sort by key for easier viewing
+    sorted_songmap = sorted(songmap_data, key=lambda s: s['key'])
 
-        # Generate table rows for existing data
-        table_rows = ""
-        for i, song in enumerate(sorted_songmap):
-            table_rows += f"""
+    # Generate table rows for existing data
+    table_rows = []
+    for i, song in enumerate(sorted_songmap):
+        table_rows.append(f"""
             <tr id="row-{i}">
                 <td><input type="text" name="debugName_{i}" value="{song['debugName'].replace('"', '&quot;')}" style="width: 200px;"></td>
                 <td><input type="text" name="key_{i}" value="{song['key']}" style="width: 50px;" maxlength="1"></td>
@@ -373,27 +2357,19 @@ class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
                 </td>
                 <td><input type="text" name="payload_{i}" value="{song['payload'].replace('"', '&quot;')}" style="width: 400px;"></td>
                 <td><button type="button" onclick="removeRow({i})">Remove</button></td>
-            </tr>"""
+            </tr>""")
 
-        html = f"""<!DOCTYPE html>
+    return f"""<!DOCTYPE html>
 <html>
 <head>
     <title>Sonobo Songmap Editor</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 20px; }}
-        table {{ border-collapse: collapse; width: 100%; margin-top: 20px; }}
-        th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
-        th {{ background-color: #f2f2f2; }}
-        input, select {{ margin: 2px; }}
-        .nav {{ margin-bottom: 20px; }}
-        .controls {{ margin: 20px 0; }}
-        .controls button {{ margin: 5px; padding: 10px 15px; }}
-    </style>
+    <link rel="stylesheet" href="{EDITOR_CSS_PATH}">
+    <script src="{EDITOR_JS_PATH}"></script>
 </head>
 <body>
     <h1>Sonobo Songmap Editor</h1>
     <div class="nav">
-        <a href="/log">View Logs</a>
+        <a href="/log">View Logs</a> | <a href="/stats">Stats</a>
     </div>
 
     <form id="songmapForm" method="POST" action="/updatesongmap">
@@ -414,8 +2390,8 @@ class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
                     <th>Action</th>
                 </tr>
             </thead>
-            <tbody id="songTableBody">
-                {table_rows}
+            <tbody id="songTableBody" data-next-row-id="{len(songmap_data)}">
+                {''.join(table_rows)}
             </tbody>
         </table>
 
@@ -424,51 +2400,549 @@ class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
             <button type="submit">Save Songmap</button>
         </div>
     </form>
+</body>
+</html>"""
 
-    <script>
-        let nextRowId = {len(songmap_data)};
-
-        function addRow() {{
-            const tbody = document.getElementById('songTableBody');
-            const newRow = document.createElement('tr');
-            newRow.id = `row-${{nextRowId}}`;
-            newRow.innerHTML = `
-                <td><input type="text" name="debugName_${{nextRowId}}" value="" style="width: 200px;"></td>
-                <td><input type="text" name="key_${{nextRowId}}" value="" style="width: 50px;" maxlength="1"></td>
-                <td>
-                    <select name="kind_${{nextRowId}}" style="width: 150px;">
-                        <option value="SPOTIFY" selected>SPOTIFY</option>
-                        <option value="SONOS_PLAYLIST_NAME">SONOS_PLAYLIST_NAME</option>
-                    </select>
-                </td>
-                <td><input type="text" name="payload_${{nextRowId}}" value="" style="width: 400px;"></td>
-                <td><button type="button" onclick="removeRow(${{nextRowId}})">Remove</button></td>
-            `;
-            tbody.appendChild(newRow);
-            nextRowId++;
-            updateRowCount();
-        }}
-
-        function removeRow(rowId) {{
-            const row = document.getElementById(`row-${{rowId}}`);
-            if (row) {{
-                row.remove();
-                updateRowCount();
-            }}
-        }}
-
-        function updateRowCount() {{
-            const rows = document.getElementById('songTableBody').children.length;
-            document.getElementById('rowCount').value = rows;
-        }}
-    </script>
+def render_stats_page(rows: list[dict[str, typing.Any]]) -> str:
+    def ms(seconds: float) -> str:
+        if math.isnan(seconds):
+            # e.g. an action kind that only ever failed.
+            return '&ndash;'
+        return '&gt;%d ms' % (LATENCY_BUCKETS_SEC[-1] * 1000) if seconds == math.inf else '%.0f ms' % (seconds * 1000)
+
+    table_rows = []
+    for row in rows:
+        stages = ', '.join('%s %s' % (stage, ms(mean)) for stage, mean in row['stages'])
+        table_rows.append(f"""
+            <tr>
+                <td>{row['kind']}</td><td>{row['completed']}</td><td>{row['superseded']}</td><td>{row['errors']}</td>
+                <td>{ms(row['p50'])}</td><td>{ms(row['p95'])}</td><td>{ms(row['p99'])}</td><td>{ms(row['mean'])}</td>
+                <td>{stages}</td>
+            </tr>""")
+
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+    <title>Sonobo Stats</title>
+    <link rel="stylesheet" href="{EDITOR_CSS_PATH}">
+</head>
+<body>
+    <h1>Sonobo Stats</h1>
+    <div class="nav">
+        <a href="/">Songmap Editor</a> | <a href="/log">View Logs</a> | <a href="/metrics">Prometheus metrics</a>
+    </div>
+    <p>Latency is from keypress to the action completing. Quantiles are bucket upper bounds.</p>
+    <table>
+        <thead>
+            <tr>
+                <th>Action</th><th>Completed</th><th>Superseded</th><th>Errors</th>
+                <th>p50</th><th>p95</th><th>p99</th><th>Mean</th><th>Mean time per stage</th>
+            </tr>
+        </thead>
+        <tbody>
+            {''.join(table_rows)}
+        </tbody>
+    </table>
 </body>
 </html>"""
 
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+class SongmapEditorPage:
+    """The rendered editor page, re-rendered only when the songmap version changes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version: typing.Optional[int] = None
+        self.response: typing.Optional[CachedResponse] = None
+
+    def get(self, sonobo: Sonobo) -> CachedResponse:
+        version, songmap_data = sonobo.get_versioned_songmap_json()
+        with self.lock:
+            if self.response is not None and version == self.version:
+                return self.response
+        response = CachedResponse(render_songmap_editor(songmap_data).encode('utf-8'), 'text/html; charset=utf-8')
+        with self.lock:
+            self.version = version
+            self.response = response
+        return response
+
+def write_file_durably(filename: str, data: bytes) -> None:
+    """Atomically replaces 'filename' with 'data', surviving a power cut either way."""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_filename, filename)
+    fsync_directory(os.path.dirname(os.path.abspath(filename)))
+
+def fsync_directory(dirname: str) -> None:
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def songmap_by_key(songmap_json: list[JsonSongT]) -> dict[str, JsonSongT]:
+    # Later entries win, as in songmap_json_to_map.
+    return {song['key']: song for song in songmap_json}
+
+def songmap_changes(old_json: list[JsonSongT],
+                    new_json: list[JsonSongT]) -> dict[str, list[typing.Optional[JsonSongT]]]:
+    """Maps each key whose entry differs to its [old, new] entries (None if absent)."""
+    old = songmap_by_key(old_json)
+    new = songmap_by_key(new_json)
+    return {key: [old.get(key), new.get(key)] for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+
+def songmap_digest(songmap_json: list[JsonSongT]) -> str:
+    """Identifies the songmap's entries, regardless of their order."""
+    return hashlib.sha1(json.dumps(songmap_by_key(songmap_json), sort_keys=True).encode('utf-8')).hexdigest()
+
+def apply_songmap_changes(songmap_json: list[JsonSongT],
+                          changes: dict[str, typing.Optional[JsonSongT]]) -> list[JsonSongT]:
+    """'changes' maps a key to its new entry, or to None to remove it."""
+    result = []
+    pending = dict(changes)
+    for song in songmap_json:
+        if song['key'] not in changes:
+            result.append(song)
+        elif song['key'] in pending:
+            # Keep a replaced entry where it was.
+            replacement = pending.pop(song['key'])
+            if replacement is not None:
+                result.append(replacement)
+    result.extend(song for song in pending.values() if song is not None)
+    return result
+
+class SongmapStore:
+    """songmap.json, plus a journal of the changes that led up to it.
+
+    Each save appends one line to the journal, recording the old and new
+    value of just the entries that changed, so the journal grows with the
+    size of the edits rather than the size of the songmap. Only the last
+    max_entries saves are kept. Undoing journal entries from the current
+    songmap gets back any retained revision.
+    """
+    saved: list[JsonSongT]
+    journal: list[dict[str, typing.Any]]
+
+    def __init__(self, filename: str = SONGMAP_FILENAME, journal_filename: str = SONGMAP_JOURNAL_FILENAME,
+                 max_entries: int = SONGMAP_HISTORY_ENTRIES):
+        self.filename = filename
+        self.journal_filename = journal_filename
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.saved = []
+        self.journal = []
+
+    def load(self) -> list[JsonSongT]:
+        with open(self.filename) as infile:
+            songmap_json = json.load(infile)
+        journal = []
+        try:
+            with open(self.journal_filename) as infile:
+                for line in infile:
+                    try:
+                        journal.append(json.loads(line))
+                    except ValueError:
+                        # Most likely a line torn by a crash mid-append.
+                        log.info("Skipping bad line in %s", self.journal_filename)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.saved = songmap_json
+            self.journal = journal
+        return songmap_json
+
+    def revision(self) -> int:
+        with self.lock:
+            return self.journal[-1]['revision'] if self.journal else 0
+
+    def history(self) -> list[dict[str, typing.Any]]:
+        """Retained journal entries, oldest first."""
+        with self.lock:
+            return list(self.journal)
+
+    def matches_saved(self, songmap_json: list[JsonSongT]) -> bool:
+        with self.lock:
+            return songmap_json == self.saved
+
+    def unsaved_changes(self, songmap_json: list[JsonSongT]) -> dict[str, typing.Optional[JsonSongT]]:
+        """How 'songmap_json' differs from the last save, in apply_songmap_changes' terms."""
+        with self.lock:
+            return {key: change[1] for key, change in songmap_changes(self.saved, songmap_json).items()}
+
+    def save(self, songmap_json: list[JsonSongT], write_file: bool = True) -> int:
+        """Writes 'songmap_json' and journals how it differs from the last save. Returns its revision.
+
+        write_file=False just journals a change someone else already wrote.
+        """
+        with self.lock:
+            changes = songmap_changes(self.saved, songmap_json)
+            revision = (self.journal[-1]['revision'] if self.journal else 0) + 1
+            entry = {'revision': revision, 'time': time.time(), 'changes': changes,
+                     'digest': songmap_digest(songmap_json)}
+
+            if write_file:
+                write_file_durably(self.filename, json.dumps(songmap_json, indent=2).encode('utf-8'))
+            self.saved = songmap_json
+            self.journal.append(entry)
+            if len(self.journal) > 2 * self.max_entries:
+                # Rewrite rather than append now and then, to drop old history.
+                self.journal = self.journal[-self.max_entries:]
+                write_file_durably(self.journal_filename,
+                                   b''.join(json.dumps(e).encode('utf-8') + b'\n' for e in self.journal))
+            else:
+                with open(self.journal_filename, 'ab') as journal_file:
+                    journal_file.write(json.dumps(entry).encode('utf-8') + b'\n')
+                    journal_file.flush()
+                    os.fsync(journal_file.fileno())
+        log.info("Saved songmap revision %d (%d changed entries)", revision, len(changes))
+        return revision
+
+    def songmap_at(self, revision: int) -> list[JsonSongT]:
+        """The songmap as it was saved at 'revision', by undoing later journal entries.
+
+        Raises ValueError if that's no longer retained, and SongmapHistoryBroken
+        if the entries in between are missing (e.g. a torn line was skipped) or
+        don't lead to the current file (e.g. it was edited while we weren't
+        running).
+        """
+        with self.lock:
+            entries = {entry['revision']: entry for entry in self.journal}
+            current = self.journal[-1]['revision'] if self.journal else 0
+            oldest = min(entries, default=current + 1) - 1
+            if revision > current or revision < oldest:
+                raise ValueError('Songmap revision %d is not available (have %d to %d)' % (
+                    revision, oldest, current))
+            songmap_json = self.saved
+            for r in range(current, revision, -1):
+                entry = entries.get(r)
+                if entry is None:
+                    raise SongmapHistoryBroken('Songmap revision %d is missing from the journal' % r)
+                if not self.entry_led_to(entry, songmap_json):
+                    raise SongmapHistoryBroken("Songmap journal doesn't match the songmap as of revision %d" % r)
+                songmap_json = apply_songmap_changes(
+                    songmap_json, {key: change[0] for key, change in entry['changes'].items()})
+            return songmap_json
+
+    @staticmethod
+    def entry_led_to(entry: dict[str, typing.Any], songmap_json: list[JsonSongT]) -> bool:
+        """Whether saving journal 'entry' left the songmap as 'songmap_json'."""
+        if 'digest' in entry:
+            return entry['digest'] == songmap_digest(songmap_json)
+        # Older entries only say what became of the keys they changed.
+        by_key = songmap_by_key(songmap_json)
+        return all(by_key.get(key) == change[1] for key, change in entry['changes'].items())
+
+class SongmapWriter:
+    """Saves the songmap to a SongmapStore in the background.
+
+    Edits only mark the songmap dirty; a burst of them within delay_sec of
+    each other turns into a single write of the latest version.
+    """
+
+    def __init__(self, sonobo: Sonobo, store: SongmapStore, delay_sec: float = SONGMAP_WRITE_DELAY_SEC):
+        self.sonobo = sonobo
+        self.store = store
+        self.delay_sec = delay_sec
+        self.dirty = threading.Event()
+        self.write_lock = threading.Lock()
+        self.written_version, _ = sonobo.get_versioned_songmap_json()
+
+    def schedule(self) -> None:
+        self.dirty.set()
+
+    def flush(self) -> None:
+        """Writes the songmap now, if it has changed since we last wrote it."""
+        with self.write_lock:
+            version, songmap_json = self.sonobo.get_versioned_songmap_json()
+            if version == self.written_version:
+                return
+            self.store.save(songmap_json)
+            self.written_version = version
+
+    def install_from_disk(self, songmap_json: list[JsonSongT]) -> list[str]:
+        """Installs a songmap someone else wrote to the file, and journals it without rewriting it.
+
+        Edits we haven't written yet are kept, on top of the file's contents,
+        and written out as usual.
+        """
+        with self.write_lock:
+            while True:
+                version, current = self.sonobo.get_versioned_songmap_json()
+                pending = {} if version == self.written_version else self.store.unsaved_changes(current)
+                merged = apply_songmap_changes(songmap_json, pending)
+                try:
+                    problems = self.sonobo.update_code_to_song_map(merged, expected_version=version)
+                    break
+                except SongmapVersionMismatch:
+                    # Another edit came in meanwhile; take it along too.
+                    continue
+            self.store.save(songmap_json, write_file=False)
+            if merged == songmap_json:
+                self.written_version = version + 1
+            else:
+                self.schedule()
+        return problems
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name='sonobo-songmap-writer')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self) -> None:
+        while True:
+            self.dirty.wait()
+            # Let the rest of the burst arrive.
+            time.sleep(self.delay_sec)
+            self.dirty.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                log.warning("Could not save songmap: %s", e)
+
+@functools.lru_cache(maxsize=None)
+def libc() -> ctypes.CDLL:
+    # Loaded once; InputMultiplexer adds watches on every rescan.
+    return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+def open_inotify(dirname: str, mask: int = IN_CLOSE_WRITE | IN_MOVED_TO) -> typing.Optional[int]:
+    """An inotify fd watching 'dirname', or None if unavailable.
+
+    By default it watches for files written or renamed into the directory.
+    """
+    try:
+        fd = libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError) as e:
+        log.info("inotify unavailable: %s", e)
+        return None
+    if fd < 0:
+        log.info("inotify_init1 failed: %s", os.strerror(ctypes.get_errno()))
+        return None
+    if not add_inotify_watch(fd, dirname, mask):
+        os.close(fd)
+        return None
+    return fd
+
+def add_inotify_watch(fd: int, dirname: str, mask: int) -> bool:
+    if libc().inotify_add_watch(fd, os.fsencode(dirname), mask) < 0:
+        log.info("inotify_add_watch(%s) failed: %s", dirname, os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
+def inotify_event_names(data: bytes) -> list[str]:
+    names = []
+    offset = 0
+    while offset + INOTIFY_EVENT_STRUCT.size <= len(data):
+        _, _, _, name_len = INOTIFY_EVENT_STRUCT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT_STRUCT.size
+        names.append(os.fsdecode(data[offset:offset + name_len].rstrip(b'\0')))
+        offset += name_len
+    return names
+
+class SongmapWatcher:
+    """Reloads the songmap file when something other than us changes it.
+
+    Watches the directory with inotify, so editors and deploy tools that
+    rename a new file into place are noticed too. Falls back to polling the
+    file's stat every poll_sec if inotify isn't usable. A file that doesn't
+    parse or validate is logged and ignored, keeping the current songmap.
+    """
+
+    def __init__(self, writer: SongmapWriter, poll_sec: float = SONGMAP_POLL_SEC):
+        self.writer = writer
+        self.filename = writer.store.filename
+        self.poll_sec = poll_sec
+        self.stopped = threading.Event()
+        self.last_stat = self.stat()
+
+    def stat(self) -> typing.Optional[typing.Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def reload(self) -> bool:
+        """Installs the file's contents if they're new to us. Returns whether it did."""
+        try:
+            with open(self.filename) as infile:
+                songmap_json = json.load(infile)
+            if self.writer.store.matches_saved(songmap_json):
+                # Our own write, or no real change.
+                return False
+            problems = self.writer.install_from_disk(songmap_json)
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            log.warning("Keeping the current songmap, %s is unusable: %s", self.filename, e)
+            return False
+        log.info("Reloaded songmap from %s (%d problems)", self.filename, len(problems))
+        return True
+
+    def check(self) -> bool:
+        """Reloads if the file's stat has changed since we last looked."""
+        stat = self.stat()
+        if stat == self.last_stat:
+            return False
+        self.last_stat = stat
+        return stat is not None and self.reload()
+
+    def start(self) -> threading.Thread:
+        fd = open_inotify(os.path.dirname(os.path.abspath(self.filename)))
+        if fd is None:
+            log.info("Polling %s for changes every %ss", self.filename, self.poll_sec)
+        thread = threading.Thread(target=self.run, args=(fd,), name='sonobo-songmap-watcher')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self, fd: typing.Optional[int]) -> None:
+        if fd is None:
+            while not self.stopped.wait(self.poll_sec):
+                self.check()
+            return
+        basename = os.path.basename(self.filename)
+        try:
+            while not self.stopped.is_set():
+                # Time out now and then so close() takes effect.
+                readable, _, _ = select.select([fd], [], [], self.poll_sec)
+                if not readable:
+                    continue
+                try:
+                    data = os.read(fd, 4096)
+                except BlockingIOError:
+                    continue
+                if basename in inotify_event_names(data):
+                    self.reload()
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        self.stopped.set()
+
+class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
+    # Keep-alive, so a phone reloading the editor reuses its connection. That
+    # means every response needs a Content-Length; see _send().
+    protocol_version = 'HTTP/1.1'
+    # For reading a request; see handle() for idle keep-alive connections.
+    timeout = HTTP_REQUEST_TIMEOUT_SEC
+
+    def __init__(self, sonobo: Sonobo, log_index: LogIndex, log_stream: LogStreamHub,
+                 editor_page: SongmapEditorPage, songmap_writer: SongmapWriter, *args):
+        self.sonobo = sonobo
+        self.log_index = log_index
+        self.log_stream = log_stream
+        self.editor_page = editor_page
+        self.songmap_writer = songmap_writer
+        super().__init__(*args)
+
+    def _send(self, code: int, body: bytes, content_type: str = 'text/html',
+              headers: typing.Optional[dict[str, str]] = None, close: bool = False) -> None:
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if close:
+            # e.g. we didn't read the request body, so the connection is unusable.
+            self.send_header('Connection', 'close')
+            self.close_connection = True
         self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
+        self.wfile.write(body)
+
+    def handle(self) -> None:
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            # Wait for the next request with a shorter timeout, then give it
+            # the full one to arrive in.
+            self.connection.settimeout(HTTP_KEEPALIVE_IDLE_SEC)
+            try:
+                if not self.rfile.peek(1):
+                    return
+            except OSError:
+                return
+            self.connection.settimeout(self.timeout)
+            self.handle_one_request()
+
+    def do_GET(self) -> None:
+        log.info('do_GET %s', self.path)
+        if self.path == '/':
+            self._handle_songmap_editor()
+        elif self.path in STATIC_RESPONSES:
+            self._send_cached(STATIC_RESPONSES[self.path])
+        elif self.path == SONGMAP_API_PREFIX:
+            self._handle_get_songmap()
+        elif self.path == '/metrics':
+            self._send(200, self.sonobo.metrics.prometheus_text(self.sonobo.action_queue).encode('utf-8'),
+                       'text/plain; version=0.0.4; charset=utf-8')
+        elif self.path == '/stats':
+            self._send(200, render_stats_page(self.sonobo.metrics.summary()).encode('utf-8'))
+        elif self.path == SONGMAP_API_PREFIX + '/history':
+            self._send_json(200, self.songmap_writer.store.history())
+        elif self.path == '/log/stream':
+            self._handle_log_stream()
+        elif self.path == '/log/recent':
+            self._handle_recent_log()
+        elif self.path.startswith('/log'):
+            self._handle_log_request()
+        else:
+            self._send(404, b'')
+        log.info('do_GET done')
+
+    def _handle_songmap_editor(self) -> None:
+        self._send_cached(self.editor_page.get(self.sonobo))
+
+    def _send_cached(self, response: CachedResponse) -> None:
+        headers = {'ETag': response.etag, 'Cache-Control': response.cache_control}
+        if etag_matches(self.headers.get('If-None-Match') or '', response.etag):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        body = response.body
+        if response.gzipped is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            if accepts_encoding(self.headers.get('Accept-Encoding') or '', 'gzip'):
+                headers['Content-Encoding'] = 'gzip'
+                body = response.gzipped
+        self._send(200, body, response.content_type, headers)
+
+    def _handle_log_stream(self) -> None:
+        """Server-Sent Events: one 'data:' message per log line, as it is logged."""
+        # Each viewer ties up one of the server's threads for as long as it
+        # stays, so leave room for everything else.
+        subscriber = self.log_stream.subscribe(self.server.max_streams)
+        if subscriber is None:
+            self._send(503, b'Too many log viewers', headers={'Retry-After': '30'})
+            return
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.flush()
+            while not subscriber.dropped:
+                try:
+                    line = subscriber.lines.get(timeout=LOG_STREAM_KEEPALIVE_SEC)
+                    message = ''.join('data: %s\n' % part for part in line.split('\n')) + '\n'
+                except queue.Empty:
+                    message = ': keepalive\n\n'
+                self.wfile.write(message.encode('utf-8'))
+                self.wfile.flush()
+            log.info('Log stream viewer fell behind, disconnecting it')
+            self.wfile.write(b'event: dropped\ndata: \n\n')
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass
+        finally:
+            self.log_stream.unsubscribe(subscriber)
+
+    def _handle_recent_log(self) -> None:
+        content = '\n'.join(self.log_stream.recent_lines()).encode('utf-8')
+        self._send(200, content, 'text/plain; charset=utf-8')
 
     def _handle_log_request(self) -> None:
         # Parse query parameters
@@ -476,16 +2950,13 @@ class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
         query_params = urllib.parse.parse_qs(url_parts.query)
 
         # Configuration
-        lines_per_page = 100
+        lines_per_page = LOG_LINES_PER_PAGE
 
         # Get page number (default to last page)
         try:
-            total_lines = sum(1 for _ in open(self.log_filename, 'r'))
+            total_lines = self.log_index.update()
         except (IOError, OSError):
-            self.send_response(404)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b'<html><body>Log file not found</body></html>')
+            self._send(404, b'<html><body>Log file not found</body></html>')
             return
 
         total_pages = max(1, (total_lines + lines_per_page - 1) // lines_per_page)
@@ -500,14 +2971,7 @@ class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
 
         # Read the specific chunk of the file
         try:
-            with open(self.log_filename, 'r') as log_file:
-                lines = []
-                for i, line in enumerate(log_file):
-                    if i >= start_line and i < end_line:
-                        lines.append(line.rstrip('\n'))
-                    elif i >= end_line:
-                        break
-
+            lines = self.log_index.read_lines(start_line, end_line)
             log_content = '\n'.join(lines)
         except (IOError, OSError):
             log_content = "Error reading log file"
@@ -562,14 +3026,28 @@ class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
         </form>
         <a href="/" style="margin-left: 20px;">Back to Home</a>
     </div>
-    <div class="log-content">{log_content.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')}</div>
+    <div class="log-content" id="logContent">{log_content.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')}</div>
+
+    <script>
+        // On the last page, keep appending lines as they are logged.
+        if ({'true' if page >= total_pages else 'false'}) {{
+            const logContent = document.getElementById('logContent');
+            logContent.scrollTop = logContent.scrollHeight;
+            const stream = new EventSource('/log/stream');
+            stream.onmessage = (event) => {{
+                const atBottom = logContent.scrollTop + logContent.clientHeight >= logContent.scrollHeight - 5;
+                logContent.appendChild(document.createTextNode('\n' + event.data));
+                if (atBottom) {{
+                    logContent.scrollTop = logContent.scrollHeight;
+                }}
+            }};
+            stream.addEventListener('dropped', () => stream.close());
+        }}
+    </script>
 </body>
 </html>"""
 
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
+        self._send(200, html.encode('utf-8'))
 
     def do_POST(self) -> None:
         log.info('do_POST %s', self.path)
@@ -584,19 +3062,13 @@ class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
                 pdict[pkey] = bytes(pdict_str[pkey], 'utf-8')
 
             if ctype == 'multipart/form-data':
-                self.send_response(500)
-                self.send_header('content-type','text/html')
-                self.end_headers()
-                self.wfile.write('form-multipart not supported'.encode('utf-8'))
+                self._send(500, 'form-multipart not supported'.encode('utf-8'), close=True)
                 return
 #            postvars: dict[str, list[typing.Any]] = cgi.parse_multipart(self.rfile, pdict)
 #            log.info("songmap (multipart): %s\n" % postvars[b'songmap'])
 
             if ctype != 'application/x-www-form-urlencoded':
-                self.send_response(500)
-                self.send_header('content-type','text/html')
-                self.end_headers()
-                self.wfile.write(("unknown content type %s" % ctype).encode('utf-8'))
+                self._send(500, ("unknown content type %s" % ctype).encode('utf-8'), close=True)
                 return
 
             length: int = int(self.headers['content-length'])
@@ -640,27 +3112,138 @@ class SonoboHTTPHandler(http.server.SimpleHTTPRequestHandler):
 
                 log.debug("smap (tabular): %d songs reconstructed", len(songmap_json))
 
-            self.sonobo.update_code_to_song_map(songmap_json)
-
-            shutil.copyfile('songmap.json', 'songmap-%d.json' % time.time())
-
-            with open('songmap.tmp', 'w') as outfile:
-                json.dump(songmap_json, outfile, indent=2)
+            try:
+                problems = self.sonobo.update_code_to_song_map(songmap_json)
+            except ValueError as e:
+                log.info("Rejected songmap: %s", e)
+                self._send(400, str(e).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').encode('utf-8'))
+                return
 
-            shutil.move('songmap.tmp', 'songmap.json')
-            self.json_songmap = songmap_json
+            self.songmap_writer.flush()
 
-            self.send_response(200)
-            self.send_header('content-type','text/html')
-            self.end_headers()
-            self.wfile.write(b'OK')
+            response = 'OK'
+            for problem in problems:
+                problem = problem.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                response += '<br>WARNING: %s' % problem
+            self._send(200, response.encode('utf-8'))
             # TODO: error handling / sanity checking
+        elif self.path == SONGMAP_API_PREFIX + '/rollback':
+            self._handle_rollback()
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b'')
+            self._send(404, b'', close=True)
         log.info('do_POST done')
 
+    def _send_json(self, code: int, value: typing.Any, headers: typing.Optional[dict[str, str]] = None) -> None:
+        self._send(code, json.dumps(value).encode('utf-8'), 'application/json', headers)
+
+    def _handle_get_songmap(self) -> None:
+        version, songmap_json = self.sonobo.get_versioned_songmap_json()
+        self._send_json(200, {'version': version, 'songs': songmap_json}, {'ETag': '"%d"' % version})
+
+    def _api_key(self) -> typing.Optional[str]:
+        """The songmap key in an /api/songmap/<key> path, or None if it isn't one."""
+        if not self.path.startswith(SONGMAP_API_PREFIX + '/'):
+            self._send(404, b'', close=True)
+            return None
+        return urllib.parse.unquote(self.path[len(SONGMAP_API_PREFIX) + 1:])
+
+    def _expected_version(self) -> typing.Optional[int]:
+        """The songmap version from If-Match, or None to apply the edit unconditionally."""
+        if_match = self.headers.get('If-Match')
+        if if_match is None or if_match.strip() == '*':
+            return None
+        return int(if_match.strip().removeprefix('W/').strip('"'))
+
+    def _read_json_body(self) -> typing.Any:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length))
+
+    def _apply_song_edit(self, replace: bool) -> None:
+        key = self._api_key()
+        if key is None:
+            return
+        try:
+            fields = self._read_json_body()
+            expected_version = self._expected_version()
+            if not isinstance(fields, dict):
+                raise ValueError('Expected a JSON object')
+            if replace:
+                song = {'debugName': 'Song %s' % key}
+            else:
+                version, songmap_json = self.sonobo.get_versioned_songmap_json()
+                existing = [s for s in songmap_json if s['key'] == key]
+                if not existing:
+                    self._send_json(404, {'error': 'No songmap entry for "%s"' % key})
+                    return
+                song = dict(existing[-1])
+                # Without If-Match, don't let a concurrent edit slip in under our merge.
+                if expected_version is None:
+                    expected_version = version
+            song.update(fields)
+            song['key'] = key
+            for field in ('debugName', 'kind', 'payload'):
+                if not isinstance(song.get(field), str):
+                    raise ValueError('"%s" must be a string' % field)
+            version, problems = self.sonobo.put_song(typing.cast(JsonSongT, song), expected_version)
+        except SongmapVersionMismatch as e:
+            self._send_json(412, {'error': str(e)})
+            return
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError too.
+            log.info("Rejected songmap edit: %s", e)
+            self._send_json(400, {'error': str(e)})
+            return
+        self.songmap_writer.schedule()
+        self._send_json(200, {'version': version, 'problems': problems}, {'ETag': '"%d"' % version})
+
+    def _handle_rollback(self) -> None:
+        """Reinstalls the songmap as of {"revision": N}. The rollback is itself journaled."""
+        try:
+            revision = self._read_json_body()['revision']
+            if not isinstance(revision, int):
+                raise ValueError('"revision" must be an integer')
+            songmap_json = self.songmap_writer.store.songmap_at(revision)
+            problems = self.sonobo.update_code_to_song_map(songmap_json)
+        except SongmapHistoryBroken as e:
+            log.info("Refused songmap rollback: %s", e)
+            self._send_json(409, {'error': str(e)})
+            return
+        except (KeyError, TypeError, ValueError) as e:
+            log.info("Rejected songmap rollback: %s", e)
+            self._send_json(400, {'error': str(e)})
+            return
+        self.songmap_writer.flush()
+        version, _ = self.sonobo.get_versioned_songmap_json()
+        self._send_json(200, {'version': version, 'revision': self.songmap_writer.store.revision(),
+                              'problems': problems})
+
+    def do_PUT(self) -> None:
+        log.info('do_PUT %s', self.path)
+        self._apply_song_edit(replace=True)
+
+    def do_PATCH(self) -> None:
+        log.info('do_PATCH %s', self.path)
+        self._apply_song_edit(replace=False)
+
+    def do_DELETE(self) -> None:
+        log.info('do_DELETE %s', self.path)
+        key = self._api_key()
+        if key is None:
+            return
+        try:
+            version = self.sonobo.delete_song(key, self._expected_version())
+        except SongmapVersionMismatch as e:
+            self._send_json(412, {'error': str(e)})
+            return
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except KeyError:
+            self._send_json(404, {'error': 'No songmap entry for "%s"' % key})
+            return
+        self.songmap_writer.schedule()
+        self._send_json(200, {'version': version}, {'ETag': '"%d"' % version})
+
 def get_ip_address() -> str:
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.connect(("8.8.8.8", 80))
@@ -683,35 +3266,79 @@ def main() -> None:
     stdout_handler.setFormatter(formatter)
 
     log.setLevel(os.environ.get("LOGLEVEL", "INFO"))
-    log.addHandler(stdout_handler)
-    log.addHandler(file_handler)
-
-    log.info("discovering sonos...")
-    speakers = soco.discover()
-    for speaker in speakers:
-        log.info(" - %s", speaker.player_name)
-
-    log.info("Using 'Living Room'")
-    living_room_speaker = speaker_with_name(speakers, 'Living Room')
-
-    raw_songmap_contents = open('songmap.json')
-    json_songmap_contents: list[JsonSongT] = json.load(raw_songmap_contents)
-    key_code_to_song_map: dict[int, SongInfo]  = songmap_json_to_map(json_songmap_contents)
-    log.info("Song map (%s) has %d songs", 'songmap.json', len(key_code_to_song_map))
-    log.debug(key_code_to_song_map)
-
+    log_stream = LogStreamHub()
+    log_stream.setFormatter(formatter)
+
+    # Everything that formats or writes runs on the listener's thread.
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    log_listener = logging.handlers.QueueListener(
+        log_queue, stdout_handler, file_handler, log_stream, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    log.addHandler(DroppingQueueHandler(log_queue))
+
+    # Open the keyboards first, so keys pressed while we start up aren't lost.
+    input_devices = load_input_devices(INPUT_DEVICES_FILENAME)
+    log.info('reading input from %s', ', '.join('"%s"' % device['match'] for device in input_devices))
+    recorder = None
+    capture_filename = os.environ.get("INPUT_CAPTURE")
+    if capture_filename:
+        log.info('recording input to "%s"', capture_filename)
+        recorder = EventRecorder(capture_filename)
+    reader = InputMultiplexer(input_devices, recorder=recorder)
+    startup_input = StartupInputBuffer(reader).start()
+
+    cached_speakers = load_speaker_cache(SPEAKER_CACHE_FILENAME)
+    speakers = speakers_from_cache(cached_speakers)
+    living_room_speaker = verify_cached_speaker(speakers, cached_speakers, LIVING_ROOM)
+    started_from_cache = living_room_speaker is not None
+    if started_from_cache:
+        log.info("Using %d cached speakers, rediscovering in the background", len(speakers))
+    else:
+        log.info("discovering sonos...")
+        living_room_speaker, speakers = discover_speakers(LIVING_ROOM)
+        save_speaker_cache(SPEAKER_CACHE_FILENAME, speakers)
+
+    log.info("Using '%s'", LIVING_ROOM)
+
+    songmap_store = SongmapStore()
+    json_songmap_contents: list[JsonSongT] = songmap_store.load()
     sonobo = Sonobo(json_songmap_contents, living_room_speaker, speakers, Clock())
-
-    HTTP_PORT = 8080
+    log.info("Song map (%s) has %d songs", SONGMAP_FILENAME, len(sonobo.key_code_to_song_map))
+    log.debug(sonobo.key_code_to_song_map)
+
+    if started_from_cache:
+        discovery_thread = threading.Thread(
+            target=rediscover, args=(sonobo, SPEAKER_CACHE_FILENAME), name='sonobo-discovery')
+        discovery_thread.daemon = True
+        discovery_thread.start()
+
+    log_index = LogIndex(LIVE_LOG_FILENAME)
+    editor_page = SongmapEditorPage()
+    songmap_writer = SongmapWriter(sonobo, songmap_store)
+    songmap_writer.start()
+    SongmapWatcher(songmap_writer).start()
     def hwrapper(*args):
-        SonoboHTTPHandler(sonobo, LIVE_LOG_FILENAME, *args)
-    server = http.server.HTTPServer(('0.0.0.0', HTTP_PORT), hwrapper)
-    server_thread = threading.Thread(target=server.serve_forever)
+        SonoboHTTPHandler(sonobo, log_index, log_stream, editor_page, songmap_writer, *args)
+    server = PooledHTTPServer(('0.0.0.0', HTTP_PORT), hwrapper)
+    server_thread = threading.Thread(target=server.serve_forever, name='sonobo-http-accept')
     server_thread.daemon = True
     server_thread.start()
     log.info("HTTPServer running: http://%s:%d", get_ip_address(), HTTP_PORT)
+
+    # Turn SIGTERM into SystemExit so we get to shut down the web server.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     log.info("Sonobo initializing...")
-    sonobo.loop()
+    try:
+        with reader:
+            sonobo.loop(reader, startup_input.finish())
+    finally:
+        log.info("Shutting down web server")
+        server.shutdown()
+        log_stream.disconnect_all()
+        server.server_close()
+        songmap_writer.flush()
 
     log.info("Exiting.")
 
@@ -0,0 +1,243 @@
+# Latency benchmarks for the dispatch path, against simulated slow speakers.
+#
+# Runs scripted key sequences through Sonobo.dispatch using the fakes from
+# sonobo_fakes, on a simulated clock: speaker calls "take" their injected
+# latency without really sleeping, and keypresses are delivered when the
+# simulated time reaches them (including while an action is in progress).
+# Results only depend on the options and the seed, so they are comparable
+# across machines, apart from the CPU-time throughput figure.
+#
+#   python sonobo_bench.py --latency-ms 80 --jitter-ms 40 --output bench_output.txt
+
+import argparse
+import collections
+import json
+import logging
+import sys
+import time
+import typing
+
+import sonobo
+import sonobo_fakes
+
+ROOMS = ['Move', 'Kitchen', 'Bedroom', 'Office']
+
+# (offset in seconds, key code, value) as they'd come from the keyboard.
+ScriptT = list[typing.Tuple[float, int, int]]
+
+def song_key(key: str) -> int:
+    return sonobo.KEY_STRING_TO_CODE_MAP[key]
+
+def rapid_song_switching() -> ScriptT:
+    keys = [song_key('A'), song_key('C')]
+    return [(i * 0.05, keys[i % 2], 1) for i in range(20)]
+
+def held_volume() -> ScriptT:
+    # dispatch() only acts on presses (value 1), so a held key is modelled as
+    # presses at a typical autorepeat rate, up and then back down.
+    return ([(i * 0.03, sonobo.KEY_UP, 1) for i in range(25)] +
+            [(0.75 + i * 0.03, sonobo.KEY_DOWN, 1) for i in range(10)])
+
+def play_pause_mashing() -> ScriptT:
+    return [(i * 0.08, sonobo.KEY_SPACE, 1) for i in range(15)]
+
+def grouping_storm() -> ScriptT:
+    keys = [sonobo.KEY_M, sonobo.KEY_A, sonobo.KEY_U, sonobo.KEY_M, sonobo.KEY_U,
+            sonobo.KEY_M, sonobo.KEY_A, sonobo.KEY_U]
+    script = [(0.0, sonobo.KEY_LEFTSHIFT, 1)]
+    script += [(0.01 + i * 0.1, key, 1) for i, key in enumerate(keys)]
+    script.append((0.02 + len(keys) * 0.1, sonobo.KEY_LEFTSHIFT, 0))
+    return script
+
+SCENARIOS: dict[str, typing.Callable[[], ScriptT]] = {
+    'rapid_song_switching': rapid_song_switching,
+    'held_volume': held_volume,
+    'play_pause_mashing': play_pause_mashing,
+    'grouping_storm': grouping_storm,
+}
+
+def last_press(script: ScriptT) -> float:
+    return max(when for when, _, value in script if value == 1)
+
+class SimulatedClock(sonobo_fakes.FakeClock):
+    """FakeClock that delivers scripted keypresses as time passes over them."""
+
+    def __init__(self):
+        super().__init__()
+        self.sonobo: typing.Optional[sonobo.Sonobo] = None
+        self.pending: collections.deque[typing.Tuple[float, int, int]] = collections.deque()
+
+    def script(self, s: sonobo.Sonobo, script: ScriptT) -> None:
+        self.sonobo = s
+        self.pending = collections.deque(sorted(script))
+
+    def advance(self, delta):
+        target = self.current_timestamp + delta
+        while self.pending and self.pending[0][0] <= target:
+            when, code, value = self.pending.popleft()
+            self.current_timestamp = max(self.current_timestamp, when)
+            self.sonobo.dispatch(sonobo.EV_KEY, code, value, when)
+        self.current_timestamp = max(self.current_timestamp, target)
+
+    def advance_to_next_event(self) -> None:
+        self.advance(max(0.0, self.pending[0][0] - self.current_timestamp))
+
+class SimulatedFanOut(sonobo.SpeakerFanOut):
+    """Runs the operations one at a time, but only charges the clock for the
+    slowest, as if they had run concurrently like the real fan-out."""
+
+    def __init__(self, clock: SimulatedClock):
+        super().__init__(max_workers=1)
+        self.clock = clock
+
+    def run(self, description, speakers, operation, name_of=repr):
+        start = self.clock.current_timestamp
+        end = start
+        results = {}
+        for speaker in speakers:
+            self.clock.current_timestamp = start
+            try:
+                operation(speaker)
+                results[name_of(speaker)] = None
+            except Exception as e:
+                results[name_of(speaker)] = e
+            end = max(end, self.clock.current_timestamp)
+        self.clock.current_timestamp = end
+        return results
+
+class RunResult:
+    def __init__(self):
+        self.time_to_final_state = 0.0
+        self.latencies: list[float] = []
+        self.completed = 0
+        self.superseded = 0
+        self.errors = 0
+        self.dropped = 0
+        self.calls: collections.Counter[str] = collections.Counter()
+
+def simulate(script: ScriptT, latency_sec: float, jitter_sec: float, failure_rate: float,
+             seed: int) -> RunResult:
+    """Plays 'script' against one fresh household, and works through the actions it causes."""
+    clock = SimulatedClock()
+    faults = sonobo_fakes.FaultInjector(clock, latency_sec, jitter_sec, failure_rate, seed)
+    living_room = sonobo_fakes.FakeSpeaker(faults)
+    rooms = [sonobo_fakes.FakeRoomSpeaker(name, faults) for name in ROOMS]
+    s = sonobo.Sonobo(json.loads(sonobo_fakes.TWO_SONG_RAW_SONG_MAP), living_room, [living_room] + rooms, clock)
+    s.fan_out = SimulatedFanOut(clock)
+    s.action_queue = sonobo.ActionQueue()
+    s.action_queue.on_drop = s.abandoned
+    clock.script(s, script)
+
+    result = RunResult()
+    finished_at = 0.0
+    while True:
+        action = s.action_queue.get(0)
+        if action is None:
+            if not clock.pending:
+                break
+            clock.advance_to_next_event()
+            continue
+        try:
+            s.execute(action)
+        except Exception:
+            # As run_actions() would.
+            s.state.invalidate()
+            result.errors += 1
+        else:
+            if any(stage == 'superseded' for stage, _ in action.stages):
+                result.superseded += 1
+            else:
+                result.completed += 1
+                result.latencies.append(action.stages[-1][1] - action.stages[0][1])
+        finished_at = clock.current_timestamp
+    result.time_to_final_state = max(0.0, finished_at - last_press(script))
+    result.dropped = s.action_queue.dropped
+    result.calls = faults.calls
+    return result
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    """p50/p95/p99 (nearest rank) in milliseconds."""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    def rank(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+    return {'p50': rank(0.5), 'p95': rank(0.95), 'p99': rank(0.99), 'max': round(ordered[-1] * 1000, 3)}
+
+def run_scenario(name: str, runs: int, latency_sec: float, jitter_sec: float, failure_rate: float,
+                 seed: int) -> dict[str, typing.Any]:
+    script = SCENARIOS[name]()
+    keypresses = sum(1 for _, code, value in script if value == 1 and code != sonobo.KEY_LEFTSHIFT)
+    results = []
+    cpu_start = time.process_time()
+    for run in range(runs):
+        results.append(simulate(script, latency_sec, jitter_sec, failure_rate, seed + run))
+    cpu_sec = time.process_time() - cpu_start
+
+    calls: collections.Counter[str] = collections.Counter()
+    for result in results:
+        calls.update(result.calls)
+    simulated_sec = sum(last_press(script) + r.time_to_final_state for r in results)
+    completed = sum(r.completed for r in results)
+    return {
+        'runs': runs,
+        'keypresses_per_run': keypresses,
+        'time_to_final_state_ms': percentiles([r.time_to_final_state for r in results]),
+        'action_latency_ms': percentiles([latency for r in results for latency in r.latencies]),
+        'actions': {
+            'completed': completed,
+            'superseded': sum(r.superseded for r in results),
+            'errors': sum(r.errors for r in results),
+            'dropped': sum(r.dropped for r in results),
+        },
+        'speaker_calls': {
+            'total': sum(calls.values()),
+            'per_run': round(sum(calls.values()) / runs, 2),
+            'by_call': dict(sorted(calls.items())),
+        },
+        'throughput': {
+            # Actions completed per second of simulated time.
+            'actions_per_sec': round(completed / simulated_sec, 2) if simulated_sec else 0.0,
+            # How much keypress traffic this machine's CPU gets through; not deterministic.
+            'keypresses_per_cpu_sec': round(keypresses * runs / cpu_sec) if cpu_sec else None,
+        },
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Latency benchmarks for sonobo against simulated slow speakers.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run (repeatable, default: all)')
+    parser.add_argument('--runs', type=int, default=200, help='runs per scenario')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='base latency of each speaker call')
+    parser.add_argument('--jitter-ms', type=float, default=30.0, help='extra random latency, up to this much')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of speaker calls that fail')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    # Only warnings, on stderr; stdout is for the report.
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    report = {
+        'config': {
+            'runs': args.runs,
+            'latency_ms': args.latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'failure_rate': args.failure_rate,
+            'seed': args.seed,
+        },
+        'scenarios': {},
+    }
+    for name in args.scenario or SCENARIOS:
+        report['scenarios'][name] = run_scenario(
+            name, args.runs, args.latency_ms / 1000, args.jitter_ms / 1000, args.failure_rate, args.seed)
+
+    output = json.dumps(report, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(output)
+    else:
+        sys.stdout.write(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# Stand-ins for soco speakers and a clock, for exercising Sonobo without a
+# Sonos household: used by the unit tests, sonobo_bench.py and sonobo_replay.py.
+
+import collections
+import random
+
+import sonobo
+
+class FakeSubscription:
+    def __init__(self):
+        self.is_subscribed = True
+        self.time_left = 600
+
+    def unsubscribe(self):
+        self.is_subscribed = False
+
+class FakeService:
+    def subscribe(self, requested_timeout=None, auto_renew=False):
+        return FakeSubscription()
+
+class FaultInjector:
+    """Makes calls on the fakes slow, jittery or failing, reproducibly for a given seed.
+
+    Latency is spent on 'clock', so with a FakeClock nothing really sleeps.
+    """
+    def __init__(self, clock, latency_sec=0.0, jitter_sec=0.0, failure_rate=0.0, seed=0):
+        self.clock = clock
+        self.latency_sec = latency_sec
+        self.jitter_sec = jitter_sec
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.failures = 0
+
+    def call(self, name):
+        self.calls[name] += 1
+        self.clock.sleep(self.latency_sec + self.random.uniform(0, self.jitter_sec))
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            raise sonobo.soco.exceptions.SoCoException('injected failure in %s' % name)
+
+class FakeAvTransport(FakeService):
+    def __init__(self, faults=None):
+        self.faults = faults
+        self.update_id = 0
+
+    def AddURIToQueue(self, args=None):
+        if self.faults is not None:
+            self.faults.call('AddURIToQueue')
+        self.update_id += 1
+        return {'NewUpdateID': str(self.update_id)}
+
+class FakeEvent:
+    def __init__(self, variables):
+        self.variables = variables
+
+class FakeCoordinator:
+    playing = False
+    volume = 10
+
+    def __init__(self, faults=None):
+        self.playing = False
+        self.faults = faults
+        self.avTransport = FakeAvTransport(faults)
+        self.renderingControl = FakeService()
+        self.zoneGroupTopology = FakeService()
+        self.contentDirectory = FakeService()
+
+    def call(self, name):
+        if self.faults is not None:
+            self.faults.call(name)
+
+    def partymode(self):
+        self.call('partymode')
+
+    def get_sonos_playlists(self, complete_result=False):
+        self.call('get_sonos_playlists')
+        return [fake_playlist('Bedtime', 1), fake_playlist('Dance Party', 2)]
+
+    def get_current_transport_info(self):
+        self.call('get_current_transport_info')
+        return {'current_transport_state': 'PLAYING' if self.playing else 'STOPPED'}
+
+    def play(self):
+        self.call('play')
+        self.playing = True
+
+    def pause(self):
+        self.call('pause')
+        self.playing = False
+
+    def next(self):
+        self.call('next')
+
+    def previous(self):
+        self.call('previous')
+
+    def play_from_queue(self, index):
+        self.play()
+
+    def clear_queue(self):
+        self.call('clear_queue')
+
+    def set_relative_volume(self, delta):
+        self.call('set_relative_volume')
+        self.volume = self.volume + delta
+        return self.volume
+
+def fake_playlist(title, number):
+    return sonobo.soco.data_structures.DidlPlaylistContainer(
+        title, 'SQ:', 'SQ:%d' % number,
+        resources=[sonobo.soco.data_structures.DidlResource(
+            'file:///jffs/settings/savedqueues.rsq#%d' % number, 'x-rincon-playlist:*:*:*')])
+
+class FakeGroup:
+    def __init__(self, faults=None, coordinator=None):
+        self.coordinator = coordinator if coordinator is not None else FakeCoordinator(faults)
+
+class FakeSpeaker:
+    player_name = 'Living Room'
+
+    def __init__(self, faults=None):
+        self.group = FakeGroup(faults)
+
+class FakeRoomSpeaker(FakeCoordinator):
+    """A speaker that coordinates its own group until it joins another."""
+    def __init__(self, name, faults=None):
+        super().__init__(faults)
+        self.player_name = name
+        self.group = FakeGroup(coordinator=self)
+
+    def join(self, coordinator):
+        self.call('join')
+        self.group = FakeGroup(coordinator=coordinator)
+
+    def unjoin(self):
+        self.call('unjoin')
+        self.group = FakeGroup(coordinator=self)
+
+ONE_SONG_RAW_SONG_MAP = """[
+   {
+        "debugName": "Atencion Atencion - Que Pasa Con La Music",
+        "key": "A",
+        "kind": "SPOTIFY",
+        "payload": "https://open.spotify.com/track/payload"
+    }
+]"""
+
+TWO_SONG_RAW_SONG_MAP = """[
+   {
+        "debugName": "Song A",
+        "key": "A",
+        "kind": "SPOTIFY",
+        "payload": "https://open.spotify.com/track/payload_a"
+    },
+   {
+        "debugName": "Song C",
+        "key": "C",
+        "kind": "SPOTIFY",
+        "payload": "https://open.spotify.com/track/payload_c"
+    }
+]"""
+
+PLAYLIST_RAW_SONG_MAP = """[
+   {
+        "debugName": "Bedtime",
+        "key": "B",
+        "kind": "SONOS_PLAYLIST_NAME",
+        "payload": "Bedtime"
+    }
+]"""
+
+class FakeClock(sonobo.Clock):
+    def __init__(self):
+        self.current_timestamp = 0.0
+
+    def advance(self, delta):
+        self.current_timestamp = self.current_timestamp + delta
+
+    def now_ts(self):
+        return self.current_timestamp
+
+    def monotonic(self):
+        return self.current_timestamp
+
+    def wall_time(self):
+        return self.current_timestamp
+
+    def sleep(self, seconds):
+        self.advance(seconds)
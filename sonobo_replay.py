@@ -0,0 +1,104 @@
+# Replays an input capture (see INPUT_CAPTURE / EventRecorder) through Sonobo.dispatch.
+#
+# By default the capture is played against the fake coordinator from
+# sonobo_fakes, optionally made slow with --latency-ms/--jitter-ms; with
+# --speaker it goes to a real Sonos speaker instead. --fast feeds the events
+# as fast as they're taken instead of at their recorded pace.
+#
+#   python sonobo_replay.py sonobo-input.bin
+#   python sonobo_replay.py --fast --latency-ms 80 sonobo-input.bin
+#   python sonobo_replay.py --speaker 'Living Room' sonobo-input.bin
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import sonobo
+import sonobo_fakes
+
+log = logging.getLogger("sonobo")
+
+def connect(name: str):
+    """The speaker named 'name' and all speakers, from the speaker cache if it's still good."""
+    cached_speakers = sonobo.load_speaker_cache(sonobo.SPEAKER_CACHE_FILENAME)
+    speakers = sonobo.speakers_from_cache(cached_speakers)
+    speaker = sonobo.verify_cached_speaker(speakers, cached_speakers, name)
+    if speaker is None:
+        speaker, speakers = sonobo.discover_speakers(name)
+    return speaker, speakers
+
+def fake_household(latency_sec: float, jitter_sec: float, seed: int):
+    faults = sonobo_fakes.FaultInjector(sonobo.Clock(), latency_sec, jitter_sec, seed=seed)
+    speaker = sonobo_fakes.FakeSpeaker(faults)
+    return speaker, [speaker], faults
+
+def replay(s: sonobo.Sonobo, events: list[sonobo.InputEventT], fast: bool) -> float:
+    """Dispatches 'events', then waits for the actions they cause. Returns the seconds taken."""
+    if not events:
+        return 0.0
+    action_queue = sonobo.ActionQueue()
+    worker = s.start_worker(action_queue)
+    start = time.time()
+    # Move the capture to now, so latencies measured from the kernel
+    # timestamps mean something. With 'fast', the gaps between events still
+    # matter (e.g. for fast-repeat detection), so the whole capture is put
+    # just in the past: only the stages after 'submitted' are real then.
+    shift = start - events[-1 if fast else 0][3]
+    for typet, code, value, timestamp in events:
+        when = timestamp + shift
+        if not fast:
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        s.dispatch(typet, code, value, when)
+    action_queue.close()
+    worker.join()
+    return time.time() - start
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replay an input capture through sonobo.')
+    parser.add_argument('capture', help='capture file; its rotated backups (.1, .2, ...) are played first')
+    parser.add_argument('--fast', action='store_true', help="don't wait between events")
+    parser.add_argument('--speaker', help='play against this real speaker rather than a fake one')
+    parser.add_argument('--songmap', default=sonobo.SONGMAP_FILENAME)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency of each fake speaker call')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='extra random latency of fake speaker calls')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="[%(levelname).1s%(asctime)s.%(msecs)03d] %(message)s",
+                        datefmt="%Y%m%d %H:%M:%S", stream=sys.stderr)
+    log.setLevel(logging.WARNING)
+
+    paths = sonobo.capture_files(args.capture)
+    if not paths:
+        sys.exit('No capture at "%s"' % args.capture)
+    events = sonobo.read_capture(paths)
+
+    faults = None
+    if args.speaker:
+        speaker, speakers = connect(args.speaker)
+    else:
+        speaker, speakers, faults = fake_household(args.latency_ms / 1000, args.jitter_ms / 1000, args.seed)
+    with open(args.songmap) as songmap_file:
+        s = sonobo.Sonobo(json.load(songmap_file), speaker, speakers, sonobo.Clock())
+
+    elapsed = replay(s, events, args.fast)
+    keypresses = sum(1 for typet, _, value, _ in events if typet == sonobo.EV_KEY and value == 1)
+    report = {
+        'files': paths,
+        'events': len(events),
+        'keypresses': keypresses,
+        'captured_sec': round(events[-1][3] - events[0][3], 3) if events else 0.0,
+        'replay_sec': round(elapsed, 3),
+        'keypresses_per_sec': round(keypresses / elapsed, 2) if elapsed else None,
+        'actions': s.metrics.summary(),
+    }
+    if faults is not None:
+        report['speaker_calls'] = dict(sorted(faults.calls.items()))
+    sys.stdout.write(json.dumps(report, indent=2) + '\n')
+
+if __name__ == "__main__":
+    main()
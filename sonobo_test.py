@@ -1,71 +1,48 @@
+import gzip
+import http.client
 import json
 import logging
+import math
+import os
+import queue
+import socket
 import sys
+import tempfile
+import threading
+import time
 import unittest
 import unittest.mock
 import urllib.parse
 
 import sonobo
+from sonobo_fakes import (
+    FakeClock, FakeCoordinator, FakeEvent, FakeGroup, FakeRoomSpeaker, FakeSpeaker, FaultInjector,
+    ONE_SONG_RAW_SONG_MAP, PLAYLIST_RAW_SONG_MAP, TWO_SONG_RAW_SONG_MAP)
 
 logger = logging.getLogger()
 logger.level = logging.DEBUG
 stream_handler = logging.StreamHandler(sys.stdout)
 logger.addHandler(stream_handler)
 
-class FakeAvTransport:
-    def AddURIToQueue(self):
-        pass
-
-class FakeCoordinator:
-    playing = False
-    volume = 10
-
-    def __init__(self):
-        self.playing = False
-        self.avTransport = FakeAvTransport()
-
-    def get_current_transport_info(self):
-        return {'current_transport_state': 'PLAYING' if self.playing else 'STOPPED'}
-
-    def play(self):
-        self.playing = True
-
-    def pause(self):
-        self.playing = False
-
-    def clear_queue(self):
-        pass
-
-    def set_relative_volume(self, delta):
-        self.volume = self.volume + delta
-
-class FakeGroup:
+class CountingSpeaker(FakeSpeaker):
+    """Counts how often the (potentially network-backed) group is looked up."""
     def __init__(self):
-        self.coordinator = FakeCoordinator()
-
-
-class FakeSpeaker:
-    def __init__(self):
-        self.group = FakeGroup()
-
-ONE_SONG_RAW_SONG_MAP = """[
-   {
-        "debugName": "Atencion Atencion - Que Pasa Con La Music",
-        "key": "A",
-        "kind": "SPOTIFY",
-        "payload": "https://open.spotify.com/track/payload"
-    }
-]"""
+        self._group = FakeGroup()
+        self.group_lookups = 0
 
-class FakeClock(sonobo.Clock):
-    def __init__(self):
-        self.current_timestamp = 0.0
+    @property
+    def group(self):
+        self.group_lookups += 1
+        return self._group
 
-    def advance(self, delta):
-        self.current_timestamp = self.current_timestamp + delta
+class UnreachableSpeaker(FakeSpeaker):
+    """A speaker whose zone group state cannot be fetched."""
+    def __init__(self, name):
+        self.player_name = name
 
-    def now_ts(self):
-        return self.current_timestamp
+    @property
+    def group(self):
+        raise OSError('No route to host')
 
 class TestSonobo(unittest.TestCase):
     def setUp(self):
@@ -86,7 +63,7 @@ class TestSonobo(unittest.TestCase):
         speaker.group.coordinator.play = unittest.mock.MagicMock(wraps=speaker.group.coordinator.play)
 
         songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
-        s = sonobo.Sonobo(songmap_json, speaker, self.fake_clock)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
 
         s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['A'], 1, 0.0)
 
@@ -104,7 +81,7 @@ class TestSonobo(unittest.TestCase):
         speaker.group.coordinator.play = unittest.mock.MagicMock(wraps=speaker.group.coordinator.play)
 
         songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
-        s = sonobo.Sonobo(songmap_json, speaker, self.fake_clock)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
 
         # Press A twice, with a delay just under the threshold
         s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['A'], 1, 0.0)
@@ -123,7 +100,7 @@ class TestSonobo(unittest.TestCase):
         speaker.group.coordinator.pause = unittest.mock.MagicMock(wraps=speaker.group.coordinator.pause)
 
         songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
-        s = sonobo.Sonobo(songmap_json, speaker, self.fake_clock)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
 
         s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
         speaker.group.coordinator.play.assert_called_once()
@@ -139,10 +116,146 @@ class TestSonobo(unittest.TestCase):
         speaker.group.coordinator.play.assert_called_once()
         speaker.group.coordinator.pause.assert_called_once()
 
+    def test_play_pause_uses_events(self):
+        speaker = FakeSpeaker()
+        speaker.group.coordinator.get_current_transport_info = unittest.mock.MagicMock()
+        speaker.group.coordinator.play = unittest.mock.MagicMock()
+        speaker.group.coordinator.pause = unittest.mock.MagicMock()
+
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        s.state.subscribe(speaker.group.coordinator)
+
+        # Someone started playback from the Sonos app.
+        s.state.on_event(FakeEvent({'transport_state': 'PLAYING', 'volume': {'Master': '7'}}))
+        self.fake_clock.advance(sonobo.TRANSPORT_STATE_TTL_SEC + 1.0)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        speaker.group.coordinator.pause.assert_called_once()
+        speaker.group.coordinator.get_current_transport_info.assert_not_called()
+        self.assertEqual(7, s.volume.volume)
+
+        # Without events, the cached state expires and we poll again.
+        s.state.unsubscribe()
+        self.fake_clock.advance(sonobo.TRANSPORT_STATE_TTL_SEC + 1.0)
+        speaker.group.coordinator.get_current_transport_info.return_value = {'current_transport_state': 'STOPPED'}
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        speaker.group.coordinator.get_current_transport_info.assert_called_once()
+        speaker.group.coordinator.play.assert_called_once()
+
+    def test_topology_is_cached_until_grouping_changes(self):
+        speaker = CountingSpeaker()
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 0.0)
+        self.assertEqual(1, speaker.group_lookups)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_LEFTSHIFT, 1, 0.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_A, 1, 0.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_LEFTSHIFT, 0, 0.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        self.assertEqual(2, speaker.group_lookups)
+
+        # A ZoneGroupTopology event also invalidates it.
+        s.topology.invalidate(FakeEvent({}))
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        self.assertEqual(3, speaker.group_lookups)
+
+    def test_topology_expires_without_events(self):
+        speaker = CountingSpeaker()
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        self.assertEqual(1, speaker.group_lookups)
+
+        # Someone may have regrouped us from the Sonos app.
+        self.fake_clock.advance(sonobo.TOPOLOGY_TTL_SEC + 1.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        self.assertEqual(2, speaker.group_lookups)
+
+        # With events flowing, we'd hear about it.
+        s.topology.events_flowing = lambda: True
+        self.fake_clock.advance(sonobo.TOPOLOGY_TTL_SEC + 1.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        self.assertEqual(2, speaker.group_lookups)
+
+    def test_ungrouped_speaker_is_not_cached(self):
+        speaker = FakeSpeaker()
+        group = speaker.group
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+
+        speaker.group = None
+        with self.assertRaises(sonobo.soco.exceptions.SoCoException):
+            s.coordinator()
+        speaker.group = group
+        self.assertIs(group.coordinator, s.coordinator())
+
+    def test_failed_action_invalidates_topology(self):
+        speaker = CountingSpeaker()
+        speaker._group.coordinator.play = unittest.mock.MagicMock(
+            side_effect=sonobo.soco.exceptions.SoCoException('not coordinator'))
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+        s.topology.events_flowing = lambda: True
+        action_queue = sonobo.ActionQueue()
+
+        worker = s.start_worker(action_queue)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 1.0)
+        action_queue.close()
+        worker.join(1.0)
+        self.assertFalse(worker.is_alive())
+        # Looked up again after the failure, even though it hadn't expired.
+        self.assertEqual(2, speaker.group_lookups)
+
+    def test_unreachable_speaker_only_affects_grouping(self):
+        speaker = FakeSpeaker()
+        kitchen = FakeRoomSpeaker('Kitchen')
+        move = UnreachableSpeaker('Move')
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker, move, kitchen], self.fake_clock)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        self.assertTrue(speaker.group.coordinator.playing)
+
+        self.assertIs(kitchen, s.topology.speaker_named('Kitchen'))
+        self.assertIsNone(s.topology.speaker_named('Move'))
+        self.assertIsNone(s.topology.resolve()[move])
+
+        # Our own speaker is still required.
+        s.topology = sonobo.Topology(UnreachableSpeaker('Living Room'), [kitchen], self.fake_clock)
+        with self.assertRaises(OSError):
+            s.topology.coordinator()
+
+    def test_ungroup_all_runs_concurrently(self):
+        living_room = FakeSpeaker()
+        others = []
+        unjoined = []
+        barrier = threading.Barrier(3, timeout=2.0)
+        for name in ('Kitchen', 'Move', 'Office'):
+            speaker = FakeSpeaker()
+            speaker.player_name = name
+            speaker.group = living_room.group
+            # Every unjoin waits for the other two: this only finishes if
+            # they run at the same time.
+            speaker.unjoin = unittest.mock.MagicMock(side_effect=lambda: unjoined.append(barrier.wait()))
+            others.append(speaker)
+
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, living_room, [living_room] + others, self.fake_clock)
+        self.assertIs(others[1], s.speaker_with_name('Move'))
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_LEFTSHIFT, 1, 0.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_U, 1, 0.0)
+
+        self.assertEqual(3, len(unjoined))
+
     def test_volume(self):
         speaker = FakeSpeaker()
         songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
-        s = sonobo.Sonobo(songmap_json, speaker, self.fake_clock)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
 
         for _ in range(25):
             s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 0.0)
@@ -162,10 +275,185 @@ class TestSonobo(unittest.TestCase):
         self.assertEqual(0, speaker.group.coordinator.volume,
                          "Min volume should be capped at 0")
 
+    def test_volume_burst_is_one_write(self):
+        speaker = FakeSpeaker()
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        # RenderingControl events keep the cached volume current.
+        s.volume.events_flowing = lambda: True
+        action_queue = sonobo.ActionQueue()
+        s.action_queue = action_queue
+        speaker.group.coordinator.set_relative_volume = unittest.mock.MagicMock(return_value=16)
+
+        with unittest.mock.patch.object(FakeCoordinator, 'volume', new_callable=unittest.mock.PropertyMock,
+                                        return_value=10) as volume_getter:
+            for _ in range(3):
+                s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 0.0)
+            self.assertEqual(1, len(action_queue))
+            s.perform(action_queue.get(0))
+
+            speaker.group.coordinator.set_relative_volume.assert_called_once_with(6)
+            self.assertEqual(1, volume_getter.call_count)
+
+            # The next burst is computed from the cached volume, and capped.
+            for _ in range(3):
+                s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 0.0)
+            s.perform(action_queue.get(0))
+
+            speaker.group.coordinator.set_relative_volume.assert_called_with(sonobo.MAX_VOLUME - 16)
+            self.assertEqual(1, volume_getter.call_count)
+
+    def test_volume_is_read_again_without_events(self):
+        speaker = FakeSpeaker()
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+        speaker.group.coordinator.set_relative_volume = unittest.mock.MagicMock(return_value=12)
+
+        with unittest.mock.patch.object(FakeCoordinator, 'volume', new_callable=unittest.mock.PropertyMock,
+                                        side_effect=[10, 30]):
+            s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 0.0)
+            speaker.group.coordinator.set_relative_volume.assert_called_once_with(sonobo.VOLUME_STEP)
+
+            # A parent turned it up from the app, and we never heard about it.
+            s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 10.0)
+        speaker.group.coordinator.set_relative_volume.assert_called_once()
+        self.assertEqual(30, s.volume.volume)
+
+    def test_volume_keys_survive_a_failed_flush(self):
+        speaker = FakeSpeaker()
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+
+        with unittest.mock.patch.object(FakeCoordinator, 'volume', new_callable=unittest.mock.PropertyMock,
+                                        side_effect=[sonobo.soco.exceptions.SoCoException('timed out'), 10]):
+            with self.assertRaises(sonobo.soco.exceptions.SoCoException):
+                s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 0.0)
+            speaker.group.coordinator.set_relative_volume = unittest.mock.MagicMock(return_value=12)
+            s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 1.0)
+        speaker.group.coordinator.set_relative_volume.assert_called_once_with(sonobo.VOLUME_STEP)
+
+        # Nor does a volume action lost to a full queue wedge them.
+        s.action_queue = sonobo.ActionQueue(maxsize=1, overflow=sonobo.OVERFLOW_DROP_NEWEST)
+        s.action_queue.on_drop = s.abandoned
+        s.action_queue.put(sonobo.Action(sonobo.ACTION_NEXT, 2.0))
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, 2.0)
+        self.assertTrue(s.volume.press(1, False))
+
+    def test_playlist_catalog(self):
+        speaker = FakeSpeaker()
+        coordinator = speaker.group.coordinator
+        coordinator.get_sonos_playlists = unittest.mock.MagicMock(wraps=coordinator.get_sonos_playlists)
+        coordinator.avTransport.AddURIToQueue = unittest.mock.MagicMock()
+
+        songmap_json = json.loads(PLAYLIST_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        s.playlists.refresh(coordinator)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['B'], 1, 0.0)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['B'], 1, 10.0)
+
+        self.assertEqual(1, coordinator.get_sonos_playlists.call_count)
+        self.assertEqual(2, coordinator.avTransport.AddURIToQueue.call_count)
+        self.assertEqual(
+            'file:///jffs/settings/savedqueues.rsq#1',
+            self.enqueue_args_as_dict(coordinator.avTransport.AddURIToQueue.call_args)['EnqueuedURI'])
+
+        problems = s.update_code_to_song_map([
+            {'debugName': 'Gone', 'key': 'G', 'kind': 'SONOS_PLAYLIST_NAME', 'payload': 'Gone'}])
+        self.assertEqual(['No Sonos playlist named "Gone"'], problems)
+
+    def test_missing_playlists(self):
+        speaker = FakeSpeaker()
+        coordinator = speaker.group.coordinator
+        coordinator.get_sonos_playlists = unittest.mock.MagicMock(wraps=coordinator.get_sonos_playlists)
+        songmap_json = json.loads(PLAYLIST_RAW_SONG_MAP) + [
+            {'debugName': 'Gone', 'key': 'G', 'kind': 'SONOS_PLAYLIST_NAME', 'payload': 'Gone'}]
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+
+        # Reported once we know which playlists there are.
+        with self.assertLogs(sonobo.log, logging.INFO) as logs:
+            s.playlists.refresh(coordinator)
+        self.assertIn('No Sonos playlist named "Gone"', [record.getMessage() for record in logs.records])
+
+        # Pressing it again and again doesn't keep fetching the playlists.
+        for timestamp in (10.0, 20.0, 30.0):
+            s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['G'], 1, timestamp)
+        self.assertEqual(1, coordinator.get_sonos_playlists.call_count)
+
+        self.fake_clock.advance(sonobo.PLAYLIST_MISS_REFRESH_SEC)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['G'], 1, 40.0)
+        self.assertEqual(2, coordinator.get_sonos_playlists.call_count)
+
+    def test_invalid_share_link_is_rejected(self):
+        speaker = FakeSpeaker()
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+
+        with self.assertRaises(ValueError):
+            s.update_code_to_song_map([
+                {'debugName': 'Typo', 'key': 'A', 'kind': 'SPOTIFY', 'payload': 'https://example.com/nope'}])
+
+        # The previous map is still installed.
+        self.assertEqual(songmap_json, s.get_songmap_json())
+        self.assertEqual(2, len(s.song_for_code(sonobo.KEY_STRING_TO_CODE_MAP['A']).enqueue))
+
+    def test_invalid_share_link_on_disk_only_disables_its_key(self):
+        speaker = FakeSpeaker()
+        songmap_json = json.loads(PLAYLIST_RAW_SONG_MAP) + [
+            {'debugName': 'Typo', 'key': 'A', 'kind': 'SPOTIFY', 'payload': 'https://example.com/nope'}]
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+
+        self.assertIsNone(s.song_for_code(sonobo.KEY_STRING_TO_CODE_MAP['A']))
+        self.assertIsNotNone(s.song_for_code(sonobo.KEY_STRING_TO_CODE_MAP['B']))
+        # Still there to be fixed in the editor.
+        self.assertEqual(songmap_json, s.get_songmap_json())
+
+    def test_share_link_falls_back_to_next_service(self):
+        speaker = FakeSpeaker()
+        speaker.group.coordinator.avTransport.AddURIToQueue = unittest.mock.MagicMock(
+            side_effect=[sonobo.soco.exceptions.SoCoException('wrong region'), {}, {}])
+
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        song = s.song_for_code(sonobo.KEY_STRING_TO_CODE_MAP['A'])
+        us_service = song.enqueue[1]
+
+        sonobo.enqueue_song(speaker.group.coordinator, song)
+        self.assertEqual(2, speaker.group.coordinator.avTransport.AddURIToQueue.call_count)
+        self.assertIs(us_service, song.enqueue[0])
+
+        sonobo.enqueue_song(speaker.group.coordinator, song)
+        self.assertEqual(3, speaker.group.coordinator.avTransport.AddURIToQueue.call_count)
+
+    def test_reuses_queue_when_song_is_already_loaded(self):
+        speaker = FakeSpeaker()
+        coordinator = speaker.group.coordinator
+        coordinator.clear_queue = unittest.mock.MagicMock()
+        coordinator.avTransport.AddURIToQueue = unittest.mock.MagicMock(
+            return_value={'FirstTrackNumberEnqueued': '1', 'NewUpdateID': '5'})
+        coordinator.play_from_queue = unittest.mock.MagicMock()
+
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        s.state.subscribe(coordinator)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['A'], 1, 0.0)
+        s.state.on_content_directory_event(FakeEvent({'container_update_i_ds': 'Q:0,5'}))
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['A'], 1, 10.0)
+
+        coordinator.clear_queue.assert_called_once()
+        coordinator.avTransport.AddURIToQueue.assert_called_once()
+        self.assertEqual(2, coordinator.play_from_queue.call_count)
+        coordinator.play_from_queue.assert_called_with(0)
+
+        # Somebody edited the queue from the Sonos app.
+        s.state.on_content_directory_event(FakeEvent({'container_update_i_ds': 'Q:0,9'}))
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['A'], 1, 20.0)
+        self.assertEqual(2, coordinator.clear_queue.call_count)
+        self.assertEqual(2, coordinator.avTransport.AddURIToQueue.call_count)
+
     def test_change_song_map(self):
         speaker = FakeSpeaker()
         original_songmap = json.loads(ONE_SONG_RAW_SONG_MAP)
-        s = sonobo.Sonobo(original_songmap, speaker, self.fake_clock)
+        s = sonobo.Sonobo(original_songmap, speaker, [speaker], self.fake_clock)
 
         speaker.group.coordinator.clear_queue = unittest.mock.MagicMock()
         speaker.group.coordinator.avTransport.AddURIToQueue = unittest.mock.MagicMock()
@@ -206,5 +494,896 @@ class TestSonobo(unittest.TestCase):
             urllib.parse.quote_plus('spotify:track:new_payload').lower(),
             self.enqueue_args_as_dict(speaker.group.coordinator.avTransport.AddURIToQueue.call_args)['EnqueuedURI'])
 
+    def test_worker_executes_queued_actions(self):
+        speaker = FakeSpeaker()
+        speaker.group.coordinator.play = unittest.mock.MagicMock(wraps=speaker.group.coordinator.play)
+
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        action_queue = sonobo.ActionQueue()
+        s.action_queue = action_queue
+
+        # The input thread only enqueues, it never talks to the speaker.
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 0.0)
+        speaker.group.coordinator.play.assert_not_called()
+        self.assertEqual(1, len(action_queue))
+
+        worker = s.start_worker(action_queue)
+        # Closing lets the worker exit once it has drained the queue.
+        action_queue.close()
+        worker.join(1.0)
+        speaker.group.coordinator.play.assert_called_once()
+
+    def test_worker_survives_failed_coordinator_lookup(self):
+        speaker = FakeSpeaker()
+        coordinator = speaker.group.coordinator
+        coordinator.play = unittest.mock.MagicMock(wraps=coordinator.play)
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+        s.coordinator = unittest.mock.MagicMock(side_effect=[
+            sonobo.soco.exceptions.SoCoException('unreachable'), coordinator, coordinator, coordinator])
+        action_queue = sonobo.ActionQueue()
+
+        worker = s.start_worker(action_queue)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 1.0)
+        action_queue.close()
+        worker.join(1.0)
+        self.assertFalse(worker.is_alive())
+        coordinator.play.assert_called_once()
+
+    def test_newer_song_abandons_sequence_in_progress(self):
+        speaker = FakeSpeaker()
+        speaker.group.coordinator.avTransport.AddURIToQueue = unittest.mock.MagicMock()
+        speaker.group.coordinator.play = unittest.mock.MagicMock(wraps=speaker.group.coordinator.play)
+
+        songmap_json = json.loads(TWO_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        action_queue = sonobo.ActionQueue()
+        s.action_queue = action_queue
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['A'], 1, 0.0)
+        first = action_queue.get(0)
+
+        # "C" is pressed while "A" is still clearing the queue.
+        def press_c():
+            s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['C'], 1, 0.5)
+        speaker.group.coordinator.clear_queue = unittest.mock.MagicMock(side_effect=press_c)
+
+        s.perform(first)
+        speaker.group.coordinator.avTransport.AddURIToQueue.assert_not_called()
+        speaker.group.coordinator.play.assert_not_called()
+
+        s.perform(action_queue.get(0))
+        speaker.group.coordinator.avTransport.AddURIToQueue.assert_called_once()
+        self.assertEqual(
+            urllib.parse.quote_plus('spotify:track:payload_c').lower(),
+            self.enqueue_args_as_dict(speaker.group.coordinator.avTransport.AddURIToQueue.call_args)['EnqueuedURI'])
+        speaker.group.coordinator.play.assert_called_once()
+
+    def test_action_latency_metrics(self):
+        speaker = FakeSpeaker()
+        coordinator = speaker.group.coordinator
+        coordinator.clear_queue = unittest.mock.MagicMock(side_effect=lambda: self.fake_clock.advance(0.02))
+        coordinator.avTransport.AddURIToQueue = unittest.mock.MagicMock(
+            side_effect=lambda *args: self.fake_clock.advance(0.05))
+        coordinator.next = unittest.mock.MagicMock(side_effect=RuntimeError('unreachable'))
+
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+        # The keypress happened 10ms before we get to it.
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['A'], 1, self.fake_clock.wall_time() - 0.01)
+        with self.assertRaises(RuntimeError):
+            s.dispatch(sonobo.EV_KEY, sonobo.KEY_RIGHT, 1, self.fake_clock.wall_time())
+
+        [next_row, song_row] = s.metrics.summary()
+        self.assertEqual(('NEXT', 0, 1), (next_row['kind'], next_row['completed'], next_row['errors']))
+        self.assertEqual(('SONG', 1, 0), (song_row['kind'], song_row['completed'], song_row['errors']))
+        # Nothing completed, so there is no latency to speak of.
+        self.assertTrue(math.isnan(next_row['p50']))
+        self.assertTrue(math.isnan(sonobo.Histogram().quantile(0.99)))
+        page = sonobo.render_stats_page([next_row])
+        self.assertIn('&ndash;', page)
+        self.assertNotIn(' ms<', page)
+        self.assertEqual(0.1, song_row['p99'])
+        self.assertAlmostEqual(0.08, song_row['mean'])
+        stages = dict(song_row['stages'])
+        self.assertAlmostEqual(0.02, stages['clear_queue'])
+        self.assertAlmostEqual(0.05, stages['enqueue'])
+
+        metrics = s.metrics.prometheus_text(sonobo.ActionQueue())
+        self.assertIn('sonobo_action_latency_seconds_bucket{kind="SONG",le="0.05"} 0\n', metrics)
+        self.assertIn('sonobo_action_latency_seconds_bucket{kind="SONG",le="0.1"} 1\n', metrics)
+        self.assertIn('sonobo_action_errors_total{kind="NEXT"} 1\n', metrics)
+        self.assertIn('sonobo_actions_dropped_total 0\n', metrics)
+
+    def test_set_speakers_after_rediscovery(self):
+        speaker = FakeSpeaker()
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        self.assertIsNone(s.speaker_with_name('Move'))
+
+        move = FakeSpeaker()
+        move.player_name = 'Move'
+        s.set_speakers(speaker, [speaker, move])
+        self.assertIs(move, s.speaker_with_name('Move'))
+
+    def test_replay_drops_stale_startup_events(self):
+        speaker = FakeSpeaker()
+        speaker.group.coordinator.pause = unittest.mock.MagicMock()
+        speaker.group.coordinator.next = unittest.mock.MagicMock()
+
+        songmap_json = json.loads(ONE_SONG_RAW_SONG_MAP)
+        s = sonobo.Sonobo(songmap_json, speaker, [speaker], self.fake_clock)
+        self.fake_clock.advance(100.0)
+
+        keyboard = sonobo.InputDevice('keyboard')
+        s.replay([(keyboard, (sonobo.EV_KEY, sonobo.KEY_BACKSPACE, 1, 100.0 - sonobo.STARTUP_EVENT_MAX_AGE_SEC - 1.0)),
+                  (keyboard, (sonobo.EV_KEY, sonobo.KEY_RIGHT, 1, 99.0))])
+
+        speaker.group.coordinator.pause.assert_not_called()
+        speaker.group.coordinator.next.assert_called_once()
+
+    def test_startup_buffer_keeps_shift_of_dropped_events(self):
+        keyboard = sonobo.InputDevice('keyboard')
+        batches = [[(keyboard, (sonobo.EV_KEY, sonobo.KEY_LEFTSHIFT, 1, 99.0)),
+                    (keyboard, (sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 99.1)),
+                    (keyboard, (sonobo.EV_KEY, sonobo.KEY_M, 1, 99.2))]]
+        reader = unittest.mock.Mock()
+        reader.read_events = lambda timeout: batches.pop() if batches else time.sleep(timeout) or []
+        startup_input = sonobo.StartupInputBuffer(reader, maxlen=2).start()
+        while batches:
+            time.sleep(0.01)
+        events = startup_input.finish()
+        self.assertEqual([sonobo.KEY_SPACE, sonobo.KEY_M], [event[1] for _, event in events])
+
+        speaker = FakeSpeaker()
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+        s.submit = unittest.mock.Mock()
+        self.fake_clock.advance(100.0)
+        s.replay(events)
+        # The shift press was dropped, but the M after it is still Shift+M.
+        self.assertEqual(sonobo.ACTION_TOGGLE_MOVE, s.submit.call_args.args[0].kind)
+
+    def test_keyboards_have_their_own_shift_and_keymap(self):
+        speaker = FakeSpeaker()
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], self.fake_clock)
+        s.submit = unittest.mock.Mock()
+        one = sonobo.InputDevice('one')
+        two = sonobo.InputDevice('two', sonobo.keymap_json_to_map({'1': 'A'}))
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_LEFTSHIFT, 1, 1.0, device=one)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_M, 1, 1.1, device=two)
+        s.submit.assert_not_called()
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_M, 1, 1.2, device=one)
+        self.assertEqual(sonobo.ACTION_TOGGLE_MOVE, s.submit.call_args.args[0].kind)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['1'], 1, 1.3, device=two)
+        self.assertEqual(sonobo.ACTION_SONG, s.submit.call_args.args[0].kind)
+        # A fast repeat is one keyboard pressing a key again, not two pressing it.
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_A, 1, 1.4, device=one)
+        self.assertEqual(3, s.submit.call_count)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_A, 1, 1.5, device=two)
+        self.assertEqual(3, s.submit.call_count)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_A, 1, 1.6, device=sonobo.InputDevice('three'))
+        self.assertEqual(4, s.submit.call_count)
+        with self.assertRaises(ValueError):
+            sonobo.keymap_json_to_map({'1': 'F13'})
+
+class TestSpeakerCache(unittest.TestCase):
+    def test_round_trip(self):
+        speaker = FakeSpeaker()
+        speaker.ip_address = '127.0.0.2'
+        speaker.uid = 'RINCON_000E58000001401400'
+        speaker.household_id = 'Sonos_household'
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'speakers.json')
+            sonobo.save_speaker_cache(filename, [speaker])
+            entries = sonobo.load_speaker_cache(filename)
+
+        self.assertEqual([{'name': 'Living Room', 'ip': '127.0.0.2',
+                           'uid': 'RINCON_000E58000001401400', 'household': 'Sonos_household'}], entries)
+        cached, = sonobo.speakers_from_cache(entries)
+        self.assertEqual('127.0.0.2', cached.ip_address)
+        # Known without asking the speaker.
+        self.assertEqual('RINCON_000E58000001401400', cached.uid)
+        self.assertEqual('Sonos_household', cached.household_id)
+        # player_name itself still checks the zone group state.
+        self.assertEqual('Living Room', cached._player_name)
+
+    def test_missing_cache(self):
+        self.assertEqual([], sonobo.load_speaker_cache('/nonexistent/speakers.json'))
+
+class TestSongmapStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'songmap.json')
+        self.journal_filename = os.path.join(self.tmpdir.name, 'journal.jsonl')
+        with open(self.filename, 'w') as songmap_file:
+            songmap_file.write('[]')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def song(self, key, payload):
+        return {'debugName': 'Song %s' % key, 'key': key, 'kind': 'SPOTIFY', 'payload': payload}
+
+    def test_journal_records_only_changes(self):
+        store = sonobo.SongmapStore(self.filename, self.journal_filename)
+        store.load()
+        store.save([self.song('A', 'a1'), self.song('B', 'b1')])
+        store.save([self.song('A', 'a2'), self.song('B', 'b1')])
+        store.save([self.song('A', 'a2')])
+
+        store = sonobo.SongmapStore(self.filename, self.journal_filename)
+        self.assertEqual([self.song('A', 'a2')], store.load())
+        self.assertEqual([['A'], ['B']], [list(entry['changes']) for entry in store.history()[1:]])
+        self.assertEqual([], store.songmap_at(0))
+        self.assertEqual([self.song('A', 'a1'), self.song('B', 'b1')], store.songmap_at(1))
+        self.assertEqual([self.song('A', 'a2'), self.song('B', 'b1')], store.songmap_at(2))
+        self.assertEqual([], [name for name in os.listdir(self.tmpdir.name) if name.endswith('.tmp')])
+
+    def test_history_is_bounded(self):
+        store = sonobo.SongmapStore(self.filename, self.journal_filename, max_entries=2)
+        store.load()
+        for i in range(5):
+            store.save([self.song('A', str(i))])
+        self.assertEqual(5, store.revision())
+        self.assertEqual([4, 5], [entry['revision'] for entry in store.history()])
+        self.assertEqual([self.song('A', '2')], store.songmap_at(3))
+        with self.assertRaises(ValueError):
+            store.songmap_at(2)
+
+    def test_refuses_to_rebuild_across_a_gap(self):
+        store = sonobo.SongmapStore(self.filename, self.journal_filename)
+        store.load()
+        for i in range(3):
+            store.save([self.song('A', str(i))])
+        # A torn line in the middle is skipped on load.
+        with open(self.journal_filename) as journal_file:
+            lines = journal_file.readlines()
+        lines[1] = lines[1][:10] + '\n'
+        with open(self.journal_filename, 'w') as journal_file:
+            journal_file.writelines(lines)
+
+        store = sonobo.SongmapStore(self.filename, self.journal_filename)
+        store.load()
+        self.assertEqual([self.song('A', '1')], store.songmap_at(2))
+        with self.assertRaises(sonobo.SongmapHistoryBroken):
+            store.songmap_at(1)
+
+    def test_refuses_to_rebuild_after_unjournaled_edit(self):
+        store = sonobo.SongmapStore(self.filename, self.journal_filename)
+        store.load()
+        store.save([self.song('A', 'a1')])
+        store.save([self.song('A', 'a2')])
+        # Edited while we weren't running.
+        with open(self.filename, 'w') as songmap_file:
+            json.dump([self.song('A', 'a3')], songmap_file)
+
+        store = sonobo.SongmapStore(self.filename, self.journal_filename)
+        store.load()
+        with self.assertRaises(sonobo.SongmapHistoryBroken):
+            store.songmap_at(1)
+
+class TestSongmapWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'songmap.json')
+        with open(self.filename, 'w') as songmap_file:
+            songmap_file.write(ONE_SONG_RAW_SONG_MAP)
+        store = sonobo.SongmapStore(self.filename, os.path.join(self.tmpdir.name, 'journal.jsonl'))
+        speaker = FakeSpeaker()
+        self.sonobo = sonobo.Sonobo(store.load(), speaker, [speaker], FakeClock())
+        self.writer = sonobo.SongmapWriter(self.sonobo, store)
+        self.watcher = sonobo.SongmapWatcher(self.writer, poll_sec=0.05)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmpdir.cleanup()
+
+    def replace_songmap(self, contents):
+        with open(self.filename + '.new', 'w') as songmap_file:
+            songmap_file.write(contents)
+        os.replace(self.filename + '.new', self.filename)
+
+    def test_reload(self):
+        # Our own writes aren't reloaded.
+        self.sonobo.update_code_to_song_map(json.loads(TWO_SONG_RAW_SONG_MAP))
+        self.writer.flush()
+        self.assertFalse(self.watcher.check())
+
+        self.replace_songmap('[not json')
+        self.assertFalse(self.watcher.check())
+        self.assertEqual(json.loads(TWO_SONG_RAW_SONG_MAP), self.sonobo.get_songmap_json())
+
+        self.replace_songmap(PLAYLIST_RAW_SONG_MAP)
+        self.assertTrue(self.watcher.check())
+        self.assertEqual(json.loads(PLAYLIST_RAW_SONG_MAP), self.sonobo.get_songmap_json())
+        self.assertEqual(2, self.writer.store.revision())
+
+    def test_reload_keeps_unwritten_edits(self):
+        song_c = json.loads(TWO_SONG_RAW_SONG_MAP)[1]
+        self.sonobo.put_song(song_c)
+
+        # Someone replaces the file before the writer got to our edit.
+        self.replace_songmap(PLAYLIST_RAW_SONG_MAP)
+        self.assertTrue(self.watcher.check())
+        self.assertEqual(['B', 'C'], [song['key'] for song in self.sonobo.get_songmap_json()])
+        self.assertTrue(self.writer.dirty.is_set())
+
+        self.writer.flush()
+        with open(self.filename) as infile:
+            self.assertEqual(['B', 'C'], [song['key'] for song in json.load(infile)])
+        self.assertFalse(self.watcher.check())
+
+    def test_inotify(self):
+        fd = sonobo.open_inotify(self.tmpdir.name)
+        if fd is None:
+            self.skipTest('inotify unavailable')
+        os.close(fd)
+        thread = self.watcher.start()
+        version, _ = self.sonobo.get_versioned_songmap_json()
+        self.replace_songmap(PLAYLIST_RAW_SONG_MAP)
+        deadline = time.time() + 5
+        while self.sonobo.get_versioned_songmap_json()[0] == version and time.time() < deadline:
+            time.sleep(0.01)
+        # Let it finish journaling before the directory goes away.
+        self.watcher.close()
+        thread.join()
+        self.assertEqual(json.loads(PLAYLIST_RAW_SONG_MAP), self.sonobo.get_songmap_json())
+
+class TestLogIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'sonobo.log')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_lines(self, first, last, mode='a'):
+        with open(self.filename, mode) as log_file:
+            for i in range(first, last):
+                log_file.write('line %d\n' % i)
+
+    def test_pages(self):
+        self.write_lines(0, 25)
+        index = sonobo.LogIndex(self.filename, every=10)
+
+        self.assertEqual(25, index.update())
+        self.assertEqual(['line 10', 'line 11'], index.read_lines(10, 12))
+        self.assertEqual(['line 23', 'line 24'], index.read_lines(23, 30))
+
+        # Appending only indexes the new lines.
+        self.write_lines(25, 31)
+        with open(self.filename, 'a') as log_file:
+            log_file.write('partial')
+        self.assertEqual(32, index.update())
+        self.assertEqual(4, len(index.offsets))
+        self.assertEqual(['line 30', 'partial'], index.read_lines(30, 40))
+
+    def test_rotation_resets_index(self):
+        self.write_lines(0, 25)
+        index = sonobo.LogIndex(self.filename, every=10)
+        self.assertEqual(25, index.update())
+
+        os.rename(self.filename, self.filename + '.prev')
+        self.write_lines(100, 103, mode='w')
+        self.assertEqual(3, index.update())
+        self.assertEqual(['line 100', 'line 101', 'line 102'], index.read_lines(0, 100))
+
+class TestPooledHTTPServer(unittest.TestCase):
+    def test_refuses_connections_beyond_backlog(self):
+        release = threading.Event()
+        server = sonobo.PooledHTTPServer(
+            ('127.0.0.1', 0), lambda request, client_address, server: release.wait(5), pool_size=1, max_pending=1)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        clients = []
+        try:
+            for _ in range(3):
+                clients.append(socket.create_connection(server.server_address, timeout=5))
+            # One is being handled, one waits for the thread, and one is refused.
+            self.assertTrue(clients[2].recv(1024).startswith(b'HTTP/1.1 503 '))
+            self.assertEqual(2, server.connections)
+        finally:
+            release.set()
+            for client in clients:
+                client.close()
+            server.shutdown()
+            server.server_close()
+            server_thread.join()
+        self.assertEqual(0, server.connections)
+
+class TestLogStreamHub(unittest.TestCase):
+    def test_fan_out_and_drop_slow_viewers(self):
+        hub = sonobo.LogStreamHub(client_buffer=2)
+        hub.setFormatter(logging.Formatter('%(message)s'))
+        test_log = logging.getLogger('sonobo_test.stream')
+        test_log.addHandler(hub)
+        try:
+            fast = hub.subscribe()
+            slow = hub.subscribe()
+
+            test_log.warning('one')
+            self.assertEqual('one', fast.lines.get_nowait())
+            test_log.warning('two')
+            self.assertEqual('two', fast.lines.get_nowait())
+            test_log.warning('three')
+            self.assertEqual('three', fast.lines.get_nowait())
+
+            self.assertFalse(fast.dropped)
+            self.assertTrue(slow.dropped)
+            self.assertEqual({fast}, hub.subscribers)
+        finally:
+            test_log.removeHandler(hub)
+
+    def test_limits_viewers(self):
+        hub = sonobo.LogStreamHub()
+        first = hub.subscribe(max_viewers=1)
+        self.assertIsNotNone(first)
+        self.assertIsNone(hub.subscribe(max_viewers=1))
+        hub.unsubscribe(first)
+        self.assertIsNotNone(hub.subscribe(max_viewers=1))
+
+    def test_keeps_recent_lines(self):
+        hub = sonobo.LogStreamHub(recent_lines=2)
+        hub.setFormatter(logging.Formatter('%(message)s'))
+        for message in ('one', 'two', 'three'):
+            hub.handle(logging.makeLogRecord({'msg': message}))
+        self.assertEqual(['two', 'three'], hub.recent_lines())
+
+class TestDroppingQueueHandler(unittest.TestCase):
+    def test_drops_and_reports_when_full(self):
+        log_queue = queue.Queue(2)
+        handler = sonobo.DroppingQueueHandler(log_queue)
+        for message in ('one', 'two', 'three', 'four'):
+            handler.handle(logging.makeLogRecord({'msg': message}))
+        self.assertEqual(2, handler.dropped)
+
+        self.assertEqual('one', log_queue.get_nowait().getMessage())
+        self.assertEqual('two', log_queue.get_nowait().getMessage())
+        handler.handle(logging.makeLogRecord({'msg': 'five'}))
+        self.assertEqual('Log queue full, dropped 2 records', log_queue.get_nowait().getMessage())
+        self.assertEqual('five', log_queue.get_nowait().getMessage())
+
+class TestHTTPHeaders(unittest.TestCase):
+    def test_etag_matches(self):
+        self.assertTrue(sonobo.etag_matches('"a", "b"', '"b"'))
+        self.assertTrue(sonobo.etag_matches('W/"b"', '"b"'))
+        self.assertTrue(sonobo.etag_matches('*', '"b"'))
+        self.assertFalse(sonobo.etag_matches('"ab"', '"b"'))
+        self.assertFalse(sonobo.etag_matches('"b-gzip"', '"b"'))
+        self.assertFalse(sonobo.etag_matches('', '"b"'))
+
+    def test_accepts_encoding(self):
+        self.assertTrue(sonobo.accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertTrue(sonobo.accepts_encoding('GZIP;q=0.5', 'gzip'))
+        self.assertTrue(sonobo.accepts_encoding('br, *', 'gzip'))
+        self.assertFalse(sonobo.accepts_encoding('gzip;q=0', 'gzip'))
+        self.assertFalse(sonobo.accepts_encoding('*, gzip;q=0', 'gzip'))
+        self.assertFalse(sonobo.accepts_encoding('x-gzipped', 'gzip'))
+        self.assertFalse(sonobo.accepts_encoding('', 'gzip'))
+
+class TestHTTPServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        log_filename = os.path.join(self.tmpdir.name, 'sonobo.log')
+        with open(log_filename, 'w') as log_file:
+            log_file.write('hello\n')
+
+        speaker = FakeSpeaker()
+        s = sonobo.Sonobo(json.loads(ONE_SONG_RAW_SONG_MAP), speaker, [speaker], FakeClock())
+        self.sonobo = s
+        log_index = sonobo.LogIndex(log_filename)
+        self.log_stream = log_stream = sonobo.LogStreamHub()
+        editor_page = sonobo.SongmapEditorPage()
+        self.songmap_filename = os.path.join(self.tmpdir.name, 'songmap.json')
+        with open(self.songmap_filename, 'w') as songmap_file:
+            songmap_file.write(ONE_SONG_RAW_SONG_MAP)
+        store = sonobo.SongmapStore(self.songmap_filename, os.path.join(self.tmpdir.name, 'journal.jsonl'))
+        store.load()
+        self.songmap_writer = sonobo.SongmapWriter(s, store)
+        def hwrapper(*args):
+            sonobo.SonoboHTTPHandler(s, log_index, log_stream, editor_page, self.songmap_writer, *args)
+        self.server = sonobo.PooledHTTPServer(('127.0.0.1', 0), hwrapper, pool_size=2)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.log_stream.disconnect_all()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        self.tmpdir.cleanup()
+
+    def test_keep_alive(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        try:
+            for path, expected in (('/', b'Songmap Editor'), ('/log', b'hello'), ('/stats', b'Sonobo Stats'),
+                                   ('/metrics', b''), ('/nope', b'')):
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+                self.assertIn(expected, body)
+                self.assertEqual(11, response.version)
+                self.assertFalse(response.will_close)
+        finally:
+            connection.close()
+
+    def test_editor_etag(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        try:
+            connection.request('GET', '/', headers={'Accept-Encoding': 'gzip'})
+            response = connection.getresponse()
+            body = response.read()
+            self.assertEqual('gzip', response.getheader('Content-Encoding'))
+            self.assertIn(b'Songmap Editor', gzip.decompress(body))
+            etag = response.getheader('ETag')
+
+            connection.request('GET', '/', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+            response = connection.getresponse()
+            self.assertIn(b'Songmap Editor', response.read())
+            self.assertIsNone(response.getheader('Content-Encoding'))
+
+            connection.request('GET', '/', headers={'If-None-Match': etag})
+            response = connection.getresponse()
+            self.assertEqual(b'', response.read())
+            self.assertEqual(304, response.status)
+
+            self.sonobo.update_code_to_song_map(json.loads(TWO_SONG_RAW_SONG_MAP))
+            connection.request('GET', '/', headers={'If-None-Match': etag})
+            response = connection.getresponse()
+            self.assertIn(b'Song C', response.read())
+            self.assertEqual(200, response.status)
+            self.assertNotEqual(etag, response.getheader('ETag'))
+        finally:
+            connection.close()
+
+    def test_static_assets_are_named_by_content(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        try:
+            connection.request('GET', '/')
+            page = connection.getresponse().read().decode('utf-8')
+            self.assertIn(sonobo.EDITOR_JS_PATH, page)
+            self.assertRegex(sonobo.EDITOR_JS_PATH, r'^/static/editor\.[0-9a-f]{20}\.js$')
+
+            for path in (sonobo.EDITOR_CSS_PATH, sonobo.EDITOR_JS_PATH):
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                self.assertEqual(200, response.status)
+                self.assertIn('immutable', response.getheader('Cache-Control'))
+
+            connection.request('GET', '/static/editor.js')
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(404, response.status)
+        finally:
+            connection.close()
+
+    def test_idle_keep_alive_connections_time_out(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        try:
+            with unittest.mock.patch.object(sonobo, 'HTTP_KEEPALIVE_IDLE_SEC', 0.1):
+                connection.request('GET', '/')
+                response = connection.getresponse()
+                response.read()
+                self.assertFalse(response.will_close)
+                # The server hangs up rather than holding a thread for us.
+                self.assertEqual(b'', connection.sock.recv(1))
+        finally:
+            connection.close()
+
+    def test_log_stream_viewers_are_limited(self):
+        # pool_size=2 leaves one thread for log viewers.
+        viewer = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        other = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        try:
+            viewer.request('GET', '/log/stream')
+            self.assertEqual(200, viewer.getresponse().status)
+
+            other.request('GET', '/log/stream')
+            response = other.getresponse()
+            response.read()
+            self.assertEqual(503, response.status)
+
+            other.request('GET', '/stats')
+            response = other.getresponse()
+            self.assertIn(b'Sonobo Stats', response.read())
+        finally:
+            viewer.close()
+            other.close()
+
+    def test_songmap_api(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        def call(method, path, body=None, headers={}):
+            connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        try:
+            status, songmap = call('GET', '/api/songmap')
+            self.assertEqual(200, status)
+            version = songmap['version']
+            self.assertEqual(['A'], [song['key'] for song in songmap['songs']])
+
+            status, result = call('PUT', '/api/songmap/B', {'kind': 'SONOS_PLAYLIST_NAME', 'payload': 'Bedtime'},
+                                  {'If-Match': '"%d"' % version})
+            self.assertEqual(200, status)
+            self.assertEqual(version + 1, result['version'])
+            self.assertEqual('Bedtime', self.sonobo.key_code_to_song_map[sonobo.KEY_STRING_TO_CODE_MAP['B']].payload)
+
+            # Based on the old version, so it's refused.
+            status, _ = call('DELETE', '/api/songmap/A', headers={'If-Match': '"%d"' % version})
+            self.assertEqual(412, status)
+            status, _ = call('PATCH', '/api/songmap/B', {'debugName': 'Bedtime!'})
+            self.assertEqual(200, status)
+            status, _ = call('DELETE', '/api/songmap/A')
+            self.assertEqual(200, status)
+            status, _ = call('DELETE', '/api/songmap/A')
+            self.assertEqual(404, status)
+            self.assertNotIn(sonobo.KEY_STRING_TO_CODE_MAP['A'], self.sonobo.key_code_to_song_map)
+        finally:
+            connection.close()
+
+        self.songmap_writer.flush()
+        with open(self.songmap_filename) as songmap_file:
+            self.assertEqual([{'debugName': 'Bedtime!', 'kind': 'SONOS_PLAYLIST_NAME', 'payload': 'Bedtime', 'key': 'B'}],
+                             json.load(songmap_file))
+
+    def test_songmap_rollback(self):
+        self.sonobo.update_code_to_song_map(json.loads(TWO_SONG_RAW_SONG_MAP))
+        self.songmap_writer.flush()
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        try:
+            connection.request('POST', '/api/songmap/rollback', json.dumps({'revision': 0}))
+            response = connection.getresponse()
+            self.assertEqual(2, json.loads(response.read())['revision'])
+            self.assertEqual(200, response.status)
+        finally:
+            connection.close()
+        self.assertEqual(json.loads(ONE_SONG_RAW_SONG_MAP), self.sonobo.get_songmap_json())
+        with open(self.songmap_filename) as songmap_file:
+            self.assertEqual(json.loads(ONE_SONG_RAW_SONG_MAP), json.load(songmap_file))
+
+    def test_songmap_rollback_refused_when_journal_is_broken(self):
+        self.sonobo.update_code_to_song_map(json.loads(TWO_SONG_RAW_SONG_MAP))
+        self.songmap_writer.flush()
+        # As if someone edited songmap.json while we weren't running.
+        self.songmap_writer.store.saved = json.loads(PLAYLIST_RAW_SONG_MAP)
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        try:
+            connection.request('POST', '/api/songmap/rollback', json.dumps({'revision': 0}))
+            response = connection.getresponse()
+            self.assertIn('match', json.loads(response.read())['error'])
+            self.assertEqual(409, response.status)
+        finally:
+            connection.close()
+        self.assertEqual(json.loads(TWO_SONG_RAW_SONG_MAP), self.sonobo.get_songmap_json())
+
+class TestBenchmark(unittest.TestCase):
+    def test_fault_injection(self):
+        clock = FakeClock()
+        faults = FaultInjector(clock, latency_sec=0.1, jitter_sec=0.05, failure_rate=0.5, seed=3)
+        coordinator = FakeCoordinator(faults)
+        failures = 0
+        for _ in range(20):
+            try:
+                coordinator.play()
+            except sonobo.soco.exceptions.SoCoException:
+                failures += 1
+        self.assertEqual(20, faults.calls['play'])
+        self.assertEqual(faults.failures, failures)
+        self.assertTrue(0 < failures < 20)
+        self.assertTrue(2.0 <= clock.current_timestamp <= 3.0)
+
+    def test_simulation_is_deterministic(self):
+        import sonobo_bench
+        script = sonobo_bench.rapid_song_switching()
+        first = sonobo_bench.simulate(script, 0.05, 0.03, 0.0, seed=7)
+        second = sonobo_bench.simulate(script, 0.05, 0.03, 0.0, seed=7)
+        self.assertEqual(first.latencies, second.latencies)
+        self.assertEqual(first.calls, second.calls)
+        # Songs picked while an earlier one was loading were abandoned, not played.
+        self.assertEqual(1, first.calls['AddURIToQueue'])
+        self.assertGreater(first.superseded, 0)
+
+class TestActionQueue(unittest.TestCase):
+    def test_drop_oldest(self):
+        q = sonobo.ActionQueue(maxsize=2)
+        self.assertTrue(q.put(sonobo.Action(sonobo.ACTION_NEXT, 1.0)))
+        self.assertTrue(q.put(sonobo.Action(sonobo.ACTION_PREVIOUS, 2.0)))
+        self.assertTrue(q.put(sonobo.Action(sonobo.ACTION_PAUSE, 3.0)))
+
+        self.assertEqual(1, q.dropped)
+        self.assertEqual(sonobo.ACTION_PREVIOUS, q.get(0).kind)
+        self.assertEqual(sonobo.ACTION_PAUSE, q.get(0).kind)
+        self.assertIsNone(q.get(0))
+
+    def test_drop_newest(self):
+        q = sonobo.ActionQueue(maxsize=1, overflow=sonobo.OVERFLOW_DROP_NEWEST)
+        self.assertTrue(q.put(sonobo.Action(sonobo.ACTION_NEXT, 1.0)))
+        self.assertFalse(q.put(sonobo.Action(sonobo.ACTION_PREVIOUS, 2.0)))
+
+        self.assertEqual(1, q.dropped)
+        self.assertEqual(sonobo.ACTION_NEXT, q.get(0).kind)
+
+    def test_newer_song_replaces_pending_songs(self):
+        q = sonobo.ActionQueue()
+        q.put(sonobo.Action(sonobo.ACTION_SONG, 1.0, song=sonobo.SongInfo('a', 'SPOTIFY')))
+        q.put(sonobo.Action(sonobo.ACTION_NEXT, 2.0))
+        q.put(sonobo.Action(sonobo.ACTION_SONG, 3.0, song=sonobo.SongInfo('c', 'SPOTIFY')))
+
+        self.assertEqual(sonobo.ACTION_NEXT, q.get(0).kind)
+        self.assertEqual('c', q.get(0).song.payload)
+        self.assertIsNone(q.get(0))
+
+class TestEventReader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'event-kbd')
+        os.mkfifo(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reads_whole_batch(self):
+        with sonobo.EventReader(self.path) as reader:
+            writer = os.open(self.path, os.O_WRONLY)
+            try:
+                self.assertEqual([], reader.read_events(0))
+
+                os.write(writer,
+                         sonobo.INPUT_EVENT_STRUCT.pack(10, 500000, 4, 4, 30) +
+                         sonobo.INPUT_EVENT_STRUCT.pack(10, 500000, sonobo.EV_KEY, sonobo.KEY_SPACE, 1) +
+                         sonobo.INPUT_EVENT_STRUCT.pack(10, 500000, 0, 0, 0))
+
+                self.assertEqual([(4, 4, 30, 10.5),
+                                  (sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 10.5),
+                                  (0, 0, 0, 10.5)],
+                                 reader.read_events(1.0))
+            finally:
+                os.close(writer)
+
+    def test_startup_buffer(self):
+        with sonobo.InputMultiplexer([{'match': self.path}], watch_dir=self.tmpdir.name) as reader:
+            writer = os.open(self.path, os.O_WRONLY)
+            try:
+                startup_input = sonobo.StartupInputBuffer(reader, maxlen=2).start()
+                for code in (sonobo.KEY_LEFT, sonobo.KEY_RIGHT, sonobo.KEY_SPACE):
+                    os.write(writer, sonobo.INPUT_EVENT_STRUCT.pack(10, 0, sonobo.EV_KEY, code, 1))
+                    time.sleep(0.05)
+                events = startup_input.finish()
+            finally:
+                os.close(writer)
+
+        # Bounded: only the most recent events are kept.
+        self.assertEqual([(sonobo.EV_KEY, sonobo.KEY_RIGHT, 1, 10.0),
+                          (sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 10.0)], [event for _, event in events])
+        self.assertEqual({'event-kbd'}, {device.name for device, _ in events})
+
+    def test_multiplexer_hotplug(self):
+        pattern = os.path.join(self.tmpdir.name, '*-kbd')
+        with sonobo.InputMultiplexer([{'match': pattern}], watch_dir=self.tmpdir.name) as reader:
+            if reader.inotify_fd is None:
+                self.skipTest('inotify unavailable')
+            writer = os.open(self.path, os.O_WRONLY)
+            try:
+                os.write(writer, sonobo.INPUT_EVENT_STRUCT.pack(10, 0, sonobo.EV_KEY, sonobo.KEY_SPACE, 1))
+                (first, event), = reader.read_events(1.0)
+                self.assertEqual((sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 10.0), event)
+
+                # Plugged in later.
+                second_path = os.path.join(self.tmpdir.name, 'second-kbd')
+                os.mkfifo(second_path)
+                second_path = os.path.realpath(second_path)
+                self.assertEqual([], reader.read_events(1.0))
+                second_writer = os.open(second_path, os.O_WRONLY)
+                try:
+                    os.write(second_writer, sonobo.INPUT_EVENT_STRUCT.pack(11, 0, sonobo.EV_KEY, sonobo.KEY_UP, 1))
+                    os.write(writer, sonobo.INPUT_EVENT_STRUCT.pack(11, 0, sonobo.EV_KEY, sonobo.KEY_DOWN, 1))
+                    events = reader.read_events(1.0)
+                finally:
+                    os.close(second_writer)
+                self.assertEqual({(first, sonobo.KEY_DOWN), (reader.devices[reader.fds[second_path]], sonobo.KEY_UP)},
+                                 {(device, event[1]) for device, event in events})
+                self.assertEqual('second-kbd', reader.devices[reader.fds[second_path]].name)
+            finally:
+                os.close(writer)
+
+            # Unplugged.
+            os.unlink(self.path)
+            deadline = time.time() + 5
+            while len(reader.readers) > 1 and time.time() < deadline:
+                reader.read_events(0.1)
+            self.assertEqual([second_path], list(reader.fds))
+
+    def test_records_raw_events(self):
+        capture = os.path.join(self.tmpdir.name, 'capture.bin')
+        # Room for two events per file, so the third batch rotates.
+        recorder = sonobo.EventRecorder(capture, max_bytes=2 * sonobo.INPUT_EVENT_STRUCT.size, backups=1)
+        with sonobo.EventReader(self.path, recorder=recorder) as reader:
+            writer = os.open(self.path, os.O_WRONLY)
+            try:
+                events = []
+                for i in range(3):
+                    os.write(writer, sonobo.INPUT_EVENT_STRUCT.pack(10 + i, 0, sonobo.EV_KEY, sonobo.KEY_SPACE, 1))
+                    events.extend(reader.read_events(1.0))
+            finally:
+                os.close(writer)
+
+        self.assertEqual([capture + '.1', capture], sonobo.capture_files(capture, backups=1))
+        self.assertEqual(events, sonobo.read_capture(sonobo.capture_files(capture, backups=1)))
+        self.assertEqual([(sonobo.EV_KEY, sonobo.KEY_SPACE, 1, 12.0)], sonobo.read_capture([capture]))
+
+    def test_failed_recording_stops_for_every_device(self):
+        recorder = sonobo.EventRecorder(os.path.join(self.tmpdir.name, 'capture.bin'))
+        recorder.file.write = unittest.mock.Mock(side_effect=OSError('No space left on device'))
+        with sonobo.EventReader(self.path, recorder=recorder) as first, \
+                sonobo.EventReader(self.path, recorder=recorder) as second:
+            writer = os.open(self.path, os.O_WRONLY)
+            try:
+                os.write(writer, sonobo.INPUT_EVENT_STRUCT.pack(10, 0, sonobo.EV_KEY, sonobo.KEY_SPACE, 1))
+                self.assertEqual(1, len(first.read_events(1.0)))
+                self.assertIsNone(recorder.file)
+                os.write(writer, sonobo.INPUT_EVENT_STRUCT.pack(11, 0, sonobo.EV_KEY, sonobo.KEY_SPACE, 1))
+                self.assertEqual(1, len(second.read_events(1.0)))
+            finally:
+                os.close(writer)
+
+class TestFakeSonos(unittest.TestCase):
+    """Drives fake_sonos.py through real soco, HTTP and events."""
+
+    def setUp(self):
+        import fake_sonos
+        self.household = fake_sonos.FakeHousehold(port=0)
+        self.living_room = self.household.add_speaker('Living Room')
+        self.move = self.household.add_speaker('Move')
+        self.household.add_playlist('Bedtime')
+        try:
+            self.household.start()
+        except OSError as e:
+            self.skipTest('Cannot listen on 127.0.0.x: %s' % e)
+        self.addCleanup(self.household.stop)
+        entries = self.household.speaker_cache()
+        self.speakers = sonobo.speakers_from_cache(entries)
+        self.speaker = sonobo.verify_cached_speaker(self.speakers, entries, 'Living Room')
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_sonobo_against_fake_speakers(self):
+        self.assertIsNotNone(self.speaker)
+        self.assertEqual(self.living_room.port, self.speaker.port)
+        s = sonobo.Sonobo(json.loads(PLAYLIST_RAW_SONG_MAP), self.speaker, self.speakers, sonobo.Clock())
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_STRING_TO_CODE_MAP['B'], 1, time.time())
+        self.assertEqual('PLAYING', self.living_room.transport_state)
+        self.assertEqual(3, len(self.living_room.queue))
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_UP, 1, time.time())
+        self.assertEqual(10 + sonobo.VOLUME_STEP, self.living_room.volume)
+
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_LEFTSHIFT, 1, time.time())
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_M, 1, time.time())
+        self.assertIs(self.living_room, self.move.coordinator)
+        s.dispatch(sonobo.EV_KEY, sonobo.KEY_M, 1, time.time())
+        self.assertIs(self.move, self.move.coordinator)
+
+    def test_events(self):
+        s = sonobo.Sonobo(json.loads(PLAYLIST_RAW_SONG_MAP), self.speaker, self.speakers, sonobo.Clock())
+        s.state.subscribe(self.speaker)
+        self.addCleanup(s.state.unsubscribe)
+        self.wait_for(lambda: s.state.queue_update_id == '0')
+        self.assertTrue(s.state.subscribed())
+
+        self.household.set_transport_state(self.living_room, 'PAUSED_PLAYBACK')
+        self.wait_for(lambda: s.state.transport_state == 'PAUSED_PLAYBACK')
+        # Known from the event, without asking the speaker.
+        requests = self.household.requests
+        self.assertEqual('PAUSED_PLAYBACK', s.state.get_transport_state(self.speaker))
+        self.assertEqual(requests, self.household.requests)
+
 if __name__ == '__main__':
     unittest.main()